@@ -1,13 +1,21 @@
 import sys
 
-import structlog
+__all__ = ["CladeTime"]
 
-from cladetime.cladetime import CladeTime
 
-__all__ = ["CladeTime"]
+def __getattr__(name: str):
+    # CladeTime is imported on first use so that "import cladetime" stays cheap
+    # (its data dependencies are only loaded when a code path needs them)
+    if name == "CladeTime":
+        from cladetime.cladetime import CladeTime
+
+        return CladeTime
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def setup_logging():
+    import structlog
+
     shared_processors = [
         structlog.processors.TimeStamper(fmt="%Y-%m-%d %H:%M:%S"),
         structlog.processors.add_log_level,
@@ -29,6 +37,3 @@ def setup_logging():
         processors=processors,
         cache_logger_on_first_use=True,
     )
-
-
-setup_logging()
@@ -2,19 +2,34 @@
 
 import datetime
 import os
+import shutil
 import subprocess
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from pathlib import Path
 
 import polars as pl
 import rich_click as click
 import structlog
 
+from cladetime.exceptions import NextcladeRunError
+from cladetime.util.assignment import (
+    _get_assignment_store_path,
+    combine_assignments,
+    get_stored_assignments,
+    update_assignment_store,
+)
+from cladetime.util.cache import _atomic_open
 from cladetime.util.config import Config
-from cladetime.util.reference import get_nextclade_dataset
+from cladetime.util.fasta import _split_fasta, profile_fasta, write_fasta_records
+from cladetime.util.pipeline import Pipeline, Stage
+from cladetime.util.reference import _get_nextclade_dataset_tag, get_nextclade_dataset
 from cladetime.util.sequence import (
     _unzip_sequence_package,
     get_covid_genome_data,
     parse_sequence_assignments,
 )
+from cladetime.util.timing import MetricsCollector, span, time_function
 
 logger = structlog.get_logger()
 
@@ -31,6 +46,7 @@ def setup_config(base_data_dir: str, sequence_released_date: datetime, tree_as_o
     return config
 
 
+@time_function
 def get_sequences(config: Config):
     """Download SARS-CoV-2 sequences from Genbank."""
 
@@ -46,6 +62,7 @@ def get_sequences(config: Config):
     logger.info("NCBI SARS-COV-2 genome package downloaded and unzipped", package_location=sequence_package)
 
 
+@time_function
 def get_sequence_metadata(config: Config):
     """Generate tabular representation of the downloaded genbank sequences."""
 
@@ -58,58 +75,328 @@ def get_sequence_metadata(config: Config):
                 "tsv",
                 "virus-genome",
                 "--inputfile",
-                f"{config.data_path}/ncbi_dataset/data/data_report.jsonl",
+                f"{config.ncbi_sequence_report_file}",
                 "--fields",
                 f"{fields}",
             ],
             stdout=f,
+            check=True,
         )
 
     logger.info("extracted sequence metadata", metadata_file=config.ncbi_sequence_metadata_file)
 
 
-def assign_clades(config: Config, nextclade_dataset_path: str):
-    """Assign downloaded genbank sequences to a clade."""
+@time_function
+def prefilter_sequences(config: Config) -> Path:
+    """
+    Profile, quality-filter and deduplicate the downloaded sequences before clade assignment.
+
+    Each sequence's content hash, length and fraction of ambiguous bases are
+    computed in a single pass over config.ncbi_sequence_file. Sequences
+    shorter than config.sequence_min_length, or with a larger ambiguous base
+    fraction than config.sequence_max_ambiguous_fraction, fail QC and aren't
+    assigned a clade. Of the sequences that pass, the first record of each
+    distinct sequence is its representative: only representatives are sent
+    to Nextclade, and their assignments are shared with the duplicates.
+
+    Returns
+    -------
+    Path
+        Location of the QC table (config.sequence_qc_file): the columns
+        returned by cladetime.util.fasta.profile_fasta, plus passed_qc and
+        representative flags.
+    """
+    passed_qc = pl.lit(True)
+    if config.sequence_min_length is not None:
+        passed_qc = passed_qc & (pl.col("length") >= config.sequence_min_length)
+    if config.sequence_max_ambiguous_fraction is not None:
+        passed_qc = passed_qc & (pl.col("ambiguous_fraction") <= config.sequence_max_ambiguous_fraction)
+
+    sequence_qc = (
+        profile_fasta(config.ncbi_sequence_file)
+        .with_columns(passed_qc=passed_qc)
+        .with_columns(
+            representative=pl.col("passed_qc")
+            & pl.col("record").eq(pl.col("record").filter(pl.col("passed_qc")).min().over("seq_hash"))
+        )
+    )
+    with _atomic_open(config.sequence_qc_file) as f:
+        sequence_qc.write_parquet(f.name)
 
-    subprocess.run(
-        [
-            "nextclade",
-            "run",
-            f"{config.ncbi_sequence_file}",
-            "--input-dataset",
-            nextclade_dataset_path,
-            "--output-csv",
-            f"{config.assignment_no_metadata_file}",
-        ]
+    num_passed = sequence_qc["passed_qc"].sum()
+    logger.info(
+        "Sequences deduplicated and filtered",
+        sequence_qc_file=config.sequence_qc_file,
+        num_sequences=len(sequence_qc),
+        num_failed_qc=len(sequence_qc) - num_passed,
+        num_duplicates=num_passed - sequence_qc["representative"].sum(),
     )
 
-    logger.info("Assigned sequences to clades via Nextclade CLI", output_file=config.assignment_no_metadata_file)
+    return config.sequence_qc_file
+
+
+@time_function
+def assign_clades(
+    config: Config,
+    nextclade_dataset_path: str,
+    shards: int = 1,
+    jobs: int | None = None,
+    retries: int = 1,
+    dataset_tag: str | None = None,
+    sequence_qc_file: Path | None = None,
+):
+    """
+    Assign downloaded genbank sequences to a clade.
+
+    Only one record of each distinct sequence is sent to Nextclade, and its
+    assignment is copied to every record with the same sequence. Records that
+    failed QC (see prefilter_sequences) aren't assigned a clade.
+
+    Parameters
+    ----------
+    config : Config
+        Pipeline configuration.
+    nextclade_dataset_path : str
+        Path to the Nextclade dataset (.zip) used for clade assignments.
+    shards : int
+        Number of shards to split the sequence file into. Each shard is assigned
+        by its own, concurrently-running Nextclade process, and the results are
+        combined into config.assignment_no_metadata_file.
+    jobs : int | None
+        Number of threads used by each sharded Nextclade process. Defaults to
+        the number of CPUs divided by the number of shards.
+    retries : int
+        Number of times a failed shard is re-run before the assignment fails.
+    dataset_tag : str | None
+        Version tag of the Nextclade dataset. When provided (and persistent
+        caching is enabled), clade assignments are stored by sequence content
+        and dataset tag, and only sequences without a stored assignment are
+        sent to Nextclade.
+    sequence_qc_file : Path | None
+        QC table written by prefilter_sequences. By default, the sequences
+        are profiled (and filtered using config's QC thresholds) first.
+    """
+    if sequence_qc_file is None:
+        sequence_qc_file = prefilter_sequences(config)
+    sequence_qc = pl.read_parquet(sequence_qc_file)
+    sequences = sequence_qc.filter("passed_qc").select("record", "seqName", "seq_hash")
+    representatives = sequence_qc.filter("representative").select("record", "seqName", "seq_hash")
+
+    store_path = None
+    stored, unassigned = pl.DataFrame(), representatives
+    if dataset_tag is not None and config.cache_path is not None:
+        store_path = _get_assignment_store_path(config.cache_path, dataset_tag)
+        stored, unassigned = get_stored_assignments(representatives, store_path)
+
+    new_assignments = pl.DataFrame()
+    if len(unassigned) > 0:
+        # a sequence file without failed or duplicate records is sent to Nextclade as-is
+        sequence_file = config.ncbi_sequence_file
+        if len(unassigned) < len(sequence_qc):
+            sequence_file = config.data_path / "unassigned_sequences.fasta"
+            write_fasta_records(config.ncbi_sequence_file, sequence_file, unassigned["record"].to_list())
+        output_file = config.data_path / "unassigned_sequences_nextclade.csv"
+        _run_nextclade(sequence_file, nextclade_dataset_path, output_file, shards, jobs, retries)
+        new_assignments = pl.read_csv(output_file, separator=";", infer_schema_length=0)
+        if store_path is not None:
+            update_assignment_store(store_path, new_assignments, unassigned)
+
+    assignments = combine_assignments(stored, new_assignments, sequences)
+    assignments.write_csv(config.assignment_no_metadata_file, separator=";")
+
+    logger.info(
+        "Assigned sequences to clades via Nextclade CLI",
+        output_file=config.assignment_no_metadata_file,
+        dataset_tag=dataset_tag,
+        num_sequences=len(assignments),
+        num_stored=len(stored),
+        num_assigned=len(unassigned),
+    )
+
+
+def _run_nextclade(
+    sequence_file: Path,
+    nextclade_dataset_path: str,
+    output_file: Path,
+    shards: int = 1,
+    jobs: int | None = None,
+    retries: int = 1,
+):
+    """
+    Run Nextclade on a sequence file, optionally split into concurrently-assigned shards.
+
+    A failed Nextclade run is retried up to retries times. When a shard still
+    fails, the other shards' Nextclade processes are stopped and the failure
+    is raised as a NextcladeRunError.
+    """
+    processes = _NextcladeProcesses()
+    if shards <= 1:
+        _run_nextclade_shard(processes, sequence_file, nextclade_dataset_path, jobs, retries, output_file)
+        return
+
+    shard_dir = Path(output_file).parent / "nextclade_shards"
+    sequence_shards, shard_records = _split_fasta(sequence_file, shard_dir, shards)
+    if jobs is None:
+        jobs = max(1, (os.cpu_count() or 1) // max(1, len(sequence_shards)))
+
+    with ThreadPoolExecutor(max_workers=max(1, len(sequence_shards))) as executor:
+        futures = [
+            executor.submit(_run_nextclade_shard, processes, sequence_shard, nextclade_dataset_path, jobs, retries)
+            for sequence_shard in sequence_shards
+        ]
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        failed = [future for future in futures if future in done and future.exception() is not None]
+        if failed:
+            # the run can't succeed, so the other shards are stopped rather than run to completion
+            processes.cancel()
+            for future in futures:
+                future.cancel()
+            raise failed[0].exception()
+        assignment_shards = [future.result() for future in futures]
+
+    _merge_nextclade_output(assignment_shards, shard_records, output_file)
+
+
+class _NextcladeProcesses:
+    """The running Nextclade processes of a clade assignment, which are stopped together when it fails."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes: set[subprocess.Popen] = set()
+        self.cancelled = False
+
+    def run(self, args: list[str]) -> tuple[int, str]:
+        """Run a Nextclade command and return its exit code and stderr."""
+        with self._lock:
+            if self.cancelled:
+                raise NextcladeRunError("Nextclade run cancelled")
+            process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            self._processes.add(process)
+        try:
+            _, stderr = process.communicate()
+        finally:
+            with self._lock:
+                self._processes.discard(process)
+        return process.returncode, stderr
+
+    def cancel(self):
+        """Stop the running Nextclade processes, and don't start any more."""
+        with self._lock:
+            self.cancelled = True
+            for process in self._processes:
+                process.terminate()
+
+
+def _run_nextclade_shard(
+    processes: _NextcladeProcesses,
+    sequence_shard: Path,
+    nextclade_dataset_path: str,
+    jobs: int | None,
+    retries: int,
+    output_file: Path | None = None,
+) -> Path:
+    """Run Nextclade on one shard of the sequence file, retrying on failure, and return its output file."""
+    if output_file is None:
+        output_file = sequence_shard.with_suffix(".csv")
+    args = ["nextclade", "run", f"{sequence_shard}", "--input-dataset", nextclade_dataset_path]
+    if jobs is not None:
+        args += ["--jobs", str(jobs)]
+    args += ["--output-csv", f"{output_file}"]
+
+    for attempt in range(retries + 1):
+        returncode, stderr = processes.run(args)
+        if returncode == 0:
+            return output_file
+        if processes.cancelled:
+            break
+        logger.warning(
+            "Nextclade shard failed",
+            shard=str(sequence_shard),
+            attempt=attempt + 1,
+            returncode=returncode,
+            stderr=stderr[-2000:],
+        )
 
+    raise NextcladeRunError(
+        f"Nextclade failed on {sequence_shard.name} after {attempt + 1} attempt(s) "
+        f"(exit code {returncode}): {stderr[-500:]}"
+    )
 
-def merge_metadata(config: Config) -> pl.DataFrame:
-    """Merge sequence metadata with clade assignments."""
 
-    df_metadata = pl.read_csv(config.ncbi_sequence_metadata_file, separator="\t")
+def _merge_nextclade_output(assignment_shards: list[Path], shard_records: list[list[int]], output_file: Path):
+    """
+    Concatenate per-shard Nextclade CSV output into a single file with one header row.
+
+    Each shard's index column (the record's position in the shard) is
+    replaced with the record's position in the unsharded sequence file, as an
+    unsharded Nextclade run would have numbered it.
+    """
+    header = None
+    with open(output_file, "wb") as out:
+        for assignment_shard, records in zip(assignment_shards, shard_records):
+            with open(assignment_shard, "rb") as f:
+                shard_header = f.readline()
+                if header is None:
+                    header = shard_header
+                    out.write(header)
+                elif shard_header != header:
+                    raise NextcladeRunError(f"Nextclade output columns in {assignment_shard.name} don't match")
+                if not header.startswith(b"index;"):
+                    shutil.copyfileobj(f, out)
+                    continue
+                for line in f:
+                    shard_index, rest = line.split(b";", 1)
+                    out.write(b"%d;%s" % (records[int(shard_index)], rest))
+
+
+@time_function
+def merge_metadata(config: Config) -> pl.LazyFrame:
+    """
+    Merge sequence metadata with clade assignments.
+
+    Both inputs are scanned lazily, and the returned LazyFrame joins them in a
+    single query plan that can be streamed to disk (see write_merged_metadata).
+    The inputs are validated up front with one aggregate query, so memory use
+    doesn't depend on the number of sequences.
+
+    Raises
+    ------
+    ValueError
+        If the sequence metadata or the clade assignments contain more than
+        one row for a sequence.
+    """
+
+    lf_metadata = pl.scan_csv(config.ncbi_sequence_metadata_file, separator="\t")
+    lf_assignments = pl.scan_csv(config.assignment_no_metadata_file, separator=";", infer_schema_length=5000)
+    lf_assignments = parse_sequence_assignments(lf_assignments)
+
+    joined = lf_metadata.join(lf_assignments, left_on="Accession", right_on="seq", how="left")
+
+    metadata_check, assignment_check, missing_check = pl.collect_all(
+        [
+            lf_metadata.select(pl.len(), pl.col("Accession").n_unique().alias("n_unique")),
+            lf_assignments.select(pl.len(), pl.col("seq").n_unique().alias("n_unique")),
+            # ?? what is the difference between "clade" and "clade_nextstrain" ??
+            joined.select(pl.len(), pl.col("clade_nextstrain").null_count().alias("num_missing")),
+        ],
+        streaming=True,
+    )
 
     # we're expecting one row per sequence id (aka Accession)
     # TODO: how do we want to handle the case where the metadata file has
     # duplicate Accession values?
-    assert df_metadata["Accession"].n_unique() == df_metadata.shape[0]
-
-    df_assignments = pl.read_csv(config.assignment_no_metadata_file, separator=";", infer_schema_length=5000)
-    df_assignments = parse_sequence_assignments(df_assignments)
+    if metadata_check["n_unique"].item() != metadata_check["len"].item():
+        raise ValueError("Sequence metadata contains duplicate Accession values. Stopping assignment process.")
+    if assignment_check["n_unique"].item() != assignment_check["len"].item():
+        raise ValueError("Clade assignment data contains duplicate sequence. Stopping assignment process.")
 
-    joined = df_metadata.join(df_assignments, left_on="Accession", right_on="seq", how="left")
     joined = joined.with_columns(
         sequence_released_since=pl.lit(config.sequence_released_since_date),
         reference_tree_date=pl.lit(config.reference_tree_date),
         sequence_retrieved_datetime=pl.lit(config.run_time),
     )
-    num_sequences = joined.shape[0]
-
-    # ?? what is the difference between "clade" and "clade_nextstrain" ??
-    missing_clade_assignments = joined.filter(pl.col("clade_nextstrain").is_null())
-    num_missing_assignments = missing_clade_assignments.shape[0]
+    num_sequences = missing_check["len"].item()
+    num_missing_assignments = missing_check["num_missing"].item()
 
     if num_missing_assignments == 0:
         logger.info("Sequence metadata merged with clade assignments", num_sequences=num_sequences)
@@ -117,7 +404,7 @@ def merge_metadata(config: Config) -> pl.DataFrame:
         logger.warning(
             "Some sequences are missing clade assignments",
             num_sequences=num_sequences,
-            missing_clade_assignments=missing_clade_assignments,
+            num_missing_assignments=num_missing_assignments,
         )
 
     # TBD: include only the columns we need
@@ -128,6 +415,19 @@ def merge_metadata(config: Config) -> pl.DataFrame:
     return joined
 
 
+@time_function
+def write_merged_metadata(merged_data: pl.LazyFrame, output_file: Path) -> Path:
+    """Stream merged sequence metadata and clade assignments to a .csv or .parquet file."""
+    output_file = Path(output_file)
+    with _atomic_open(output_file) as f:
+        if output_file.suffix == ".parquet":
+            merged_data.sink_parquet(f.name)
+        else:
+            merged_data.sink_csv(f.name)
+
+    return output_file
+
+
 @click.command()
 @click.option(
     "--sequence-released-since-date",
@@ -151,27 +451,198 @@ def merge_metadata(config: Config) -> pl.DataFrame:
     default=None,
     help="Directory where the clade assignment file will be saved. Default: [home dir]/covid_variant/",
 )
-def main(sequence_released_since_date: datetime.date, reference_tree_date: datetime.date, data_dir: str | None):
+@click.option(
+    "--nextclade-shards",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Split the sequences into this many shards and assign clades to them with concurrent Nextclade processes",
+)
+@click.option(
+    "--nextclade-jobs",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of threads per Nextclade process when sharding. Default: number of CPUs / number of shards",
+)
+@click.option(
+    "--min-sequence-length",
+    type=click.IntRange(min=0),
+    default=None,
+    help="Don't assign clades to sequences with fewer bases than this. Default: no minimum",
+)
+@click.option(
+    "--max-ambiguous-fraction",
+    type=click.FloatRange(min=0, max=1),
+    default=None,
+    help="Don't assign clades to sequences with a larger fraction of ambiguous bases (e.g., N) than this. "
+    "Default: no maximum",
+)
+@click.option(
+    "--output-format",
+    type=click.Choice(["csv", "parquet"]),
+    default="csv",
+    show_default=True,
+    help="Format of the clade assignment file",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Skip pipeline stages that completed in an earlier run with the same --data-dir and unchanged inputs",
+)
+@click.option(
+    "--max-heavy-stages",
+    type=click.IntRange(min=1),
+    default=2,
+    show_default=True,
+    help="Maximum number of subprocess-bound stages (dataformat, Nextclade) that run at the same time",
+)
+@click.option(
+    "--prometheus-file",
+    default=None,
+    help="Also write the run's per-stage resource metrics to this file, in the Prometheus text format",
+)
+@click.option(
+    "--trace-python-memory",
+    is_flag=True,
+    default=False,
+    help="Record the peak Python heap allocations of each stage (slows down the run)",
+)
+def main(
+    sequence_released_since_date: datetime.date,
+    reference_tree_date: datetime.date,
+    data_dir: str | None,
+    nextclade_shards: int,
+    nextclade_jobs: int | None,
+    min_sequence_length: int | None,
+    max_ambiguous_fraction: float | None,
+    output_format: str,
+    resume: bool,
+    max_heavy_stages: int,
+    prometheus_file: str | None,
+    trace_python_memory: bool,
+):
     # TODO: do we need additional date validations (e.g., no future dates)?
 
     config = setup_config(data_dir, sequence_released_since_date, reference_tree_date)
+    config.sequence_min_length = min_sequence_length
+    config.sequence_max_ambiguous_fraction = max_ambiguous_fraction
     logger.info("Starting pipeline", reference_tree_date=reference_tree_date, run_time=config.run_time)
 
     os.makedirs(config.data_path, exist_ok=True)
-    nextclade_dataset_path = get_nextclade_dataset(config.reference_tree_date, config.data_path)
-    get_sequences(config)
-    get_sequence_metadata(config)
-    assign_clades(config, nextclade_dataset_path)
-    merged_data = merge_metadata(config)
-    merged_data.write_csv(config.assignment_file)
+    labels = {"run_time": config.run_time, "reference_tree_date": config.reference_tree_date}
+    # the run report is written even if a stage fails, so it shows where the run stopped
+    with MetricsCollector(labels=labels, trace_python_memory=trace_python_memory) as metrics:
+        try:
+            with span("main"):
+                assignment_file = _run_pipeline(
+                    config, nextclade_shards, nextclade_jobs, output_format, resume, max_heavy_stages
+                )
+        finally:
+            metrics.write_json(config.run_metrics_file)
+            if prometheus_file:
+                metrics.write_prometheus(prometheus_file)
+            logger.info("Run metrics saved", run_metrics_file=config.run_metrics_file)
 
     logger.info(
         "Sequence clade assignments are ready",
-        assignment_file=config.assignment_file,
+        assignment_file=assignment_file,
         run_time=config.run_time,
         reference_tree_date=config.reference_tree_date,
     )
 
 
+def _run_pipeline(
+    config: Config,
+    nextclade_shards: int,
+    nextclade_jobs: int | None,
+    output_format: str,
+    resume: bool = False,
+    max_heavy_stages: int = 2,
+) -> Path:
+    """
+    Run the stages of the clade assignment pipeline and return the location of the assignment file.
+
+    Stages run as soon as the stages they depend on are complete: the Nextclade
+    dataset is retrieved while the sequences download, and the sequence
+    metadata is extracted (dataformat) while the sequences are deduplicated
+    and filtered and clades are assigned (Nextclade).
+    No more than max_heavy_stages of those subprocess-bound stages run at once.
+
+    Each completed stage records a manifest in config.pipeline_manifest_path.
+    When resume is True, stages whose outputs are intact and whose inputs
+    haven't changed since they last completed are skipped.
+    """
+    pipeline = Pipeline(config.pipeline_manifest_path, resume=resume)
+    assignment_file = config.assignment_file
+    if output_format == "parquet":
+        assignment_file = assignment_file.with_suffix(".parquet")
+
+    def get_dataset_path() -> Path:
+        return pipeline.results["nextclade_dataset"]
+
+    stages = [
+        Stage(
+            "nextclade_dataset",
+            lambda: get_nextclade_dataset(config.reference_tree_date, config.data_path),
+            params={"reference_tree_date": config.reference_tree_date},
+        ),
+        Stage(
+            "sequences",
+            lambda: get_sequences(config),
+            outputs=[
+                config.data_path / config.ncbi_package_name,
+                config.ncbi_sequence_file,
+                config.ncbi_sequence_report_file,
+            ],
+            params={
+                "sequence_released_since_date": config.sequence_released_since_date,
+                "ncbi_base_url": config.ncbi_base_url,
+            },
+        ),
+        Stage(
+            "sequence_metadata",
+            lambda: get_sequence_metadata(config),
+            inputs=[config.ncbi_sequence_report_file],
+            outputs=[config.ncbi_sequence_metadata_file],
+            heavy=True,
+        ),
+        Stage(
+            "sequence_qc",
+            lambda: prefilter_sequences(config),
+            inputs=[config.ncbi_sequence_file],
+            outputs=[config.sequence_qc_file],
+            params={
+                "sequence_min_length": config.sequence_min_length,
+                "sequence_max_ambiguous_fraction": config.sequence_max_ambiguous_fraction,
+            },
+        ),
+        Stage(
+            "clade_assignments",
+            lambda: assign_clades(
+                config,
+                get_dataset_path(),
+                shards=nextclade_shards,
+                jobs=nextclade_jobs,
+                dataset_tag=_get_nextclade_dataset_tag(get_dataset_path()),
+                sequence_qc_file=config.sequence_qc_file,
+            ),
+            inputs=lambda: [config.ncbi_sequence_file, config.sequence_qc_file, get_dataset_path()],
+            outputs=[config.assignment_no_metadata_file],
+            depends_on=["nextclade_dataset", "sequences", "sequence_qc"],
+            heavy=True,
+        ),
+        Stage(
+            "merged_metadata",
+            lambda: write_merged_metadata(merge_metadata(config), assignment_file),
+            inputs=[config.ncbi_sequence_metadata_file, config.assignment_no_metadata_file],
+            params={"assignment_file": str(assignment_file), "assignment_file_columns": config.assignment_file_columns},
+        ),
+    ]
+    pipeline.run_all(stages, max_heavy=max_heavy_stages)
+
+    return assignment_file
+
+
 if __name__ == "__main__":
     main()
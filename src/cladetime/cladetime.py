@@ -2,16 +2,17 @@
 
 import warnings
 from datetime import datetime, timezone
-
-import polars as pl
-import structlog
+from typing import TYPE_CHECKING
 
 from cladetime.exceptions import CladeTimeFutureDateWarning, CladeTimeInvalidDateError, CladeTimeInvalidURLError
-from cladetime.util.config import Config
-from cladetime.util.reference import _get_s3_object_url
-from cladetime.util.sequence import _get_ncov_metadata, get_covid_genome_metadata
 
-logger = structlog.get_logger()
+# CladeTime is designed to be cheap to import and instantiate: S3 lookups and the
+# heavier data libraries are deferred until an attribute that needs them is accessed
+if TYPE_CHECKING:
+    import httpx
+    import polars as pl
+
+    from cladetime.util.config import Config
 
 
 class CladeTime:
@@ -42,6 +43,9 @@ class CladeTime:
     url_sequence_metadata : str
         S3 URL to the Nextstrain Sars-CoV-2 sequence metadata file
         (zst-compressed tsv) that was available at the sequence_as_of.
+
+    The S3 URLs are looked up the first time one of them is accessed
+    and memoized on the instance.
     """
 
     def __init__(self, sequence_as_of=None, tree_as_of=None):
@@ -63,23 +67,8 @@ class CladeTime:
         self._config = self._get_config()
         self.sequence_as_of = sequence_as_of
         self.tree_as_of = tree_as_of
-        self._ncov_metadata = {}
-        self._sequence_metadata = pl.LazyFrame()
-
-        self.url_sequence = _get_s3_object_url(
-            self._config.nextstrain_ncov_bucket, self._config.nextstrain_genome_sequence_key, self.sequence_as_of
-        )[1]
-        self.url_sequence_metadata = _get_s3_object_url(
-            self._config.nextstrain_ncov_bucket, self._config.nextstrain_genome_metadata_key, self.sequence_as_of
-        )[1]
-
-        # Nextstrain began publishing ncov pipeline metadata starting on 2024-08-01
-        if self.sequence_as_of >= self._config.nextstrain_min_ncov_metadata_date:
-            self.url_ncov_metadata = _get_s3_object_url(
-                self._config.nextstrain_ncov_bucket, self._config.nextstrain_ncov_metadata_key, self.sequence_as_of
-            )[1]
-        else:
-            self.url_ncov_metadata = None
+        # ncov metadata memoized by url_ncov_metadata
+        self._ncov_metadata: dict[str, dict] = {}
 
     @property
     def sequence_as_of(self) -> datetime:
@@ -98,6 +87,8 @@ class CladeTime:
             sequence_as_of = utc_now
 
         self._sequence_as_of = sequence_as_of
+        # URLs are resolved on first access (see _resolve_urls)
+        self._urls: dict[str, str | None] = {}
 
     @property
     def tree_as_of(self) -> datetime:
@@ -121,46 +112,351 @@ class CladeTime:
         self._tree_as_of = tree_as_of
 
     @property
-    def ncov_metadata(self):
-        return self._ncov_metadata
+    def url_sequence(self) -> str | None:
+        """S3 URL to the Nextstrain Sars-CoV-2 sequence file available at sequence_as_of."""
+        return self._get_url("sequence")
+
+    @url_sequence.setter
+    def url_sequence(self, url: str | None) -> None:
+        self._urls["sequence"] = url
+
+    @property
+    def url_sequence_metadata(self) -> str | None:
+        """S3 URL to the Nextstrain Sars-CoV-2 sequence metadata file available at sequence_as_of."""
+        return self._get_url("sequence_metadata")
+
+    @url_sequence_metadata.setter
+    def url_sequence_metadata(self, url: str | None) -> None:
+        self._urls["sequence_metadata"] = url
 
-    @ncov_metadata.getter
+    @property
+    def url_ncov_metadata(self) -> str | None:
+        """S3 URL to the Nextstrain ncov metadata file available at sequence_as_of."""
+        return self._get_url("ncov_metadata")
+
+    @url_ncov_metadata.setter
+    def url_ncov_metadata(self, url: str | None) -> None:
+        self._urls["ncov_metadata"] = url
+
+    @property
     def ncov_metadata(self) -> dict:
-        """Get the ncov_metadata attribute."""
-        if self.url_ncov_metadata:
-            metadata = _get_ncov_metadata(self.url_ncov_metadata)
-            return metadata
-        else:
-            metadata = {}
-        return metadata
+        """Get the ncov_metadata attribute.
+
+        Metadata is retrieved once per url_ncov_metadata and memoized on the instance
+        (and cached on disk by S3 version ID, unless persistent caching is disabled).
+        """
+        from cladetime.util.sequence import _get_ncov_metadata
+
+        url = self.url_ncov_metadata
+        if not url:
+            return {}
+
+        if url not in self._ncov_metadata:
+            metadata = _get_ncov_metadata(url, cache_path=self._config.cache_path)
+            # don't memoize failed requests
+            if not metadata:
+                return metadata
+            self._ncov_metadata[url] = metadata
+
+        return dict(self._ncov_metadata[url])
+
+    async def ncov_metadata_async(self, client: "httpx.AsyncClient | None" = None) -> dict:
+        """
+        Return the ncov_metadata attribute, retrieving it without blocking the event loop.
+
+        Parameters
+        ----------
+        client : httpx.AsyncClient | None
+            Client used for the request (see cladetime.util.aio.get_async_client).
+            Defaults to a client that's closed when the request completes.
+        """
+        from cladetime.util.aio import _get_ncov_metadata_async, get_async_client
+
+        if "ncov_metadata" not in self._urls:
+            await self._resolve_urls_async(client)
+        url = self.url_ncov_metadata
+        if not url:
+            return {}
+
+        if url not in self._ncov_metadata:
+            if client is None:
+                async with get_async_client() as client:
+                    metadata = await _get_ncov_metadata_async(client, url, cache_path=self._config.cache_path)
+            else:
+                metadata = await _get_ncov_metadata_async(client, url, cache_path=self._config.cache_path)
+            # don't memoize failed requests
+            if not metadata:
+                return metadata
+            self._ncov_metadata[url] = metadata
+
+        return dict(self._ncov_metadata[url])
 
     @property
-    def sequence_metadata(self):
-        return self._sequence_metadata
-
-    @sequence_metadata.getter
-    def sequence_metadata(self) -> pl.LazyFrame:
-        """Get the sequence_metadata attribute."""
-        if self.url_sequence_metadata:
-            sequence_metadata = get_covid_genome_metadata(metadata_url=self.url_sequence_metadata)
-            return sequence_metadata
-        else:
+    def sequence_metadata(self) -> "pl.LazyFrame":
+        """Get the sequence_metadata attribute.
+
+        The metadata file is downloaded once per S3 object version into the local
+        object cache, and the cached file is scanned (unless persistent caching is
+        disabled, in which case the remote file is scanned directly). Set
+        CLADETIME_METADATA_PARQUET to materialize each cached file as Parquet
+        and scan the Parquet copy instead.
+        """
+        from cladetime.util.sequence import _get_versioned_covid_genome_metadata
+
+        if not self.url_sequence_metadata:
             raise CladeTimeInvalidURLError("CladeTime is missing url_sequence_metadata")
 
+        return _get_versioned_covid_genome_metadata(
+            self.url_sequence_metadata,
+            self._config.cache_path,
+            max_bytes=self._config.cache_max_bytes,
+            use_parquet=self._config.metadata_parquet,
+        )
+
+    @property
+    def clade_counts(self) -> "pl.LazyFrame":
+        """Get the clade_counts attribute.
+
+        Clade counts by location, date and clade (as returned by get_clade_counts)
+        for the sequence metadata available at sequence_as_of. Counts are kept in a
+        clade count cube per metadata version (unless persistent caching is
+        disabled), so each version's metadata is only counted once.
+        """
+        from cladetime.util.counts import _get_version_clade_counts
+
+        if not self.url_sequence_metadata:
+            raise CladeTimeInvalidURLError("CladeTime is missing url_sequence_metadata")
+
+        return _get_version_clade_counts(
+            self.url_sequence_metadata,
+            self._config.cache_path,
+            max_bytes=self._config.cache_max_bytes,
+            use_parquet=self._config.metadata_parquet,
+        ).lazy()
+
+    def clade_proportions(self, clades: list[str] | None = None, other_label: str = "other") -> "pl.LazyFrame":
+        """
+        Return weekly clade proportions by location for the sequence metadata available at sequence_as_of.
+
+        Parameters
+        ----------
+        clades : list[str] | None
+            If provided, clades that aren't in this list are combined into a
+            single clade named other_label.
+        other_label : str
+            Name of the combined clade when clades is provided.
+
+        Returns
+        -------
+        polars.LazyFrame
+            location, week, clade, count, and proportion (see
+            cladetime.util.sequence.get_clade_proportions). Results are cached by
+            metadata version unless persistent caching is disabled.
+        """
+        from cladetime.util.counts import _get_version_clade_proportions
+
+        if not self.url_sequence_metadata:
+            raise CladeTimeInvalidURLError("CladeTime is missing url_sequence_metadata")
+
+        return _get_version_clade_proportions(
+            self.url_sequence_metadata,
+            self._config.cache_path,
+            max_bytes=self._config.cache_max_bytes,
+            clades=clades,
+            other_label=other_label,
+            use_parquet=self._config.metadata_parquet,
+        )
+
+    @classmethod
+    def series(cls, start, end=None, freq: str = "1w", processes: int | None = None) -> "pl.DataFrame":
+        """
+        Return clade counts for a series of sequence_as_of dates.
+
+        Sequence metadata versions for every date are resolved from a single S3
+        version listing, and clade counts are computed once per distinct
+        metadata version (dates that resolve to the same version share counts).
+
+        Parameters
+        ----------
+        start : datetime | str
+            First sequence_as_of date in the series (see CladeTime.sequence_as_of).
+        end : datetime | str | None, default = now()
+            Last possible sequence_as_of date in the series.
+        freq : str, default = "1w"
+            Interval between sequence_as_of dates, as a Polars duration string
+            (e.g., "1d", "1w", "1mo").
+        processes : int | None
+            If greater than 1, compute clade counts for that many metadata
+            versions at a time in a process pool.
+
+        Returns
+        -------
+        polars.DataFrame
+            Clade counts by location, date and clade (as returned by
+            get_clade_counts) for each date in the series, with a
+            sequence_as_of column that identifies the date.
+        """
+        import polars as pl
+
+        from cladetime.util.counts import _get_version_clade_counts
+        from cladetime.util.reference import _get_s3_object_url_series
+
+        first = cls(sequence_as_of=start)
+        last = cls(sequence_as_of=end)
+        config = first._config
+        dates = pl.datetime_range(
+            first.sequence_as_of, last.sequence_as_of, interval=freq, time_zone="UTC", eager=True
+        ).to_list()
+
+        urls = [
+            url
+            for _, url in _get_s3_object_url_series(
+                config.nextstrain_ncov_bucket, config.nextstrain_genome_metadata_key, dates, config.cache_path
+            )
+        ]
+        distinct_urls = list(dict.fromkeys(urls))
+        count_args = [
+            (url, config.cache_path, config.cache_max_bytes, config.metadata_parquet) for url in distinct_urls
+        ]
+
+        if processes is not None and processes > 1 and len(distinct_urls) > 1:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            # Polars is multithreaded, so worker processes are spawned rather than forked
+            with ProcessPoolExecutor(
+                max_workers=min(processes, len(distinct_urls)), mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                counts = dict(zip(distinct_urls, executor.map(_get_version_clade_counts, *zip(*count_args))))
+        else:
+            counts = {args[0]: _get_version_clade_counts(*args) for args in count_args}
+
+        return pl.concat(
+            [
+                counts[url].with_columns(sequence_as_of=pl.lit(date, dtype=pl.Datetime("us", "UTC")))
+                for date, url in zip(dates, urls)
+            ]
+        )
+
+    @classmethod
+    async def create(
+        cls, sequence_as_of=None, tree_as_of=None, client: "httpx.AsyncClient | None" = None
+    ) -> "CladeTime":
+        """
+        Return a CladeTime instance whose S3 URLs are resolved without blocking the event loop.
+
+        The URLs are resolved with S3's REST API on an async HTTP client, so
+        many instances can be created concurrently from one event loop (for
+        example, with asyncio.gather or CladeTime.create_many). Concurrent
+        lookups share one S3 version listing per object.
+
+        Parameters
+        ----------
+        sequence_as_of : datetime | str | None, default = now()
+            See CladeTime.
+        tree_as_of : datetime | str | None, default = sequence_as_of
+            See CladeTime.
+        client : httpx.AsyncClient | None
+            Client used for S3 requests (see cladetime.util.aio.get_async_client).
+            Defaults to a client that's closed once the URLs are resolved.
+        """
+        clade_time = cls(sequence_as_of=sequence_as_of, tree_as_of=tree_as_of)
+        await clade_time._resolve_urls_async(client)
+        return clade_time
+
+    @classmethod
+    async def create_many(
+        cls, sequence_as_of_dates: list, tree_as_of=None, client: "httpx.AsyncClient | None" = None
+    ) -> list["CladeTime"]:
+        """
+        Return CladeTime instances for many sequence_as_of dates, resolved concurrently.
+
+        Parameters
+        ----------
+        sequence_as_of_dates : list[datetime | str]
+            sequence_as_of date of each instance.
+        tree_as_of : datetime | str | None, default = sequence_as_of
+            tree_as_of date of every instance.
+        client : httpx.AsyncClient | None
+            Client shared by the lookups. Defaults to a client that's closed
+            once the URLs are resolved.
+        """
+        import asyncio
+
+        from cladetime.util.aio import get_async_client
+
+        if client is None:
+            async with get_async_client() as client:
+                return await cls.create_many(sequence_as_of_dates, tree_as_of, client)
+
+        return list(await asyncio.gather(*[cls.create(date, tree_as_of, client) for date in sequence_as_of_dates]))
+
     def __repr__(self):
         return f"CladeTime(sequence_as_of={self.sequence_as_of}, tree_as_of={self.tree_as_of})"
 
     def __str__(self):
         return f"Work with Nextstrain Sara-CoV-2 sequences as of {self.sequence_as_of} and Nextclade clade assignments as of {self.tree_as_of}"
 
-    def _get_config(self) -> Config:
+    def _get_config(self) -> "Config":
         """Return a config object."""
+        from cladetime.util.config import Config
+
         # dates passed to Config don't actually do anything in this case
         # (config needs a refactor)
         config = Config(datetime.now(), datetime.now())
 
         return config
 
+    def _get_url(self, name: str) -> str | None:
+        """Return a Nextstrain object URL, resolving the URLs for sequence_as_of if needed."""
+        if name not in self._urls:
+            self._resolve_urls()
+        return self._urls[name]
+
+    def _resolve_urls(self) -> None:
+        """Resolve the S3 URLs of the Nextstrain objects that were available at sequence_as_of.
+
+        All of the URLs are resolved from a single batch lookup and memoized on the
+        instance. URLs that were explicitly set are left as-is.
+        """
+        from cladetime.util.reference import _get_s3_object_urls
+
+        object_keys = self._get_object_keys()
+        urls = _get_s3_object_urls(self._config.nextstrain_ncov_bucket, list(object_keys.values()), self.sequence_as_of)
+        self._set_urls(object_keys, urls)
+
+    async def _resolve_urls_async(self, client: "httpx.AsyncClient | None" = None) -> None:
+        """Async counterpart of _resolve_urls."""
+        from cladetime.util.aio import _get_s3_object_urls_async, get_async_client
+
+        object_keys = self._get_object_keys()
+        bucket, keys = self._config.nextstrain_ncov_bucket, list(object_keys.values())
+        if client is None:
+            async with get_async_client() as client:
+                urls = await _get_s3_object_urls_async(client, bucket, keys, self.sequence_as_of)
+        else:
+            urls = await _get_s3_object_urls_async(client, bucket, keys, self.sequence_as_of)
+        self._set_urls(object_keys, urls)
+
+    def _get_object_keys(self) -> dict[str, str]:
+        """Return the S3 keys of the Nextstrain objects that were published at sequence_as_of, by URL name."""
+        object_keys = {
+            "sequence": self._config.nextstrain_genome_sequence_key,
+            "sequence_metadata": self._config.nextstrain_genome_metadata_key,
+        }
+        # Nextstrain began publishing ncov pipeline metadata starting on 2024-08-01
+        if self.sequence_as_of >= self._config.nextstrain_min_ncov_metadata_date:
+            object_keys["ncov_metadata"] = self._config.nextstrain_ncov_metadata_key
+        return object_keys
+
+    def _set_urls(self, object_keys: dict[str, str], urls: dict[str, tuple[str, str]]) -> None:
+        """Memoize resolved URLs, leaving URLs that were explicitly set as-is."""
+        for name in ["sequence", "sequence_metadata", "ncov_metadata"]:
+            if name in object_keys:
+                self._urls.setdefault(name, urls[object_keys[name]][1])
+            else:
+                self._urls.setdefault(name, None)
+
     def _validate_as_of_date(self, as_of: str) -> datetime:
         """Validate an as_of date used to instantiate CladeTime.
 
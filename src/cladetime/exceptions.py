@@ -15,3 +15,11 @@ class CladeTimeInvalidURLError(Error):
 
 class CladeTimeFutureDateWarning(Warning):
     """Raised when CladeTime as_of date is in the future."""
+
+
+class NextcladeRunError(Error):
+    """Raised when the Nextclade CLI fails to assign clades."""
+
+
+class DownloadError(Error):
+    """Raised when a file can't be downloaded as requested."""
@@ -1,18 +1,23 @@
 """Get a list of SARS-CoV-2 clades."""
 
 import os
-from datetime import timedelta
+from datetime import datetime, timezone
+from typing import Iterable
 
 import polars as pl
 import structlog
 from cloudpathlib import AnyPath
 
-from cladetime.util.config import Config
+from cladetime.util.config import Config, _get_cache_max_bytes, _get_cache_path
+from cladetime.util.counts import _get_version_clade_counts
+from cladetime.util.download import DOWNLOAD_MAX_WORKERS
+from cladetime.util.reference import _get_s3_object_url
 from cladetime.util.sequence import (
     download_covid_genome_metadata,
     filter_covid_genome_metadata,
     get_clade_counts,
     get_covid_genome_metadata,
+    materialize_covid_genome_metadata,
 )
 from cladetime.util.session import _get_session
 from cladetime.util.timing import time_function
@@ -24,43 +29,114 @@ logger = structlog.get_logger()
 def get_clades(clade_counts: pl.LazyFrame, threshold: float, threshold_weeks: int, max_clades: int) -> list[str]:
     """Get a list of clades to forecast based."""
 
-    # based on the data's most recent date, get the week start three weeks ago (not including this week)
-    max_day = clade_counts.select(pl.max("date")).collect().item()
-    threshold_sundays_ago = max_day - timedelta(days=max_day.weekday() + 7 * (threshold_weeks))
+    clades = _select_clades(_get_weekly_proportions(clade_counts, threshold_weeks), threshold, max_clades).collect()
 
-    # sum over weeks, combine states, and limit to just the past 3 weeks (not including current week)
-    lf = (
-        clade_counts.filter(pl.col("date") >= threshold_sundays_ago)
+    return clades.get_column("clade").to_list()
+
+
+@time_function
+def get_clades_sweep(clade_counts: pl.LazyFrame, parameters: Iterable[tuple[float, int, int]]) -> pl.DataFrame:
+    """
+    Get the list of clades to forecast for each of several parameter combinations.
+
+    clade_counts is scanned once: it's summarized to daily counts by clade over
+    the longest threshold_weeks, weekly proportions are computed once per
+    distinct threshold_weeks, and every combination is evaluated against them.
+
+    Parameters
+    ----------
+    clade_counts : polars.LazyFrame
+        Clade counts by date and location, summarized from Nextstrain metadata
+    parameters : Iterable[tuple[float, int, int]]
+        (threshold, threshold_weeks, max_clades) combinations, as used by get_clades.
+
+    Returns
+    -------
+    polars.DataFrame
+        One row per parameter combination: threshold, threshold_weeks,
+        max_clades, and clades (the list get_clades would return).
+    """
+    parameters = list(parameters)
+    if not parameters:
+        return pl.DataFrame(
+            schema={
+                "threshold": pl.Float64,
+                "threshold_weeks": pl.Int64,
+                "max_clades": pl.Int64,
+                "clades": pl.List(pl.String),
+            }
+        )
+
+    max_weeks = max(threshold_weeks for _, threshold_weeks, _ in parameters)
+    daily_counts = (
+        clade_counts.filter(pl.col("date") >= _get_threshold_start(max_weeks))
+        .group_by("date", "clade")
+        .agg(pl.col("count").sum())
+        .collect()
+        .lazy()
+    )
+    weekly_proportions = {
+        threshold_weeks: _get_weekly_proportions(daily_counts, threshold_weeks).collect().lazy()
+        for threshold_weeks in {threshold_weeks for _, threshold_weeks, _ in parameters}
+    }
+
+    selections = pl.collect_all(
+        [
+            _select_clades(weekly_proportions[threshold_weeks], threshold, max_clades)
+            for threshold, threshold_weeks, max_clades in parameters
+        ]
+    )
+
+    return pl.DataFrame(
+        {
+            "threshold": [float(threshold) for threshold, _, _ in parameters],
+            "threshold_weeks": [threshold_weeks for _, threshold_weeks, _ in parameters],
+            "max_clades": [max_clades for _, _, max_clades in parameters],
+            "clades": [selection.get_column("clade").to_list() for selection in selections],
+        },
+        schema_overrides={"clades": pl.List(pl.String)},
+    )
+
+
+def _get_threshold_start(threshold_weeks: int) -> pl.Expr:
+    """Return an expression for the Monday threshold_weeks weeks before the start of the data's most recent week."""
+    max_day = pl.col("date").max()
+    # Polars weekdays run from 1 (Monday) to 7 (Sunday)
+    return max_day - pl.duration(days=max_day.dt.weekday() - 1 + 7 * threshold_weeks)
+
+
+def _get_weekly_proportions(clade_counts: pl.LazyFrame, threshold_weeks: int) -> pl.LazyFrame:
+    """Return each clade's weekly count and proportion of all sequences over the past threshold_weeks."""
+
+    # sum over weeks, combine states, and limit to just the past threshold_weeks (not including current week)
+    weekly_counts = (
+        clade_counts.filter(pl.col("date") >= _get_threshold_start(threshold_weeks))
         .sort("date")
         .group_by_dynamic("date", every="1w", start_by="sunday", group_by="clade")
         .agg(pl.col("count").sum())
     )
 
-    # create a separate frame with the total counts per week
-    total_counts = lf.group_by("date").agg(pl.col("count").sum().alias("total_count"))
+    # divide by the total counts per week
+    return weekly_counts.with_columns((pl.col("count") / pl.col("count").sum().over("date")).alias("proportion"))
 
-    # join with count data to add a total counts per day column
-    prop_dat = lf.join(total_counts, on="date").with_columns(
-        (pl.col("count") / pl.col("total_count")).alias("proportion")
-    )
 
-    # retrieve list of variants which have crossed the threshold over the past threshold_weeks
-    high_prev_variants = prop_dat.filter(pl.col("proportion") > threshold).select("clade").unique().collect()
+def _select_clades(weekly_proportions: pl.LazyFrame, threshold: float, max_clades: int) -> pl.LazyFrame:
+    """Return the clades selected from weekly proportions by get_clades, in order."""
+
+    # variants which have crossed the threshold over the past threshold_weeks
+    clades = weekly_proportions.group_by("clade").agg(
+        pl.col("count").sum(), (pl.col("proportion") > threshold).any().alias("high_prevalence")
+    )
 
     # if more than the specified number of clades cross the threshold,
     # take the clades with the largest counts over the past threshold_weeks
     # (if there's a tie, take the first clade alphabetically)
-    if len(high_prev_variants) > max_clades:
-        high_prev_variants = (
-            prop_dat.group_by("clade")
-            .agg(pl.col("count").sum())
-            .sort("count", "clade", descending=[True, False])
-            .collect()
-        )
-
-    variants = high_prev_variants.get_column("clade").to_list()[:max_clades]
-
-    return variants
+    return (
+        clades.filter((pl.col("high_prevalence").sum() > max_clades) | pl.col("high_prevalence"))
+        .sort("count", "clade", descending=[True, False])
+        .head(max_clades)
+        .select("clade")
+    )
 
 
 # FIXME: provide ability to instantiate Config for the get_clade_list function and get the data_path from there
@@ -71,6 +147,7 @@ def main(
     threshold: float = 0.01,
     threshold_weeks: int = 3,
     max_clades: int = 9,
+    use_parquet: bool = False,
 ) -> list[str]:
     """
     Determine list of clades to model
@@ -83,7 +160,9 @@ def main(
     genome_metdata_key : str
         S3 key of the Nextstrain genome metadata file.
     data_dir : AnyPath
-        Path to the location where the genome metadata file is saved after download.
+        Path to the location where the genome metadata file is saved after
+        download (only used when persistent caching is disabled; otherwise clade
+        counts are read from the clade count cube of the current metadata version).
     clade_counts : polars.LazyFrame
         Clade counts by date and location, summarized from Nextstrain metadata
     threshold : float
@@ -93,22 +172,32 @@ def main(
         The number of weeks that we look back to identify clades.
     max_clades : int
         The maximum number of clades to include in the list.
+    use_parquet : bool
+        Materialize the downloaded genome metadata as Parquet before querying it.
 
     Returns
     -------
     list of strings
     """
-    os.makedirs(data_dir, exist_ok=True)
-    session = _get_session()
-    genome_metadata_path = download_covid_genome_metadata(
-        session,
-        genome_metadata_bucket,
-        genome_metadata_key,
-        data_dir,
-    )
-    lf_metadata = get_covid_genome_metadata(genome_metadata_path)
-    lf_metadata_filtered = filter_covid_genome_metadata(lf_metadata)
-    counts = get_clade_counts(lf_metadata_filtered)
+    cache_path = _get_cache_path()
+    if cache_path:
+        # each metadata version is counted once, and later runs read its clade count cube
+        _, metadata_url = _get_s3_object_url(genome_metadata_bucket, genome_metadata_key, datetime.now(timezone.utc))
+        counts = _get_version_clade_counts(metadata_url, cache_path, _get_cache_max_bytes(), use_parquet).lazy()
+    else:
+        os.makedirs(data_dir, exist_ok=True)
+        session = _get_session(pool_maxsize=DOWNLOAD_MAX_WORKERS)
+        genome_metadata_path = download_covid_genome_metadata(
+            session,
+            genome_metadata_bucket,
+            genome_metadata_key,
+            data_dir,
+        )
+        if use_parquet:
+            materialize_covid_genome_metadata(genome_metadata_path)
+        lf_metadata = get_covid_genome_metadata(genome_metadata_path, use_parquet=use_parquet)
+        lf_metadata_filtered = filter_covid_genome_metadata(lf_metadata)
+        counts = get_clade_counts(lf_metadata_filtered)
     clade_list = get_clades(counts, threshold, threshold_weeks, max_clades)
 
     return clade_list
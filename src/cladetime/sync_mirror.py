@@ -0,0 +1,65 @@
+"""Copy new versions of Nextstrain's SARS-CoV-2 files into a local mirror."""
+
+import datetime
+from pathlib import Path
+
+import rich_click as click
+import structlog
+
+from cladetime.util.config import Config, _get_mirror_path
+from cladetime.util.storage import LocalMirrorBackend, sync_mirror
+
+logger = structlog.get_logger()
+
+# Nextstrain objects that are mirrored by default. The sequence file (several GB per daily version) is only
+# mirrored when it's requested with --key.
+DEFAULT_MIRROR_KEYS = [
+    Config.nextstrain_genome_metadata_key,
+    Config.nextstrain_ncov_metadata_key,
+]
+
+
+@click.command()
+@click.option(
+    "--mirror-dir",
+    default=None,
+    help="Root directory of the mirror. Default: the CLADETIME_MIRROR_DIR environment variable",
+)
+@click.option(
+    "--key",
+    "keys",
+    multiple=True,
+    help="Key of an object to mirror (can be repeated). Default: Nextstrain's SARS-CoV-2 metadata and ncov "
+    "pipeline metadata files",
+)
+@click.option(
+    "--since",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    default=None,
+    help="Skip versions published before this date (YYYY-MM-DD format). Default: mirror every version",
+)
+@click.option(
+    "--bucket",
+    default=Config.nextstrain_ncov_bucket,
+    show_default=True,
+    help="S3 bucket to mirror",
+)
+def main(mirror_dir: str | None, keys: tuple[str, ...], since: datetime.datetime | None, bucket: str):
+    mirror_path = Path(mirror_dir) if mirror_dir else _get_mirror_path()
+    if mirror_path is None:
+        raise click.UsageError("Specify --mirror-dir or set the CLADETIME_MIRROR_DIR environment variable")
+    if since is not None:
+        since = since.replace(tzinfo=datetime.timezone.utc)
+
+    mirror = LocalMirrorBackend(mirror_path, bucket)
+    added = sync_mirror(mirror, list(keys) or DEFAULT_MIRROR_KEYS, since=since)
+
+    logger.info(
+        "Mirror is up to date",
+        mirror=str(mirror_path),
+        new_versions=sum(len(version_ids) for version_ids in added.values()),
+    )
+
+
+if __name__ == "__main__":
+    main()
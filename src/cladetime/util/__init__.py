@@ -0,0 +1,4 @@
+from cladetime import setup_logging
+
+# Logging is configured when the first module that can emit log messages is loaded
+setup_logging()
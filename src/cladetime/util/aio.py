@@ -0,0 +1,319 @@
+"""Asyncio counterparts of cladetime's Nextstrain lookups and downloads."""
+
+import asyncio
+import json
+import shutil
+import weakref
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Tuple
+
+import httpx
+import structlog
+
+from cladetime.util.cache import _atomic_open
+from cladetime.util.config import _get_cache_path
+from cladetime.util.download import DOWNLOAD_CHUNK_SIZE
+from cladetime.util.reference import (
+    _get_version_index_path,
+    _read_version_index,
+    _select_s3_object_version,
+    _write_version_index,
+)
+from cladetime.util.sequence import _get_ncov_metadata_cache_file
+from cladetime.util.storage import _get_local_object, get_storage_backend
+from cladetime.util.timing import record_bytes_downloaded
+
+logger = structlog.get_logger()
+
+# Maximum number of concurrent connections of an async client (requests beyond it wait for a free connection)
+AIO_MAX_CONNECTIONS = 16
+# Number of times a request is retried when the connection to the server fails
+AIO_CONNECT_RETRIES = 3
+# Namespace of the XML returned by the S3 REST API
+S3_XML_NAMESPACE = {"s3": "http://s3.amazonaws.com/doc/2006-03-01/"}
+
+# Locks that serialize version listings of the same S3 object, per event loop, so that
+# concurrent lookups of one object (e.g., many as-of dates) share a single listing
+_version_locks: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_async_client(max_connections: int = AIO_MAX_CONNECTIONS, **client_kwargs) -> httpx.AsyncClient:
+    """
+    Return an async HTTP client for cladetime's Nextstrain requests.
+
+    The coroutines in this module run their file I/O (version indexes, cache
+    and mirror files, and downloads) in worker threads, so it doesn't block
+    the event loop.
+
+    Share one client across concurrent lookups (``async with get_async_client()
+    as client:``): its connection pool bounds the number of requests in flight
+    at max_connections, and further requests wait for a free connection.
+
+    Parameters
+    ----------
+    max_connections : int
+        Maximum number of concurrent connections.
+    client_kwargs
+        Additional arguments passed to httpx.AsyncClient (e.g., transport).
+    """
+    client_kwargs.setdefault("transport", httpx.AsyncHTTPTransport(retries=AIO_CONNECT_RETRIES))
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        # requests that are queued for a connection aren't timed out
+        timeout=httpx.Timeout(60, pool=None),
+        follow_redirects=True,
+        **client_kwargs,
+    )
+
+
+async def _get_s3_object_url_async(
+    client: httpx.AsyncClient, bucket_name: str, object_key: str, date: datetime, cache_path: Path | None = None
+) -> Tuple[str, str]:
+    """Async counterpart of reference._get_s3_object_url."""
+    return (await _get_s3_object_urls_async(client, bucket_name, [object_key], date, cache_path))[object_key]
+
+
+async def _get_s3_object_urls_async(
+    client: httpx.AsyncClient,
+    bucket_name: str,
+    object_keys: list[str],
+    date: datetime,
+    cache_path: Path | None = None,
+) -> dict[str, Tuple[str, str]]:
+    """
+    For a versioned, public S3 bucket and a set of object keys, return the
+    (version ID, version URL) of each object as it existed at a specific date (UTC).
+
+    Async counterpart of reference._get_s3_object_urls: versions come from
+    the same local version indexes, and keys that need a refresh are listed
+    concurrently with S3's REST API.
+    """
+    versions = await _get_s3_object_versions_async(client, bucket_name, object_keys, date, cache_path)
+
+    urls = {}
+    for object_key in object_keys:
+        selected_version = _select_s3_object_version(versions[object_key], date)
+        if selected_version is None:
+            raise ValueError(f"No version of {object_key} found before {date}")
+        version_id = selected_version[1]
+        version_url = f"https://{bucket_name}.s3.amazonaws.com/{object_key}?versionId={version_id}"
+        urls[object_key] = (version_id, version_url)
+
+    return urls
+
+
+async def _get_s3_object_versions_async(
+    client: httpx.AsyncClient,
+    bucket_name: str,
+    object_keys: list[str],
+    date: datetime,
+    cache_path: Path | None = None,
+) -> dict[str, list[tuple[datetime, str]]]:
+    """Async counterpart of reference._get_s3_object_versions."""
+    backend = get_storage_backend(bucket_name)
+    if backend.is_local:
+        # a local mirror's manifests are read directly, as they are by the synchronous lookup
+        listed_versions = await asyncio.to_thread(
+            backend.list_versions, {object_key: None for object_key in object_keys}
+        )
+        versions = {object_key: sorted(listed_versions[object_key]) for object_key in object_keys}
+        unmirrored_keys = [object_key for object_key in object_keys if not versions[object_key]]
+        if unmirrored_keys:
+            logger.info("listing objects that aren't in the mirror from S3", keys=unmirrored_keys)
+            versions.update(
+                await _get_indexed_object_versions_async(client, bucket_name, unmirrored_keys, date, cache_path)
+            )
+        return versions
+
+    return await _get_indexed_object_versions_async(client, bucket_name, object_keys, date, cache_path)
+
+
+async def _get_indexed_object_versions_async(
+    client: httpx.AsyncClient, bucket_name: str, object_keys: list[str], date: datetime, cache_path: Path | None
+) -> dict[str, list[tuple[datetime, str]]]:
+    """Async counterpart of reference._get_indexed_object_versions (for S3)."""
+    if cache_path is None:
+        cache_path = _get_cache_path()
+
+    key_versions = await asyncio.gather(
+        *[_get_s3_key_versions_async(client, bucket_name, object_key, date, cache_path) for object_key in object_keys]
+    )
+    return dict(zip(object_keys, key_versions))
+
+
+async def _get_s3_key_versions_async(
+    client: httpx.AsyncClient, bucket_name: str, object_key: str, date: datetime, cache_path: Path | None
+) -> list[tuple[datetime, str]]:
+    """Return the known versions of one S3 object, listing versions newer than its version index if needed."""
+    if not cache_path:
+        return sorted(await _list_s3_key_versions_async(client, bucket_name, object_key, None))
+
+    index_path = _get_version_index_path(bucket_name, object_key, cache_path)
+    # a lookup that waits here finds the versions listed by the lookup ahead of it in the index
+    async with _get_version_lock(bucket_name, object_key):
+        versions = await asyncio.to_thread(_read_version_index, index_path)
+        # versions are immutable, so an index can answer as-of questions up to its newest entry
+        if versions and date <= versions[-1][0]:
+            return versions
+
+        newer_than = versions[-1][0] if versions else None
+        known_ids = {version_id for _, version_id in versions}
+        listed_versions = await _list_s3_key_versions_async(client, bucket_name, object_key, newer_than)
+        new_versions = [version for version in listed_versions if version[1] not in known_ids]
+        if new_versions:
+            versions = sorted(versions + new_versions)
+            await asyncio.to_thread(_write_version_index, index_path, bucket_name, object_key, versions)
+            logger.info("S3 version index updated", key=object_key, new_versions=len(new_versions))
+
+    return versions
+
+
+def _get_version_lock(bucket_name: str, object_key: str) -> asyncio.Lock:
+    """Return the running event loop's lock for version listings of an S3 object."""
+    loop_locks = _version_locks.setdefault(asyncio.get_running_loop(), {})
+    return loop_locks.setdefault((bucket_name, object_key), asyncio.Lock())
+
+
+async def _list_s3_key_versions_async(
+    client: httpx.AsyncClient, bucket_name: str, object_key: str, newer_than: datetime | None, max_keys: int = 1000
+) -> list[tuple[datetime, str]]:
+    """
+    List (LastModified, VersionId) pairs of a single S3 object with S3's REST API (ListObjectVersions).
+
+    S3 returns an object's versions newest first, so when newer_than is provided
+    paging stops at the first page that reaches versions older than that date.
+    """
+    url = f"https://{bucket_name}.s3.amazonaws.com/"
+    params = {"versions": "", "prefix": object_key, "max-keys": str(max_keys)}
+
+    versions = []
+    while True:
+        response = await client.get(url, params=params)
+        try:
+            response.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            logger.error("S3 version listing failed", bucket=bucket_name, key=object_key, error=e)
+            raise
+
+        page = ET.fromstring(response.content)
+        reached_known_versions = False
+        for version in page.iterfind("s3:Version", S3_XML_NAMESPACE):
+            last_modified = version.findtext("s3:LastModified", namespaces=S3_XML_NAMESPACE)
+            version_id = version.findtext("s3:VersionId", namespaces=S3_XML_NAMESPACE)
+            if (
+                version.findtext("s3:Key", namespaces=S3_XML_NAMESPACE) != object_key
+                or not last_modified
+                or not version_id
+            ):
+                continue
+            version_date = _parse_s3_datetime(last_modified)
+            if newer_than is not None and version_date < newer_than:
+                reached_known_versions = True
+                continue
+            versions.append((version_date, version_id))
+
+        if reached_known_versions or page.findtext("s3:IsTruncated", namespaces=S3_XML_NAMESPACE) != "true":
+            break
+        params["key-marker"] = page.findtext("s3:NextKeyMarker", default="", namespaces=S3_XML_NAMESPACE)
+        params["version-id-marker"] = page.findtext("s3:NextVersionIdMarker", default="", namespaces=S3_XML_NAMESPACE)
+
+    return versions
+
+
+def _parse_s3_datetime(value: str) -> datetime:
+    """Parse an S3 XML timestamp (e.g., 2024-08-01T01:26:29.000Z) as a UTC datetime."""
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone(timezone.utc)
+
+
+async def _get_ncov_metadata_async(
+    client: httpx.AsyncClient, url_ncov_metadata: str, cache_path: Path | None = None
+) -> dict:
+    """
+    Return metadata emitted by the Nextstrain ncov pipeline.
+
+    Async counterpart of sequence._get_ncov_metadata, sharing its on-disk cache.
+    """
+    cache_file = _get_ncov_metadata_cache_file(url_ncov_metadata, cache_path) if cache_path else None
+    if cache_file and cache_file.exists():
+        try:
+            return await asyncio.to_thread(_read_json, cache_file)
+        except ValueError as e:
+            logger.warning("Ignoring unreadable ncov metadata cache file", cache_file=str(cache_file), error=e)
+
+    if (local_file := _get_local_object(url_ncov_metadata)) is not None:
+        return await asyncio.to_thread(_read_json, local_file)
+
+    response = await client.get(url_ncov_metadata)
+    if not response.is_success:
+        logger.warn(
+            "Failed to retrieve ncov metadata",
+            status_code=response.status_code,
+            response_text=response.text,
+            request=str(response.request.url),
+        )
+        return {}
+
+    metadata = response.json()
+    if cache_file:
+        await asyncio.to_thread(_write_json, cache_file, metadata)
+
+    return metadata
+
+
+def _read_json(path: Path) -> dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _write_json(path: Path, data: dict):
+    with _atomic_open(path, "w") as f:
+        json.dump(data, f)
+
+
+async def download_covid_genome_metadata_async(
+    client: httpx.AsyncClient,
+    bucket: str,
+    key: str,
+    data_path: Path,
+    as_of: str | None = None,
+    use_existing: bool = False,
+) -> Path:
+    """
+    Download GenBank genome metadata from Nextstrain as it existed on a date.
+
+    Async counterpart of sequence.download_covid_genome_metadata. The file is
+    streamed to disk, so several downloads can share one event loop.
+    """
+    if as_of is None:
+        as_of_datetime = datetime.now().replace(tzinfo=timezone.utc)
+    else:
+        as_of_datetime = datetime.strptime(as_of, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+
+    (s3_version, s3_url) = await _get_s3_object_url_async(client, bucket, key, as_of_datetime)
+    filename = Path(data_path) / f"{as_of_datetime.date().strftime('%Y-%m-%d')}-{Path(key).name}"
+
+    if use_existing and filename.exists():
+        logger.info("using existing genome metadata file", metadata_file=str(filename))
+        return filename
+
+    if (local_file := _get_local_object(s3_url)) is not None:
+        logger.info("copying genome metadata from mirror", source=str(local_file), destination=str(filename))
+        await asyncio.to_thread(_copy_file, local_file, filename)
+        return filename
+
+    logger.info("starting genome metadata download", source=s3_url, destination=str(filename))
+    with _atomic_open(filename) as f:
+        async with client.stream("GET", s3_url, headers={"Accept-Encoding": "identity"}) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                await asyncio.to_thread(f.write, chunk)
+        record_bytes_downloaded(f.tell())
+
+    return filename
+
+
+def _copy_file(source: Path, destination: Path):
+    with open(source, "rb") as f_source, _atomic_open(destination) as f:
+        shutil.copyfileobj(f_source, f)
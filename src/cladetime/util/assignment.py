@@ -0,0 +1,126 @@
+"""Functions for reusing clade assignments across pipeline runs."""
+
+from pathlib import Path
+
+import polars as pl
+import structlog
+
+from cladetime.util.cache import _atomic_open
+
+logger = structlog.get_logger()
+
+# Nextclade output columns that identify a record in a particular run (rather than describe its sequence)
+NEXTCLADE_RECORD_COLUMNS = ["index", "seqName"]
+
+
+def _get_assignment_store_path(cache_path: Path, dataset_tag: str) -> Path:
+    """Return the location of the clade assignment store for a Nextclade dataset version."""
+    return Path(cache_path) / "clade_assignments" / f"{dataset_tag}.parquet"
+
+
+def get_stored_assignments(sequence_hashes: pl.DataFrame, store_path: Path) -> tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    Split a run's sequences into those with a stored clade assignment and those without.
+
+    Parameters
+    ----------
+    sequence_hashes : polars.DataFrame
+        The run's sequences (record, seqName and seq_hash), from the sequence QC
+        table written by cladetime.assign_clades.prefilter_sequences (see
+        cladetime.util.fasta.profile_fasta).
+    store_path : Path
+        Location of the clade assignment store for the Nextclade dataset used by the run.
+
+    Returns
+    -------
+    tuple[polars.DataFrame, polars.DataFrame]
+        The stored assignments of previously-seen sequences (with the run's
+        record and seqName), and the sequence_hashes rows of unseen sequences.
+    """
+    if not Path(store_path).exists():
+        return pl.DataFrame(), sequence_hashes
+
+    store = pl.scan_parquet(store_path)
+    stored = sequence_hashes.lazy().join(store, on="seq_hash", how="inner").collect()
+    unseen = sequence_hashes.lazy().join(store.select("seq_hash"), on="seq_hash", how="anti").collect()
+
+    logger.info("found stored clade assignments", num_stored=len(stored), num_unseen=len(unseen))
+
+    return stored, unseen
+
+
+def update_assignment_store(store_path: Path, assignments: pl.DataFrame, sequence_hashes: pl.DataFrame) -> int:
+    """
+    Add new Nextclade assignments to a clade assignment store.
+
+    Parameters
+    ----------
+    store_path : Path
+        Location of the clade assignment store.
+    assignments : polars.DataFrame
+        Nextclade output (read as strings) for the sequences in sequence_hashes.
+    sequence_hashes : polars.DataFrame
+        seqName and seq_hash of the assigned sequences.
+
+    Returns
+    -------
+    int
+        Number of sequences added to the store.
+    """
+    new_rows = (
+        assignments.join(sequence_hashes.select("seqName", "seq_hash"), on="seqName", how="inner")
+        .drop(NEXTCLADE_RECORD_COLUMNS, strict=False)
+        .unique("seq_hash", keep="first", maintain_order=True)
+    )
+    if Path(store_path).exists():
+        store = pl.read_parquet(store_path)
+        new_rows = new_rows.join(store.select("seq_hash"), on="seq_hash", how="anti")
+        updated_store = pl.concat([store, new_rows], how="diagonal")
+    else:
+        updated_store = new_rows
+
+    if len(new_rows) > 0:
+        with _atomic_open(store_path) as f:
+            updated_store.write_parquet(f.name)
+        logger.info("updated clade assignment store", store=str(store_path), num_added=len(new_rows))
+
+    return len(new_rows)
+
+
+def combine_assignments(stored: pl.DataFrame, new: pl.DataFrame, sequence_hashes: pl.DataFrame) -> pl.DataFrame:
+    """
+    Combine stored and newly-computed assignments into a single Nextclade-style output table.
+
+    Assignments are matched to the run's sequences by seq_hash, so a sequence
+    that appears under several accessions only needs to be assigned once:
+    every record with an assigned sequence gets a row, with its own seqName.
+    Rows are returned in the order of the run's sequence file, with the index
+    column renumbered to match it (as a single Nextclade run would have done).
+
+    Parameters
+    ----------
+    stored : polars.DataFrame
+        Stored assignments, as returned by get_stored_assignments.
+    new : polars.DataFrame
+        Nextclade output (read as strings) for sequences in sequence_hashes.
+    sequence_hashes : polars.DataFrame
+        The run's sequences (record, seqName and seq_hash), from the sequence
+        QC table written by cladetime.assign_clades.prefilter_sequences (see
+        cladetime.util.fasta.profile_fasta). Sequences without an assignment
+        are left out of the returned table.
+    """
+    records = sequence_hashes.select("record", "seqName", "seq_hash")
+    frames = []
+    if len(stored.columns) > 0:
+        frames.append(stored.drop("record", "seqName", strict=False))
+    if len(new.columns) > 0:
+        new_hashes = records.select("seqName", "seq_hash").unique("seqName", keep="first", maintain_order=True)
+        frames.append(new.join(new_hashes, on="seqName", how="inner").drop(NEXTCLADE_RECORD_COLUMNS, strict=False))
+    if not frames:
+        return pl.DataFrame(schema={"index": pl.UInt32, "seqName": pl.String})
+
+    assignments = pl.concat(frames, how="diagonal").unique("seq_hash", keep="first", maintain_order=True)
+    combined = records.join(assignments, on="seq_hash", how="inner").sort("record").rename({"record": "index"})
+    assignment_columns = [col for frame in frames for col in frame.columns if col != "seq_hash"]
+
+    return combined.select(NEXTCLADE_RECORD_COLUMNS + list(dict.fromkeys(assignment_columns)))
@@ -0,0 +1,132 @@
+"""Helpers for cladetime's persistent, on-disk caches."""
+
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterator
+from urllib.parse import parse_qs, urlparse
+
+import structlog
+from requests import Session
+
+from cladetime.util.session import _get_session
+
+logger = structlog.get_logger()
+
+
+@contextmanager
+def _atomic_open(path: Path, mode: str = "wb") -> Iterator[IO]:
+    """
+    Open a temporary file that atomically replaces path when the block exits.
+
+    The temporary file is created in path's directory (so the final rename
+    never crosses filesystems) and is removed if the block raises, so readers
+    never see a partially-written file.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    f = tempfile.NamedTemporaryFile(mode, dir=path.parent, prefix=f".{path.name}.", suffix=".tmp", delete=False)
+    try:
+        with f:
+            yield f
+        os.replace(f.name, path)
+    except BaseException:
+        Path(f.name).unlink(missing_ok=True)
+        raise
+
+
+def _get_object_cache_file(cache_path: Path, object_key: str, version_id: str) -> Path:
+    """
+    Return the location of a versioned S3 object in the local object cache.
+
+    Objects are addressed by a hash of their (key, versionId), which identifies
+    immutable content. The file keeps the key's suffixes (e.g., .tsv.zst) so
+    readers can infer its format.
+    """
+    digest = hashlib.sha256(f"{object_key}?versionId={version_id}".encode()).hexdigest()
+    suffix = "".join(Path(object_key).suffixes)
+    return Path(cache_path) / "objects" / digest[:2] / f"{digest}{suffix}"
+
+
+def _parse_s3_object_url(url: str) -> tuple[str, str] | None:
+    """Return the (key, versionId) referenced by an S3 object URL, or None if it isn't versioned."""
+    parsed_url = urlparse(url)
+    version_id = parse_qs(parsed_url.query).get("versionId")
+    if not version_id:
+        return None
+    return parsed_url.path.lstrip("/"), version_id[0]
+
+
+def _get_cached_s3_object(
+    url: str, cache_path: Path, max_bytes: int | None = None, session: Session | None = None
+) -> Path | None:
+    """
+    Return a local copy of a versioned S3 object, downloading it into the object cache on a miss.
+
+    Returns None if url doesn't reference a specific object version (only
+    immutable objects are cached). Cache hits are marked as recently used, and
+    after a download the least recently used objects are evicted until the
+    cache is no larger than max_bytes. Objects in a local mirror (see
+    util.storage) are read from the mirror rather than copied into the cache.
+    """
+    object_version = _parse_s3_object_url(url)
+    if object_version is None:
+        return None
+
+    # storage.py builds on this module, so it's imported here rather than at module level
+    from cladetime.util.storage import _get_local_object
+
+    if (local_file := _get_local_object(url)) is not None:
+        logger.info("using mirrored object", url=url, local_file=str(local_file))
+        return local_file
+
+    cache_file = _get_object_cache_file(cache_path, *object_version)
+    if cache_file.exists():
+        # file modification times track recency of use
+        os.utime(cache_file)
+        logger.info("using cached object", url=url, cache_file=str(cache_file))
+        return cache_file
+
+    # download.py writes through _atomic_open, so it's imported here rather than at module level
+    from cladetime.util.download import DOWNLOAD_MAX_WORKERS, ranged_download
+
+    if not session:
+        session = _get_session(pool_maxsize=DOWNLOAD_MAX_WORKERS)
+
+    logger.info("caching object", url=url, cache_file=str(cache_file))
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    ranged_download(session, url, cache_file)
+
+    if max_bytes is not None:
+        _evict_lru(cache_file.parent.parent, max_bytes, keep=cache_file)
+
+    return cache_file
+
+
+def _evict_lru(cache_dir: Path, max_bytes: int, keep: Path | None = None) -> list[Path]:
+    """Remove the least recently used files in cache_dir until it holds at most max_bytes."""
+    files = []
+    for path in Path(cache_dir).rglob("*"):
+        # skip in-progress writes from _atomic_open
+        if not path.is_file() or path.name.endswith(".tmp"):
+            continue
+        stat = path.stat()
+        files.append((stat.st_mtime, stat.st_size, path))
+
+    total_bytes = sum(size for _, size, _ in files)
+    evicted = []
+    for _, size, path in sorted(files, key=lambda file: file[0]):
+        if total_bytes <= max_bytes:
+            break
+        if keep is not None and path == keep:
+            continue
+        path.unlink(missing_ok=True)
+        total_bytes -= size
+        evicted.append(path)
+
+    if evicted:
+        logger.info("evicted cached objects", num_files=len(evicted), cache_bytes=total_bytes)
+
+    return evicted
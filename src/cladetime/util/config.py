@@ -1,25 +1,30 @@
 # mypy: ignore-errors
 
+import os
 from dataclasses import InitVar, asdict, dataclass, field
 from datetime import datetime, timezone
+from pathlib import Path
 from pprint import pprint
+from typing import TYPE_CHECKING
 
-from cloudpathlib import AnyPath
+if TYPE_CHECKING:
+    from cloudpathlib import AnyPath
 
 
 @dataclass
 class Config:
     sequence_released_date: InitVar[datetime]
     tree_as_of_date: InitVar[datetime]
-    data_path_root: InitVar[str] = AnyPath(".")
+    data_path_root: InitVar[str] = "."
     sequence_released_since_date: str = None
     reference_tree_date: str = None
     now = datetime.now()
     run_time = now.strftime("%Y%m%dT%H%M%S")
     ncbi_base_url: str = "https://api.ncbi.nlm.nih.gov/datasets/v2alpha/virus/genome/download"
     ncbi_package_name: str = "ncbi.zip"
-    ncbi_sequence_file: AnyPath = None
-    ncbi_sequence_metadata_file: AnyPath = None
+    ncbi_sequence_file: "AnyPath" = None
+    ncbi_sequence_metadata_file: "AnyPath" = None
+    ncbi_sequence_report_file: "AnyPath" = None
 
     # Nextstrain sequence data files in their current format is published back to 2023-05-01
     nextstrain_min_seq_date: datetime = datetime(2023, 5, 1).replace(tzinfo=timezone.utc)
@@ -32,11 +37,25 @@ class Config:
     nextstrain_genome_metadata_key = "files/ncov/open/metadata.tsv.zst"
     nextstrain_genome_sequence_key = "files/ncov/open/sequences.fasta.zst"
     nextclade_base_url: str = "https://nextstrain.org/nextclade/sars-cov-2"
-    reference_tree_file: AnyPath = None
-    root_sequence_file: AnyPath = None
-    assignment_no_metadata_file: AnyPath = None
-    assignment_file: AnyPath = None
+    reference_tree_file: "AnyPath" = None
+    root_sequence_file: "AnyPath" = None
+    assignment_no_metadata_file: "AnyPath" = None
+    assignment_file: "AnyPath" = None
     assignment_file_columns: list[str] = field(default_factory=list)
+    run_metrics_file: "AnyPath" = None
+    # directory of the manifests of completed pipeline stages (used to resume a run)
+    pipeline_manifest_path: "AnyPath" = None
+    # root directory of persistent caches (None disables them)
+    cache_path: Path = None
+    # size cap of the local cache of Nextstrain data files (least recently used files are evicted first)
+    cache_max_bytes: int = None
+    # keep a Parquet copy of each cached metadata file and scan it instead of the compressed TSV
+    metadata_parquet: bool = False
+    # per-sequence hashes and QC metrics, used to deduplicate and filter sequences before they're sent to Nextclade
+    sequence_qc_file: "AnyPath" = None
+    # sequences with fewer bases, or a larger fraction of ambiguous bases, aren't assigned clades (None: no limit)
+    sequence_min_length: int = None
+    sequence_max_ambiguous_fraction: float = None
 
     def __post_init__(
         self,
@@ -45,12 +64,16 @@ class Config:
         data_path_root: str | None,
     ):
         if data_path_root:
-            self.data_path = AnyPath(data_path_root)
+            self.data_path = _get_path(data_path_root)
         else:
-            self.data_path = AnyPath(".").home() / "covid_variant" / self.run_time
+            self.data_path = Path.home() / "covid_variant" / self.run_time
+        self.cache_path = _get_cache_path()
+        self.cache_max_bytes = _get_cache_max_bytes()
+        self.metadata_parquet = _get_metadata_parquet()
         self.sequence_released_since_date = sequence_released_date.strftime("%Y-%m-%d")
         self.reference_tree_date = tree_as_of_date.strftime("%Y-%m-%d")
         self.ncbi_sequence_file = self.data_path / "ncbi_dataset/data/genomic.fna"
+        self.ncbi_sequence_report_file = self.data_path / "ncbi_dataset/data/data_report.jsonl"
         self.ncbi_sequence_metadata_file = self.data_path / f"{self.sequence_released_since_date}-metadata.tsv"
         self.reference_tree_file = self.data_path / f"{self.reference_tree_date}_tree.json"
         self.root_sequence_file = self.data_path / f"{self.reference_tree_date}_root_sequence.fasta"
@@ -58,6 +81,9 @@ class Config:
             self.data_path / f"{self.sequence_released_since_date}_clade_assignments_no_metadata.csv"
         )
         self.assignment_file = self.data_path / f"{self.sequence_released_since_date}_clade_assignments.csv"
+        self.run_metrics_file = self.data_path / f"{self.run_time}_run_metrics.json"
+        self.pipeline_manifest_path = self.data_path / "pipeline_manifests"
+        self.sequence_qc_file = self.data_path / f"{self.sequence_released_since_date}_sequence_qc.parquet"
         self.assignment_file_columns = [
             "Accession",
             "Source database",
@@ -75,3 +101,67 @@ class Config:
 
     def __repr__(self):
         return str(pprint(asdict(self)))
+
+
+def _get_cache_path() -> Path | None:
+    """Return the root directory of cladetime's persistent, cross-run caches.
+
+    Defaults to ~/.cache/cladetime and can be overridden with the
+    CLADETIME_CACHE_DIR environment variable. Setting CLADETIME_NO_CACHE
+    disables the persistent caches (returns None).
+    """
+    if os.environ.get("CLADETIME_NO_CACHE"):
+        return None
+    cache_dir = os.environ.get("CLADETIME_CACHE_DIR")
+    if cache_dir:
+        return Path(cache_dir)
+    return Path.home() / ".cache" / "cladetime"
+
+
+def _get_mirror_path() -> Path | None:
+    """Return the root directory of a local mirror of Nextstrain's S3 objects (see util.storage).
+
+    Set with the CLADETIME_MIRROR_DIR environment variable (e.g., a shared NFS
+    directory). Returns None when no mirror is configured.
+    """
+    mirror_dir = os.environ.get("CLADETIME_MIRROR_DIR")
+    if mirror_dir:
+        return Path(mirror_dir)
+    return None
+
+
+def _get_metadata_parquet() -> bool:
+    """Return True if cached Nextstrain metadata files should be materialized as Parquet.
+
+    Off by default (the cached .tsv.zst file is scanned directly); set the
+    CLADETIME_METADATA_PARQUET environment variable to turn it on.
+    """
+    return bool(os.environ.get("CLADETIME_METADATA_PARQUET"))
+
+
+def _get_cache_max_bytes() -> int:
+    """Return the size cap (in bytes) of cladetime's cache of Nextstrain data files.
+
+    Defaults to 10 GiB and can be overridden with the CLADETIME_CACHE_MAX_BYTES
+    environment variable.
+    """
+    max_bytes = os.environ.get("CLADETIME_CACHE_MAX_BYTES")
+    if max_bytes:
+        return int(max_bytes)
+    return 10 * 1024**3
+
+
+def _get_path(path: str | Path) -> "AnyPath":
+    """Return a path object for a local path or a cloud URI.
+
+    cloudpathlib (which loads the cloud provider SDKs) is only imported for
+    cloud URIs; local paths are returned as pathlib.Path, which is what
+    AnyPath would return for them.
+    """
+    if not isinstance(path, str):
+        return path
+    if "://" in path:
+        from cloudpathlib import AnyPath
+
+        return AnyPath(path)
+    return Path(path)
@@ -0,0 +1,124 @@
+"""Functions for storing and reading clade counts for each version of the genome metadata."""
+
+import hashlib
+import json
+from pathlib import Path
+
+import polars as pl
+import structlog
+
+from cladetime.util.cache import _atomic_open, _parse_s3_object_url
+from cladetime.util.sequence import (
+    _get_versioned_covid_genome_metadata,
+    filter_covid_genome_metadata,
+    get_clade_counts,
+    get_clade_proportions,
+)
+
+logger = structlog.get_logger()
+
+# Dimensions of the clade count cube
+CLADE_COUNT_DIMENSIONS = ["location", "date", "clade"]
+
+
+def get_clade_count_cube(metadata: pl.LazyFrame, cube_path: Path, version: str) -> Path:
+    """
+    Return a Parquet file of clade counts for a version of the genome metadata, creating it if needed.
+
+    Clade counts are stored in cube_path as a count "cube" per metadata version
+    (counts by location, date and clade, as returned by get_clade_counts).
+    Nextstrain publishes each version of the metadata as a full snapshot, so a
+    version's cube is a full count of its sequences: once it exists, the
+    version's metadata doesn't need to be read again.
+
+    Each cube is written atomically to its own file, so several processes can
+    add versions to the same cube_path at once.
+
+    Parameters
+    ----------
+    metadata : polars.LazyFrame
+        Genome metadata (as returned by get_covid_genome_metadata).
+    cube_path : Path
+        Directory of the clade count cubes for one metadata file.
+    version : str
+        Version of the metadata (for example, its S3 version ID).
+
+    Returns
+    -------
+    Path
+        Location of the version's clade count cube.
+    """
+    cube_file = Path(cube_path) / f"{version}.parquet"
+    if cube_file.exists():
+        return cube_file
+
+    logger.info("creating clade count cube", version=version)
+    # counted with get_clade_counts, so cached and uncached counts have the same schema
+    counts = get_clade_counts(filter_covid_genome_metadata(metadata)).sort(CLADE_COUNT_DIMENSIONS)
+    with _atomic_open(cube_file) as f:
+        counts.collect(streaming=True).write_parquet(f.name)
+
+    return cube_file
+
+
+def _get_clade_count_cube_path(cache_path: Path, object_key: str) -> Path:
+    """Return the directory of the clade count cubes for a Nextstrain metadata file."""
+    return Path(cache_path) / "clade_counts" / object_key
+
+
+def _get_version_clade_counts(
+    metadata_url: str, cache_path: Path | None = None, max_bytes: int | None = None, use_parquet: bool = False
+) -> pl.DataFrame:
+    """
+    Return clade counts by location and date for one version of a Nextstrain metadata file.
+
+    When cache_path is provided, counts of versioned metadata files are read from
+    (and added to) the clade count cube under cache_path. use_parquet is passed
+    to _get_versioned_covid_genome_metadata when the metadata has to be read.
+    """
+    object_version = _parse_s3_object_url(metadata_url)
+    if not cache_path or object_version is None:
+        metadata = _get_versioned_covid_genome_metadata(metadata_url, cache_path, max_bytes, use_parquet)
+        return get_clade_counts(filter_covid_genome_metadata(metadata)).collect()
+
+    object_key, version_id = object_version
+    cube_path = _get_clade_count_cube_path(cache_path, object_key)
+    cube_file = cube_path / f"{version_id}.parquet"
+    # the metadata file is only needed if this version hasn't been counted yet
+    if not cube_file.exists():
+        metadata = _get_versioned_covid_genome_metadata(metadata_url, cache_path, max_bytes, use_parquet)
+        cube_file = get_clade_count_cube(metadata, cube_path, version_id)
+
+    return pl.read_parquet(cube_file)
+
+
+def _get_version_clade_proportions(
+    metadata_url: str,
+    cache_path: Path | None = None,
+    max_bytes: int | None = None,
+    clades: list[str] | None = None,
+    other_label: str = "other",
+    use_parquet: bool = False,
+) -> pl.LazyFrame:
+    """
+    Return weekly clade proportions (see get_clade_proportions) for one version of a Nextstrain metadata file.
+
+    When cache_path is provided, the proportions of versioned metadata files are
+    stored alongside the version's clade count cube, keyed by clades and other_label.
+    """
+    object_version = _parse_s3_object_url(metadata_url)
+    if not cache_path or object_version is None:
+        counts = _get_version_clade_counts(metadata_url, cache_path, max_bytes, use_parquet).lazy()
+        return get_clade_proportions(counts, clades, other_label)
+
+    object_key, version_id = object_version
+    grouping = json.dumps([sorted(clades) if clades is not None else None, other_label])
+    digest = hashlib.sha256(grouping.encode()).hexdigest()[:16]
+    proportions_file = _get_clade_count_cube_path(cache_path, object_key) / f"{version_id}.proportions.{digest}.parquet"
+
+    if not proportions_file.exists():
+        counts = _get_version_clade_counts(metadata_url, cache_path, max_bytes, use_parquet).lazy()
+        with _atomic_open(proportions_file) as f:
+            get_clade_proportions(counts, clades, other_label).collect().write_parquet(f.name)
+
+    return pl.scan_parquet(proportions_file)
@@ -0,0 +1,253 @@
+"""Functions for downloading large files."""
+
+import hashlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import structlog
+from requests import Session
+from requests.exceptions import ChunkedEncodingError, ConnectionError, HTTPError
+
+from cladetime.exceptions import DownloadError
+from cladetime.util.cache import _atomic_open
+from cladetime.util.timing import record_bytes_downloaded
+
+if TYPE_CHECKING:
+    from cladetime.util.storage import StorageBackend
+
+logger = structlog.get_logger()
+
+# Size of the chunks read from a streamed response
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Number of times an interrupted download is resumed before it fails
+DOWNLOAD_MAX_RESUMES = 5
+# Size of each ranged request made by ranged_download
+DOWNLOAD_PART_SIZE = 32 * 1024 * 1024
+# Number of concurrent ranged requests made by ranged_download
+DOWNLOAD_MAX_WORKERS = 8
+# Number of times a failed part of a ranged download is retried
+DOWNLOAD_PART_RETRIES = 3
+
+
+def stream_download(
+    session: Session,
+    url: str,
+    filename: Path,
+    method: str = "GET",
+    max_resumes: int = DOWNLOAD_MAX_RESUMES,
+    **request_kwargs,
+) -> str:
+    """
+    Stream an HTTP response body to a file and return its sha256 checksum.
+
+    The body is written to a temporary file alongside filename in fixed-size
+    chunks (so memory use doesn't depend on the size of the download), and
+    the temporary file is renamed to filename once the download completes.
+
+    If the connection drops mid-download, the request is re-sent with a Range
+    header that asks for the rest of the body. When the server doesn't honor
+    the Range header, the download starts over.
+
+    Parameters
+    ----------
+    session : Session
+        Requests session used for the download.
+    url : str
+        URL to download.
+    filename : Path
+        Location of the downloaded file.
+    method : str
+        HTTP method of the request (e.g., "POST" for API endpoints that
+        return a file).
+    max_resumes : int
+        Number of times an interrupted download is resumed before the
+        download fails.
+    request_kwargs
+        Additional arguments passed to session.request (e.g., data, timeout).
+
+    Returns
+    -------
+    str
+        sha256 checksum of the downloaded file.
+
+    Raises
+    ------
+    requests.exceptions.HTTPError
+        If the server returns an error status.
+    """
+    # byte offsets only line up across requests if the body isn't content-encoded
+    headers = {"Accept-Encoding": "identity", **(request_kwargs.pop("headers", None) or {})}
+    checksum = hashlib.sha256()
+    resumes = 0
+    # bytes received by this call (rather than the size of the file, which a restart truncates)
+    bytes_downloaded = 0
+
+    with _atomic_open(filename) as f:
+        while True:
+            offset = f.tell()
+            request_headers = dict(headers, Range=f"bytes={offset}-") if offset else headers
+            try:
+                send = getattr(session, method.lower())
+                with send(url, headers=request_headers, stream=True, **request_kwargs) as response:
+                    response.raise_for_status()
+                    if offset and _get_range_start(response) != offset:
+                        logger.warning("Server did not resume download, restarting", url=url, offset=offset)
+                        f.seek(0)
+                        f.truncate()
+                        checksum = hashlib.sha256()
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        checksum.update(chunk)
+                        bytes_downloaded += len(chunk)
+                break
+            except (ChunkedEncodingError, ConnectionError) as e:
+                if resumes >= max_resumes:
+                    raise
+                resumes += 1
+                logger.warning("Download interrupted, resuming", url=url, offset=f.tell(), attempt=resumes, error=e)
+        record_bytes_downloaded(bytes_downloaded)
+
+    logger.info("Download complete", url=url, filename=str(filename), sha256=checksum.hexdigest(), resumes=resumes)
+
+    return checksum.hexdigest()
+
+
+def _get_range_start(response) -> int | None:
+    """Return the first byte of a partial (206) response, or None if the response isn't partial."""
+    if response.status_code != 206:
+        return None
+    match = re.match(r"bytes (\d+)-", response.headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else None
+
+
+def ranged_download(
+    session: Session,
+    url: str,
+    filename: Path,
+    part_size: int = DOWNLOAD_PART_SIZE,
+    max_workers: int = DOWNLOAD_MAX_WORKERS,
+    retries: int = DOWNLOAD_PART_RETRIES,
+) -> Path:
+    """
+    Download a file as concurrent HTTP Range requests.
+
+    The file is split into parts of part_size bytes, which are requested in
+    parallel and written directly to their offsets in a temporary file that
+    is renamed to filename once every part is complete. A part that fails is
+    retried on its own (resuming from the last byte it received).
+
+    Servers that don't advertise byte-range support (Accept-Ranges: bytes), and
+    files no larger than one part, are downloaded with a single streamed GET
+    (see stream_download).
+
+    When url is a version of an S3 object that the bucket's storage backend
+    holds locally (see util.storage), the parts are read from the backend with
+    read_range instead, without any HTTP requests.
+
+    Parameters
+    ----------
+    session : Session
+        Requests session used for the download. The part requests share its
+        connection pool, which should hold at least max_workers connections.
+    url : str
+        URL to download.
+    filename : Path
+        Location of the downloaded file.
+    part_size : int
+        Size (in bytes) of each ranged request.
+    max_workers : int
+        Maximum number of concurrent part requests.
+    retries : int
+        Number of times a failed part is retried before the download fails.
+
+    Returns
+    -------
+    Path
+        Location of the downloaded file.
+    """
+    # storage.py builds on the object cache, which downloads with this module, so it's imported here
+    from cladetime.util.storage import _get_object_backend
+
+    object_backend = _get_object_backend(url)
+    if object_backend is not None and object_backend[0].is_local:
+        backend, object_key, version_id = object_backend
+        if (local_file := backend.get_path(object_key, version_id)) is not None:
+            size = local_file.stat().st_size
+            parts = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+            logger.info("Copying object from local storage", url=url, size=size, parts=len(parts))
+            with _atomic_open(filename) as f:
+                f.truncate(size)
+                f.flush()
+                with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(parts)))) as executor:
+                    futures = [
+                        executor.submit(_copy_part, backend, object_key, version_id, f.name, start, end)
+                        for start, end in parts
+                    ]
+                    for future in futures:
+                        future.result()
+            return filename
+
+    with session.head(url, headers={"Accept-Encoding": "identity"}, allow_redirects=True) as response:
+        response.raise_for_status()
+        accept_ranges = response.headers.get("Accept-Ranges")
+        content_length = response.headers.get("Content-Length")
+
+    if accept_ranges != "bytes" or not content_length or int(content_length) <= part_size:
+        stream_download(session, url, filename, max_resumes=retries)
+        return filename
+
+    size = int(content_length)
+    parts = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+    logger.info("Starting ranged download", url=url, size=size, parts=len(parts), max_workers=max_workers)
+
+    with _atomic_open(filename) as f:
+        f.truncate(size)
+        f.flush()
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(parts))) as executor:
+            futures = [
+                executor.submit(_download_part, session, url, f.name, start, end, retries) for start, end in parts
+            ]
+            for future in futures:
+                future.result()
+
+    record_bytes_downloaded(size)
+    logger.info("Ranged download complete", url=url, filename=str(filename), size=size)
+
+    return filename
+
+
+def _copy_part(backend: "StorageBackend", object_key: str, version_id: str, filename: str, start: int, end: int):
+    """Copy bytes start through end (inclusive) of an object version into the same range of filename."""
+    with open(filename, "r+b") as f:
+        f.seek(start)
+        f.write(backend.read_range(object_key, version_id, start, end - start + 1))
+
+
+def _download_part(session: Session, url: str, filename: str, start: int, end: int, retries: int):
+    """Download bytes start through end (inclusive) of url into the same range of filename."""
+    offset = start
+    attempts = 0
+    with open(filename, "r+b") as f:
+        while offset <= end:
+            f.seek(offset)
+            headers = {"Accept-Encoding": "identity", "Range": f"bytes={offset}-{end}"}
+            try:
+                with session.get(url, headers=headers, stream=True) as response:
+                    response.raise_for_status()
+                    if _get_range_start(response) != offset:
+                        raise DownloadError(f"Server did not return the requested range ({offset}-{end}) of {url}")
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        chunk = chunk[: end + 1 - offset]
+                        f.write(chunk)
+                        offset += len(chunk)
+                if offset <= end:
+                    raise ChunkedEncodingError(f"Response ended at byte {offset} of part {start}-{end}")
+            except (ChunkedEncodingError, ConnectionError, HTTPError) as e:
+                if attempts >= retries:
+                    raise
+                attempts += 1
+                logger.warning(
+                    "Download part failed, retrying", url=url, part=f"{start}-{end}", attempt=attempts, error=e
+                )
@@ -0,0 +1,497 @@
+"""Functions for reading virus genome sequence (FASTA) files."""
+
+import hashlib
+import io
+import lzma
+import mmap
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import IO, Collection, Iterator, cast
+from urllib.parse import urlparse
+
+import polars as pl
+import structlog
+import zstandard
+from requests import Session
+
+from cladetime.util.cache import _atomic_open
+from cladetime.util.session import _get_session
+
+logger = structlog.get_logger()
+
+# Size of the read buffer used when streaming FASTA files
+FASTA_READ_BUFFER_SIZE = 1024 * 1024
+# Suffix of the accession index written alongside a FASTA file (see build_fasta_index)
+FASTA_INDEX_SUFFIX = ".idx.parquet"
+
+
+def read_fasta(
+    source: str | Path, accessions: Collection[str] | None = None, session: Session | None = None
+) -> Iterator[tuple[str, str]]:
+    """
+    Stream the records of a FASTA file as (accession, sequence) tuples.
+
+    The file is read and decompressed incrementally, so memory use is bounded by
+    the size of a single record regardless of the size of the file. Files ending
+    in .zst or .xz are decompressed on the fly.
+
+    Parameters
+    ----------
+    source : str | Path
+        Path or http(s) URL of the FASTA file (e.g., CladeTime.url_sequence).
+        S3 URLs of files in a local mirror (see util.storage) are read from the mirror.
+    accessions : Collection[str] | None
+        If provided, only yield records whose accession is in this collection
+        (for example, the genbank_accession column of filter_covid_genome_metadata
+        output). Reading stops once every requested accession has been found.
+        When an uncompressed local file has an up-to-date accession index (see
+        build_fasta_index), only the requested records are read.
+    session : requests.Session | None
+        Session used to stream a URL. Defaults to a new session with retries.
+
+    Yields
+    ------
+    tuple[str, str]
+        The record's accession (the first word of its FASTA header) and its
+        sequence, with line breaks removed.
+    """
+    if accessions is not None and _is_current_index(_get_fasta_index_path(source), source):
+        with IndexedFasta(source) as fasta:
+            yield from fasta.read_many(accessions)
+        return
+
+    with _open_fasta(source, session) as f:
+        yield from _parse_fasta(f, accessions)
+
+
+@contextmanager
+def _open_fasta(source: str | Path, session: Session | None = None) -> Iterator[IO[bytes]]:
+    """Open a local or remote FASTA file as a decompressed binary stream."""
+    if isinstance(source, str) and urlparse(source).scheme in ["http", "https"]:
+        # the storage backends are only loaded for URLs (the bucket's backend may have a local copy of the file)
+        from cladetime.util.storage import _get_local_object
+
+        local_file = _get_local_object(source)
+        if local_file is None:
+            if not session:
+                session = _get_session()
+            with session.get(source, stream=True) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                with _decompress(cast(IO[bytes], response.raw), urlparse(source).path) as f:
+                    yield f
+            return
+        source = local_file
+
+    with open(source, "rb") as raw:
+        with _decompress(raw, str(source)) as f:
+            yield f
+
+
+def _decompress(raw: IO[bytes], name: str) -> IO[bytes]:
+    """Wrap a binary stream in a buffered decompressing reader chosen by file extension."""
+    if name.endswith(".zst"):
+        reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+        return io.BufferedReader(reader, buffer_size=FASTA_READ_BUFFER_SIZE)  # type: ignore
+    if name.endswith(".xz"):
+        return lzma.open(raw)  # type: ignore
+    if isinstance(raw, io.BufferedIOBase):
+        return raw
+    return io.BufferedReader(raw, buffer_size=FASTA_READ_BUFFER_SIZE)  # type: ignore
+
+
+def _parse_fasta(lines: IO[bytes], accessions: Collection[str] | None = None) -> Iterator[tuple[str, str]]:
+    """Parse (accession, sequence) records from a binary FASTA stream."""
+    remaining = set(accessions) if accessions is not None else None
+    accession = None
+    keep = False
+    chunks: list[bytes] = []
+
+    for line in lines:
+        if line.startswith(b">"):
+            if keep:
+                yield accession, b"".join(chunks).decode()  # type: ignore
+                if remaining is not None and not remaining:
+                    return
+            header = line[1:].split(maxsplit=1)
+            accession = header[0].decode() if header else ""
+            keep = remaining is None or accession in remaining
+            if keep and remaining is not None:
+                remaining.discard(accession)
+            chunks = []
+        elif keep:
+            chunks.append(line.strip())
+
+    if keep:
+        yield accession, b"".join(chunks).decode()  # type: ignore
+
+
+def split_fasta(source: Path, output_dir: Path, num_shards: int) -> list[Path]:
+    """
+    Split a FASTA file into balanced shards.
+
+    Records are streamed from source and each one is written, unchanged, to
+    the shard that currently holds the fewest bytes, so shards end up roughly
+    equal in size.
+
+    Parameters
+    ----------
+    source : Path
+        Path to the FASTA file to split (can be .zst or .xz compressed).
+    output_dir : Path
+        Directory where the shards are written (as uncompressed FASTA).
+    num_shards : int
+        Maximum number of shards to create.
+
+    Returns
+    -------
+    list[Path]
+        Paths to the shards, excluding any that received no records.
+    """
+    return _split_fasta(source, output_dir, num_shards)[0]
+
+
+def _split_fasta(source: Path, output_dir: Path, num_shards: int) -> tuple[list[Path], list[list[int]]]:
+    """Split a FASTA file like split_fasta, also returning the positions (in source) of each shard's records."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    shard_paths = [output_dir / f"{Path(source).name.split('.')[0]}_{i:03d}.fasta" for i in range(num_shards)]
+    shard_sizes = [0] * num_shards
+    shard_records: list[list[int]] = [[] for _ in range(num_shards)]
+    num_records = 0
+
+    with ExitStack() as stack:
+        shard_files = [stack.enter_context(open(path, "wb")) for path in shard_paths]
+        f = stack.enter_context(_open_fasta(source))
+        current = None
+        for line in f:
+            if line.startswith(b">"):
+                current = min(range(num_shards), key=lambda i: shard_sizes[i])
+                shard_records[current].append(num_records)
+                num_records += 1
+            if current is None:
+                # ignore anything before the first header
+                continue
+            shard_files[current].write(line)
+            shard_sizes[current] += len(line)
+
+    for path, records in zip(shard_paths, shard_records):
+        if not records:
+            path.unlink()
+    shards = [(path, records) for path, records in zip(shard_paths, shard_records) if records]
+    logger.info("split FASTA file", source=str(source), num_shards=len(shards))
+
+    return [path for path, _ in shards], [records for _, records in shards]
+
+
+def _iter_fasta_records(lines: IO[bytes]) -> Iterator[tuple[bytes, list[bytes]]]:
+    """Yield each record of a binary FASTA stream as its header (without ">") and its raw sequence lines."""
+    header = None
+    sequence_lines: list[bytes] = []
+    for line in lines:
+        if line.startswith(b">"):
+            if header is not None:
+                yield header, sequence_lines
+            header = line[1:].rstrip(b"\r\n")
+            sequence_lines = []
+        elif header is not None:
+            sequence_lines.append(line)
+    if header is not None:
+        yield header, sequence_lines
+
+
+def _normalize_sequence(sequence_lines: list[bytes]) -> bytes:
+    """Return a sequence without line breaks, in upper case."""
+    return b"".join(line.strip() for line in sequence_lines).upper()
+
+
+def profile_fasta(source: str | Path) -> pl.DataFrame:
+    """
+    Return the content hash, length and ambiguous base fraction of every sequence in a FASTA file.
+
+    The file is read once, and each record is profiled as it's read.
+
+    Returns
+    -------
+    polars.DataFrame
+        One row per record, in file order: record (the record's position in
+        the file), seqName (its full FASTA header), seq_hash (a sha256 of
+        the sequence that ignores line breaks and letter case), length (the number of bases), and ambiguous_fraction (the
+        fraction of bases that aren't A, C, G or T, such as N; 1.0 for an
+        empty sequence).
+    """
+    seq_names = []
+    seq_hashes = []
+    lengths = []
+    ambiguous_fractions = []
+    with _open_fasta(source) as f:
+        for header, sequence_lines in _iter_fasta_records(f):
+            sequence = _normalize_sequence(sequence_lines)
+            unambiguous = sum(sequence.count(base) for base in [b"A", b"C", b"G", b"T"])
+            seq_names.append(header.decode())
+            seq_hashes.append(hashlib.sha256(sequence).hexdigest())
+            lengths.append(len(sequence))
+            ambiguous_fractions.append(1 - unambiguous / len(sequence) if sequence else 1.0)
+
+    return pl.DataFrame(
+        {
+            "seqName": seq_names,
+            "seq_hash": seq_hashes,
+            "length": lengths,
+            "ambiguous_fraction": ambiguous_fractions,
+        },
+        schema={"seqName": pl.String, "seq_hash": pl.String, "length": pl.UInt32, "ambiguous_fraction": pl.Float64},
+    ).with_row_index("record")
+
+
+def write_fasta_records(source: str | Path, output: Path, records: Collection[int]) -> int:
+    """Write the records at the given positions (0-based) of a FASTA file to a new, uncompressed FASTA file."""
+    records = set(records)
+    num_written = 0
+    with _open_fasta(source) as f, open(output, "wb") as out:
+        for i, (header, sequence_lines) in enumerate(_iter_fasta_records(f)):
+            if i not in records:
+                continue
+            out.write(b">" + header + b"\n")
+            out.writelines(line if line.endswith(b"\n") else line + b"\n" for line in sequence_lines)
+            num_written += 1
+
+    return num_written
+
+
+def build_fasta_index(source: str | Path, index_path: Path | None = None) -> Path:
+    """
+    Write an accession index of an uncompressed FASTA file.
+
+    The index is a Parquet sidecar file with one row per record, sorted by
+    accession: the record's accession (the first word of its FASTA header),
+    and the byte offset and length of its sequence in the file (including any
+    line breaks within the sequence). IndexedFasta uses it to read individual
+    records without scanning the file.
+
+    Parameters
+    ----------
+    source : str | Path
+        Path to an uncompressed FASTA file (e.g., NCBI's genomic.fna or a
+        decompressed Nextstrain sequences.fasta).
+    index_path : Path | None
+        Location of the index. Defaults to source with a .idx.parquet suffix
+        appended, which is where IndexedFasta and read_fasta look for it.
+
+    Returns
+    -------
+    Path
+        Location of the index.
+    """
+    source = _check_uncompressed(source)
+    if index_path is None:
+        index_path = _get_fasta_index_path(source)
+
+    with open(source, "rb") as f:
+        if _get_size(f):
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                accessions, offsets, lengths = _find_fasta_records(mm)
+        else:
+            accessions, offsets, lengths = [], [], []
+
+    index = pl.DataFrame(
+        {"accession": accessions, "offset": offsets, "length": lengths},
+        schema={"accession": pl.String, "offset": pl.UInt64, "length": pl.UInt64},
+    ).sort("accession", maintain_order=True)
+    with _atomic_open(index_path) as f:
+        index.write_parquet(f.name)
+    logger.info("built FASTA index", source=str(source), index=str(index_path), num_records=len(index))
+
+    return index_path
+
+
+class IndexedFasta:
+    """
+    Random access to the records of an uncompressed FASTA file, by accession.
+
+    The file is memory-mapped, and sequences are returned as memoryview
+    slices of the mapping, so reading a record doesn't copy it and only the
+    pages that hold requested records are read from disk. Lookups use the
+    file's accession index (see build_fasta_index), which is built if it
+    doesn't exist or is older than the file.
+
+    Use IndexedFasta as a context manager (or call close). Sequences that are
+    still referenced when the file is closed keep its memory map open until
+    they're released.
+
+    Parameters
+    ----------
+    source : str | Path
+        Path to an uncompressed FASTA file.
+    index_path : Path | None
+        Location of the file's accession index. Defaults to source with a
+        .idx.parquet suffix appended.
+
+    Examples
+    --------
+    >>> with IndexedFasta("sequences.fasta") as fasta:
+    ...     for accession, sequence in fasta.get_many(["PP782799.1", "OR905656.1"]):
+    ...         print(accession, len(sequence))
+    """
+
+    def __init__(self, source: str | Path, index_path: Path | None = None):
+        self.source = _check_uncompressed(source)
+        self.index_path = Path(index_path) if index_path else _get_fasta_index_path(self.source)
+        if not _is_current_index(self.index_path, self.source):
+            build_fasta_index(self.source, self.index_path)
+
+        index = pl.read_parquet(self.index_path)
+        self._accessions = index.get_column("accession")
+        self._offsets = index.get_column("offset").to_numpy()
+        self._lengths = index.get_column("length").to_numpy()
+
+        self._file = open(self.source, "rb")
+        size = _get_size(self._file)
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._view = memoryview(self._mmap) if self._mmap is not None else memoryview(b"")
+
+    def __enter__(self) -> "IndexedFasta":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._accessions)
+
+    def __contains__(self, accession: str) -> bool:
+        return self._find([accession])[0] is not None
+
+    def get(self, accession: str) -> memoryview:
+        """
+        Return the sequence of the record with an accession.
+
+        The sequence is a read-only view of the file's bytes, including any
+        line breaks within the sequence. If several records share the
+        accession, the first one in the file is returned.
+
+        Raises
+        ------
+        KeyError
+            If no record has the accession.
+        """
+        [position] = self._find([accession])
+        if position is None:
+            raise KeyError(accession)
+        return self._slice(position)
+
+    def get_many(self, accessions: Collection[str]) -> Iterator[tuple[str, memoryview]]:
+        """
+        Yield (accession, sequence) for the records with the requested accessions, in file order.
+
+        Accessions that aren't in the file are skipped. Sequences are returned
+        as they are by get, in the order they appear in the file, so disk reads
+        move forward through it.
+        """
+        for accession, position in self._find_in_file_order(accessions):
+            yield accession, self._slice(position)
+
+    def read_many(self, accessions: Collection[str]) -> Iterator[tuple[str, str]]:
+        """
+        Yield (accession, sequence) for the records with the requested accessions, in file order.
+
+        Like get_many, but sequences are copied into strings without line
+        breaks (the records read_fasta yields).
+        """
+        for accession, position in self._find_in_file_order(accessions):
+            offset = int(self._offsets[position])
+            sequence = self._mmap[offset : offset + int(self._lengths[position])] if self._mmap is not None else b""
+            yield accession, b"".join(sequence.split()).decode()
+
+    def close(self) -> None:
+        """Close the file and its memory map."""
+        self._view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # sequences that are still referenced keep the mapping open until they're released
+                pass
+            self._mmap = None
+        self._file.close()
+
+    def _find(self, accessions: list[str]) -> list[int | None]:
+        """Return the index positions of the first records with accessions (None for accessions that aren't found)."""
+        positions = self._accessions.search_sorted(pl.Series(accessions, dtype=pl.String), side="left").to_list()
+        return [
+            position if position < len(self._accessions) and self._accessions[position] == accession else None
+            for position, accession in zip(positions, accessions)
+        ]
+
+    def _find_in_file_order(self, accessions: Collection[str]) -> list[tuple[str, int]]:
+        """Return (accession, index position) of the records with accessions that are in the file, in file order."""
+        accessions = list(dict.fromkeys(accessions))
+        found = [
+            (accession, position)
+            for accession, position in zip(accessions, self._find(accessions))
+            if position is not None
+        ]
+        return sorted(found, key=lambda record: self._offsets[record[1]])
+
+    def _slice(self, position: int) -> memoryview:
+        offset = int(self._offsets[position])
+        return self._view[offset : offset + int(self._lengths[position])]
+
+
+def _find_fasta_records(mm: mmap.mmap) -> tuple[list[str], list[int], list[int]]:
+    """Return the accession, sequence offset and sequence length of every record in a memory-mapped FASTA file."""
+    accessions = []
+    offsets = []
+    lengths = []
+    size = len(mm)
+
+    # records start with a ">" at the beginning of a line
+    header_start = 0 if mm[:1] == b">" else (mm.find(b"\n>") + 1 or -1)
+    while header_start != -1:
+        header_end = mm.find(b"\n", header_start)
+        header_end = size if header_end == -1 else header_end
+        next_header = mm.find(b"\n>", header_end)
+        record_end = size if next_header == -1 else next_header
+
+        sequence_start = min(header_end + 1, record_end)
+        sequence_end = record_end
+        while sequence_end > sequence_start and mm[sequence_end - 1] in b"\r\n":
+            sequence_end -= 1
+        header = mm[header_start + 1 : header_end].split(maxsplit=1)
+        accessions.append(header[0].decode() if header else "")
+        offsets.append(sequence_start)
+        lengths.append(sequence_end - sequence_start)
+
+        header_start = -1 if next_header == -1 else next_header + 1
+
+    return accessions, offsets, lengths
+
+
+def _get_fasta_index_path(source: str | Path) -> Path:
+    """Return the default location of a FASTA file's accession index (e.g., sequences.fasta.idx.parquet)."""
+    source = Path(source)
+    return source.with_name(f"{source.name}{FASTA_INDEX_SUFFIX}")
+
+
+def _is_current_index(index_path: Path, source: str | Path) -> bool:
+    """Return True if a local FASTA file has an accession index that was written after the file last changed."""
+    if isinstance(source, str) and urlparse(source).scheme in ["http", "https"]:
+        return False
+    if not index_path.exists() or not Path(source).exists():
+        return False
+    return index_path.stat().st_mtime >= Path(source).stat().st_mtime
+
+
+def _check_uncompressed(source: str | Path) -> Path:
+    """Return source as a Path, checking that it isn't a compressed file (which can't be read at random)."""
+    source = Path(source)
+    if source.name.endswith((".zst", ".xz")):
+        raise ValueError(f"{source} is compressed: decompress it to read records by accession")
+    return source
+
+
+def _get_size(f: IO[bytes]) -> int:
+    f.seek(0, io.SEEK_END)
+    size = f.tell()
+    f.seek(0)
+    return size
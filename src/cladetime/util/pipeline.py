@@ -0,0 +1,289 @@
+"""Checkpointed, concurrently-scheduled stages for the clade assignment pipeline."""
+
+import json
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextvars import copy_context
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable
+
+import structlog
+
+from cladetime.util.cache import _atomic_open
+from cladetime.util.reference import _sha256sum
+
+logger = structlog.get_logger()
+
+
+@dataclass
+class Stage:
+    """
+    A step of the pipeline, with the files it reads and writes.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage (also the name of its manifest).
+    run : Callable[[], Path | list[Path] | None]
+        Runs the stage. Any paths it returns are recorded as outputs, in
+        addition to the declared outputs, and are returned again when the
+        stage is skipped.
+    inputs : list[Path] | Callable[[], list[Path]]
+        Files the stage reads. Inputs that are only known once an earlier
+        stage has run (e.g., a path that stage returns) can be given as a
+        function that's called when the stage starts.
+    outputs : list[Path]
+        Files the stage writes.
+    params : dict
+        Settings that change the stage's outputs (e.g., a date). Values must be
+        JSON-serializable.
+    depends_on : list[str]
+        Names of stages that must complete before this one starts, in
+        addition to the stages whose declared outputs are this stage's
+        declared inputs.
+    heavy : bool
+        The stage runs a resource-intensive subprocess (e.g., Nextclade), so
+        the number of heavy stages that run at the same time is capped (see
+        Pipeline.run_all).
+    """
+
+    name: str
+    run: Callable[[], Path | list[Path] | None]
+    inputs: list[Path] | Callable[[], list[Path]] = field(default_factory=list)
+    outputs: list[Path] = field(default_factory=list)
+    params: dict = field(default_factory=dict)
+    depends_on: list[str] = field(default_factory=list)
+    heavy: bool = False
+
+
+class Pipeline:
+    """
+    Run pipeline stages, recording a manifest for each completed stage.
+
+    A stage's manifest records its parameters, the sha256 hashes of its inputs
+    and outputs, and the paths it returned. When resume is True, a stage is
+    skipped if its manifest shows it completed with the same parameters and
+    inputs, and its outputs are intact. Because a stage's outputs are the
+    next stage's inputs, rerunning a stage that produces different outputs
+    also reruns the stages that read them.
+
+    Parameters
+    ----------
+    manifest_path : Path
+        Directory of the stage manifests.
+    resume : bool
+        Skip stages that are up to date. When False, every stage runs (and
+        its manifest is rewritten).
+
+    Attributes
+    ----------
+    results : dict
+        The paths returned by each completed (or skipped) stage, by stage name.
+    """
+
+    def __init__(self, manifest_path: Path, resume: bool = False):
+        self.manifest_path = Path(manifest_path)
+        self.resume = resume
+        self.results: dict[str, Path | list[Path] | None] = {}
+        # hashes of files seen during this run, by (path, size, modification time)
+        self._hashes: dict[tuple[str, int, int], str] = {}
+
+    def run(self, stage: Stage) -> Path | list[Path] | None:
+        """Run a stage (unless it can be skipped) and return the paths it returned."""
+        manifest_file = self.manifest_path / f"{stage.name}.json"
+        manifest = _read_manifest(manifest_file)
+        input_paths = stage.inputs() if callable(stage.inputs) else stage.inputs
+
+        if self.resume and manifest is not None and self._is_current(stage, input_paths, manifest):
+            logger.info("Skipping up-to-date pipeline stage", stage=stage.name, completed=manifest["completed"])
+            self.results[stage.name] = _decode_result(manifest["result"])
+            return self.results[stage.name]
+
+        # a stage that fails part way through leaves no manifest behind
+        manifest_file.unlink(missing_ok=True)
+        inputs = {str(path): self._get_fingerprint(path, manifest, "inputs") for path in input_paths}
+        result = stage.run()
+        outputs = [*stage.outputs, *_result_paths(result)]
+
+        manifest = {
+            "stage": stage.name,
+            "params": stage.params,
+            "inputs": inputs,
+            "outputs": {str(path): self._get_fingerprint(path) for path in outputs},
+            "result": _encode_result(result),
+            "completed": datetime.now(timezone.utc).isoformat(),
+        }
+        with _atomic_open(manifest_file, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+        self.results[stage.name] = result
+        return result
+
+    def run_all(self, stages: list[Stage], max_workers: int | None = None, max_heavy: int = 1) -> dict:
+        """
+        Run stages concurrently, each one as soon as the stages it depends on have completed.
+
+        Stages run on a thread pool (the pipeline's stages spend their time
+        waiting on downloads and subprocesses), so independent stages overlap
+        and the pipeline takes as long as its slowest chain of dependent
+        stages. If a stage fails, no more stages are started, the stages
+        that are already running are allowed to finish, and the error is
+        raised.
+
+        Parameters
+        ----------
+        stages : list[Stage]
+            Stages of the pipeline. A stage depends on the stages named in its
+            depends_on, and on the stages that declare its inputs as outputs.
+        max_workers : int | None
+            Maximum number of stages that run at the same time. Defaults to
+            the number of stages.
+        max_heavy : int
+            Maximum number of heavy stages (see Stage) that run at the same time.
+
+        Returns
+        -------
+        dict
+            The paths returned by each stage, by stage name.
+
+        Raises
+        ------
+        ValueError
+            If stage names aren't unique, a stage depends on an unknown stage,
+            or the dependencies contain a cycle.
+        """
+        dependencies = _get_stage_dependencies(stages)
+        heavy_slots = threading.Semaphore(max_heavy)
+        pending = {stage.name: stage for stage in stages}
+        running: dict[Future, str] = {}
+        completed: set[str] = set()
+        error: BaseException | None = None
+
+        def run_stage(stage: Stage):
+            if not stage.heavy:
+                return self.run(stage)
+            with heavy_slots:
+                return self.run(stage)
+
+        with ThreadPoolExecutor(max_workers=max_workers or max(1, len(stages))) as executor:
+            while pending or running:
+                if error is None:
+                    for name in [name for name in pending if dependencies[name] <= completed]:
+                        # stages run in a copy of this context, so their metrics spans nest under the caller's
+                        future = executor.submit(copy_context().run, run_stage, pending.pop(name))
+                        running[future] = name
+                elif not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        logger.error("Pipeline stage failed", stage=name, error=str(future.exception()))
+                        error = error or future.exception()
+                    else:
+                        completed.add(name)
+
+        if error is not None:
+            raise error
+
+        return self.results
+
+    def _is_current(self, stage: Stage, input_paths: list[Path], manifest: dict) -> bool:
+        """Return True if a stage's manifest matches its parameters, inputs and outputs."""
+        if manifest.get("params") != json.loads(json.dumps(stage.params)):
+            logger.info("Pipeline stage parameters changed", stage=stage.name)
+            return False
+        if set(manifest.get("inputs", {})) != {str(path) for path in input_paths}:
+            return False
+
+        for kind in ["inputs", "outputs"]:
+            for path, fingerprint in manifest.get(kind, {}).items():
+                if (
+                    not Path(path).exists()
+                    or self._get_fingerprint(path, manifest, kind)["sha256"] != fingerprint["sha256"]
+                ):
+                    logger.info(f"Pipeline stage {kind} changed", stage=stage.name, path=path)
+                    return False
+
+        return True
+
+    def _get_fingerprint(self, path: Path | str, manifest: dict | None = None, kind: str | None = None) -> dict:
+        """
+        Return the size, modification time and sha256 hash of a file.
+
+        Hashing multi-gigabyte files is slow, so a hash is reused (rather than
+        recomputed) when the file's size and modification time match those
+        recorded in the manifest, or when the file was already hashed during
+        this run.
+        """
+        stat = Path(path).stat()
+        key = (str(path), stat.st_size, stat.st_mtime_ns)
+
+        recorded = (manifest or {}).get(kind, {}).get(str(path))
+        if recorded is not None and (recorded["size"], recorded["mtime_ns"]) == key[1:]:
+            self._hashes.setdefault(key, recorded["sha256"])
+
+        if key not in self._hashes:
+            self._hashes[key] = _sha256sum(Path(path))
+
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": self._hashes[key]}
+
+
+def _get_stage_dependencies(stages: list[Stage]) -> dict[str, set[str]]:
+    """Return the names of the stages that each stage depends on, checking that they can be scheduled."""
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Pipeline stage names aren't unique: {names}")
+
+    producers = {str(path): stage.name for stage in stages for path in stage.outputs}
+    dependencies = {}
+    for stage in stages:
+        declared_inputs = [] if callable(stage.inputs) else stage.inputs
+        dependencies[stage.name] = set(stage.depends_on) | {
+            producers[str(path)] for path in declared_inputs if str(path) in producers
+        }
+        dependencies[stage.name].discard(stage.name)
+        if unknown := dependencies[stage.name] - set(names):
+            raise ValueError(f"Pipeline stage {stage.name} depends on unknown stages: {sorted(unknown)}")
+
+    # every stage must be reachable by repeatedly scheduling the stages whose dependencies are complete
+    scheduled: set[str] = set()
+    while ready := {name for name in names if name not in scheduled and dependencies[name] <= scheduled}:
+        scheduled |= ready
+    if len(scheduled) != len(names):
+        raise ValueError(f"Pipeline stages have circular dependencies: {sorted(set(names) - scheduled)}")
+
+    return dependencies
+
+
+def _read_manifest(manifest_file: Path) -> dict | None:
+    """Read a stage manifest, returning None if there isn't a readable one."""
+    try:
+        with open(manifest_file, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logger.warning("Ignoring unreadable pipeline stage manifest", manifest_file=str(manifest_file), error=e)
+        return None
+
+
+def _result_paths(result) -> list[Path]:
+    if result is None:
+        return []
+    return [Path(path) for path in result] if isinstance(result, list) else [Path(result)]
+
+
+def _encode_result(result) -> str | list[str] | None:
+    if result is None:
+        return None
+    return [str(path) for path in result] if isinstance(result, list) else str(result)
+
+
+def _decode_result(result) -> Path | list[Path] | None:
+    if result is None:
+        return None
+    return [Path(path) for path in result] if isinstance(result, list) else Path(result)
@@ -1,70 +1,408 @@
 """Functions for retrieving and parsing SARS-CoV-2 phylogenic tree data."""
 
+import bisect
+import functools
+import hashlib
+import json
+import os
 import subprocess
-from datetime import datetime
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Tuple
+from typing import TYPE_CHECKING, Tuple
 
 import boto3
+import botocore.config
 import structlog
 from botocore import UNSIGNED
 from botocore.exceptions import BotoCoreError, ClientError, NoCredentialsError
+from requests import Session
+from requests.exceptions import RequestException
+
+from cladetime.util.cache import _atomic_open
+from cladetime.util.config import _get_cache_path
+from cladetime.util.session import _get_session
+from cladetime.util.timing import time_function
+
+if TYPE_CHECKING:
+    from mypy_boto3_s3 import S3Client
+
+    from cladetime.util.storage import StorageBackend
 
 logger = structlog.get_logger()
 
+# Size of the connection pool used by the shared S3 client
+S3_MAX_POOL_CONNECTIONS = 20
 
-def get_nextclade_dataset(as_of_date: str, data_path_root: str) -> Path:
+# Nextclade dataset used for clade assignments, and the index that lists its versions
+NEXTCLADE_DATASET_NAME = "sars-cov-2"
+NEXTCLADE_DATASET_INDEX_URL = "https://data.clades.nextstrain.org/v3/index.json"
+# Dataset version used when the index can't be retrieved
+NEXTCLADE_DEFAULT_DATASET_TAG = "2024-07-17--12-57-03Z"
+
+
+@time_function
+def get_nextclade_dataset(
+    as_of_date: str | datetime, data_path_root: str, cache_path: Path | None = None, session: Session | None = None
+) -> Path:
     """
     Return the Nextclade dataset relevant to a specified as_of_date. The dataset is
     in .zip format and contains two components required for assignming virus
     genome sequences to clades: a tree and the reference sequence of the virus.
+
+    Parameters
+    ----------
+    as_of_date : str | datetime
+        Use the newest Nextclade dataset released on or before this date
+        ("YYYY-MM-DD" strings include datasets released at any time that day).
+    data_path_root : str
+        Directory where the dataset is saved when persistent caching is disabled.
+    cache_path : Path | None
+        Location of the cladetime cache. Defaults to the cladetime cache directory.
+    session : Session | None
+        Requests session used to retrieve the Nextclade dataset index.
+
+    Returns
+    -------
+    Path
+        Location of the dataset .zip file (named nextclade_dataset_<tag>.zip).
+
+    Notes
+    -----
+    Each dataset version is downloaded once into a dataset store under
+    cache_path and is verified against the checksum recorded at download
+    time before it's reused.
     """
+    if cache_path is None:
+        cache_path = _get_cache_path()
+
+    tag = _get_nextclade_dataset_tag_as_of(as_of_date, cache_path, session)
 
-    # Until Nextstrain provides this information, we're hard-coding a
-    # a specific version of the nextclade dataset here.
-    as_of_date = "not yet implemented"
-    DATASET_VERSION = "2024-07-17--12-57-03Z"
-    DATASET_PATH = Path(f"{data_path_root}/nextclade_dataset_{DATASET_VERSION}.zip")
+    if cache_path is None:
+        dataset_path = Path(f"{data_path_root}/nextclade_dataset_{tag}.zip")
+        _download_nextclade_dataset(tag, dataset_path)
+    else:
+        dataset_path = _get_stored_nextclade_dataset(tag, cache_path)
+
+    logger.info(
+        "Nextclade reference dataset retrieved", as_of_date=str(as_of_date), version=tag, output_zip=dataset_path
+    )
 
+    return dataset_path
+
+
+def _get_stored_nextclade_dataset(tag: str, cache_path: Path) -> Path:
+    """Return a Nextclade dataset version from the local dataset store, downloading it if needed."""
+    store_path = Path(cache_path) / "nextclade_datasets" / NEXTCLADE_DATASET_NAME
+    dataset_path = store_path / f"nextclade_dataset_{tag}.zip"
+    checksum_path = dataset_path.with_name(f"{dataset_path.name}.sha256")
+
+    if dataset_path.exists() and checksum_path.exists():
+        if _sha256sum(dataset_path) == checksum_path.read_text().strip():
+            logger.info("Using stored Nextclade dataset", version=tag)
+            return dataset_path
+        logger.warning("Stored Nextclade dataset failed checksum verification", dataset_path=str(dataset_path))
+
+    store_path.mkdir(parents=True, exist_ok=True)
+    # download to a temporary directory in the store, so the dataset appears in the store all at once
+    with tempfile.TemporaryDirectory(dir=store_path) as download_dir:
+        download_path = Path(download_dir) / dataset_path.name
+        _download_nextclade_dataset(tag, download_path)
+        checksum = _sha256sum(download_path)
+        os.replace(download_path, dataset_path)
+    with _atomic_open(checksum_path, "w") as f:
+        f.write(checksum)
+
+    return dataset_path
+
+
+def _download_nextclade_dataset(tag: str, dataset_path: Path):
+    """Download a version of the Nextclade SARS-CoV-2 dataset with the Nextclade CLI."""
     subprocess.run(
         [
             "nextclade",
             "dataset",
             "get",
             "--name",
-            "sars-cov-2",
+            NEXTCLADE_DATASET_NAME,
             "--tag",
-            DATASET_VERSION,
+            tag,
             "--output-zip",
-            str(DATASET_PATH),
-        ]
+            str(dataset_path),
+        ],
+        check=True,
     )
 
-    logger.info(
-        "Nextclade reference dataset retrieved", as_of_date=as_of_date, version=DATASET_VERSION, output_zip=DATASET_PATH
-    )
 
-    return DATASET_PATH
+def _sha256sum(path: Path) -> str:
+    """Return the sha256 checksum of a file."""
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _get_nextclade_dataset_tag_as_of(
+    as_of_date: str | datetime, cache_path: Path | None = None, session: Session | None = None
+) -> str:
+    """
+    Return the tag of the newest Nextclade SARS-CoV-2 dataset released on or before as_of_date.
+
+    Dataset tags are release timestamps (e.g., 2024-07-17--12-57-03Z). The tags come
+    from Nextclade's dataset index, which is cached under cache_path and only
+    re-fetched when as_of_date is later than the cached copy. If the index can't be
+    retrieved, NEXTCLADE_DEFAULT_DATASET_TAG is used.
+    """
+    if isinstance(as_of_date, datetime):
+        as_of = as_of_date if as_of_date.tzinfo else as_of_date.replace(tzinfo=timezone.utc)
+    else:
+        as_of = datetime.strptime(as_of_date, "%Y-%m-%d").replace(tzinfo=timezone.utc) + timedelta(days=1)
+        as_of -= timedelta(microseconds=1)
+
+    tags = _get_nextclade_dataset_tags(as_of, cache_path, session)
+    if not tags:
+        logger.warning("Nextclade dataset index unavailable, using default dataset", tag=NEXTCLADE_DEFAULT_DATASET_TAG)
+        return NEXTCLADE_DEFAULT_DATASET_TAG
+
+    position = bisect.bisect_right(tags, as_of, key=lambda tag: tag[0])
+    if position == 0:
+        raise ValueError(f"No Nextclade {NEXTCLADE_DATASET_NAME} dataset found before {as_of_date}")
+
+    return tags[position - 1][1]
+
+
+def _get_nextclade_dataset_tags(
+    as_of: datetime, cache_path: Path | None = None, session: Session | None = None
+) -> list[tuple[datetime, str]]:
+    """Return (release date, tag) pairs of every known Nextclade SARS-CoV-2 dataset version, sorted by date."""
+    index_path = Path(cache_path) / "nextclade_datasets" / "index.json" if cache_path else None
+
+    index = None
+    if index_path and index_path.exists():
+        try:
+            with open(index_path, "r") as f:
+                cached_index = json.load(f)
+            # dataset versions are never backdated, so a cached index answers questions about its past
+            if as_of <= datetime.fromisoformat(cached_index["retrieved_at"]):
+                index = cached_index["index"]
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring unreadable Nextclade dataset index", index_path=str(index_path), error=e)
+
+    if index is None:
+        if not session:
+            session = _get_session(retry=False)
+        try:
+            response = session.get(NEXTCLADE_DATASET_INDEX_URL)
+            response.raise_for_status()
+            index = response.json()
+        except (RequestException, ValueError) as e:
+            logger.warning("Failed to retrieve Nextclade dataset index", url=NEXTCLADE_DATASET_INDEX_URL, error=e)
+            return []
+        if index_path:
+            with _atomic_open(index_path, "w") as f:
+                json.dump({"retrieved_at": datetime.now(timezone.utc).isoformat(), "index": index}, f)
+
+    return _parse_nextclade_dataset_index(index, NEXTCLADE_DATASET_NAME)
+
 
+def _parse_nextclade_dataset_index(index: dict, dataset_name: str) -> list[tuple[datetime, str]]:
+    """Return the sorted (release date, tag) pairs of a dataset (matched by path or shortcut) in a Nextclade index."""
+    tags = set()
+    for collection in index.get("collections", []):
+        for dataset in collection.get("datasets", []):
+            if dataset.get("path") != dataset_name and dataset_name not in dataset.get("shortcuts", []):
+                continue
+            for version in dataset.get("versions", []) + [dataset.get("version", {})]:
+                tag = version.get("tag")
+                try:
+                    tags.add((datetime.strptime(tag, "%Y-%m-%d--%H-%M-%SZ").replace(tzinfo=timezone.utc), tag))
+                except (TypeError, ValueError):
+                    continue
 
-def _get_s3_object_url(bucket_name: str, object_key: str, date: datetime) -> Tuple[str, str]:
+    return sorted(tags)
+
+
+def _get_nextclade_dataset_tag(dataset_path: Path) -> str | None:
+    """Return the version tag of a Nextclade dataset retrieved by get_nextclade_dataset."""
+    name = Path(dataset_path).name
+    prefix, suffix = "nextclade_dataset_", ".zip"
+    if not (name.startswith(prefix) and name.endswith(suffix)):
+        return None
+    return name[len(prefix) : -len(suffix)]
+
+
+def _get_s3_object_url(
+    bucket_name: str, object_key: str, date: datetime, cache_path: Path | None = None
+) -> Tuple[str, str]:
     """
     For a versioned, public S3 bucket and object key, return the version ID
     of the object as it existed at a specific date (UTC)
     """
+    return _get_s3_object_urls(bucket_name, [object_key], date, cache_path)[object_key]
+
+
+def _get_s3_object_urls(
+    bucket_name: str, object_keys: list[str], date: datetime, cache_path: Path | None = None
+) -> dict[str, Tuple[str, str]]:
+    """
+    For a versioned, public S3 bucket and a set of object keys, return the
+    (version ID, version URL) of each object as it existed at a specific date (UTC).
+
+    Object versions are tracked in local version indexes (see _get_s3_object_versions),
+    and any keys that need a refresh are listed together on a shared S3 client.
+    """
+    versions = _get_s3_object_versions(bucket_name, object_keys, date, cache_path)
+
+    urls = {}
+    for object_key in object_keys:
+        selected_version = _select_s3_object_version(versions[object_key], date)
+        if selected_version is None:
+            raise ValueError(f"No version of {object_key} found before {date}")
+        version_id = selected_version[1]
+        version_url = f"https://{bucket_name}.s3.amazonaws.com/{object_key}?versionId={version_id}"
+        urls[object_key] = (version_id, version_url)
+
+    return urls
+
+
+def _get_s3_object_url_series(
+    bucket_name: str, object_key: str, dates: list[datetime], cache_path: Path | None = None
+) -> list[Tuple[str, str]]:
+    """
+    For a versioned, public S3 bucket and object key, return the (version ID,
+    version URL) of the object as it existed at each of a series of dates (UTC).
+
+    All of the dates are resolved from a single version listing.
+    """
+    if not dates:
+        return []
+
+    versions = _get_s3_object_versions(bucket_name, [object_key], max(dates), cache_path)[object_key]
+
+    urls = []
+    for date in dates:
+        selected_version = _select_s3_object_version(versions, date)
+        if selected_version is None:
+            raise ValueError(f"No version of {object_key} found before {date}")
+        version_id = selected_version[1]
+        urls.append((version_id, f"https://{bucket_name}.s3.amazonaws.com/{object_key}?versionId={version_id}"))
+
+    return urls
+
+
+def _get_s3_object_versions(
+    bucket_name: str, object_keys: list[str], date: datetime, cache_path: Path | None = None
+) -> dict[str, list[tuple[datetime, str]]]:
+    """
+    Return (LastModified, VersionId) pairs for every known version of a set of
+    S3 objects, sorted by LastModified.
+
+    Versions are persisted to an on-disk index per object under cache_path
+    (default: the cladetime cache directory). S3 is only queried for objects whose
+    newest indexed version is older than date, and that query stops once it
+    reaches versions that are already in the index. When persistent caching is
+    disabled, every object's versions are listed.
+
+    When a local mirror is configured (see util.storage), versions are listed
+    from the mirror's manifests instead of S3, and aren't indexed again.
+    Objects that aren't in the mirror at all (e.g., the sequence file, which
+    isn't mirrored by default) are listed from S3.
+    """
+    # storage.py builds on this module's S3 helpers, so it's imported here rather than at module level
+    from cladetime.util.storage import S3Backend, get_storage_backend
+
+    backend = get_storage_backend(bucket_name)
+    if backend.is_local:
+        listed_versions = backend.list_versions({object_key: None for object_key in object_keys})
+        versions = {object_key: sorted(listed_versions[object_key]) for object_key in object_keys}
+        unmirrored_keys = [object_key for object_key in object_keys if not versions[object_key]]
+        if unmirrored_keys:
+            logger.info("listing objects that aren't in the mirror from S3", keys=unmirrored_keys)
+            versions.update(
+                _get_indexed_object_versions(S3Backend(bucket_name), bucket_name, unmirrored_keys, date, cache_path)
+            )
+        return versions
+
+    return _get_indexed_object_versions(backend, bucket_name, object_keys, date, cache_path)
+
+
+def _get_indexed_object_versions(
+    backend: "StorageBackend", bucket_name: str, object_keys: list[str], date: datetime, cache_path: Path | None
+) -> dict[str, list[tuple[datetime, str]]]:
+    """Return the versions of a set of objects from their on-disk indexes, listing newer versions from backend."""
+    if cache_path is None:
+        cache_path = _get_cache_path()
+
+    versions = {}
+    newer_than = {}
+    for object_key in object_keys:
+        versions[object_key] = (
+            _read_version_index(_get_version_index_path(bucket_name, object_key, cache_path)) if cache_path else []
+        )
+        # versions are immutable, so an index can answer as-of questions up to its newest entry
+        if not versions[object_key] or date > versions[object_key][-1][0]:
+            newer_than[object_key] = versions[object_key][-1][0] if versions[object_key] else None
+
+    if not newer_than:
+        return versions
+
+    listed_versions = backend.list_versions(newer_than)
+    for object_key, key_versions in listed_versions.items():
+        known_ids = {version_id for _, version_id in versions[object_key]}
+        new_versions = [version for version in key_versions if version[1] not in known_ids]
+        if not new_versions:
+            continue
+        versions[object_key] = sorted(versions[object_key] + new_versions)
+        if cache_path:
+            index_path = _get_version_index_path(bucket_name, object_key, cache_path)
+            _write_version_index(index_path, bucket_name, object_key, versions[object_key])
+            logger.info("S3 version index updated", key=object_key, new_versions=len(new_versions))
+
+    return versions
+
+
+def _select_s3_object_version(versions: list[tuple[datetime, str]], date: datetime) -> tuple[datetime, str] | None:
+    """Return the newest (LastModified, VersionId) pair on or before date from a sorted version list."""
+    position = bisect.bisect_right(versions, date, key=lambda version: version[0])
+    if position == 0:
+        return None
+    return versions[position - 1]
+
+
+@functools.cache
+def _get_s3_client() -> "S3Client":
+    """Return a long-lived, unsigned S3 client that is shared by all of cladetime's S3 requests."""
+    config = botocore.config.Config(
+        signature_version=UNSIGNED,
+        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+        retries={"max_attempts": 5, "mode": "standard"},
+        tcp_keepalive=True,
+    )
+    return boto3.client("s3", config=config)
+
+
+def _list_s3_object_versions(
+    bucket_name: str, newer_than: dict[str, datetime | None], max_keys: int = 1000
+) -> dict[str, list[tuple[datetime, str]]]:
+    """
+    List (LastModified, VersionId) pairs of one or more S3 objects.
+
+    newer_than maps each object key to the LastModified date of its newest known
+    version (or None to list every version). The keys are listed concurrently on
+    the shared S3 client, so resolving several keys costs about as much wall time
+    as resolving one.
+    """
+    s3_client = _get_s3_client()
+    max_workers = min(len(newer_than), S3_MAX_POOL_CONNECTIONS)
+
     try:
-        s3_client = boto3.client("s3", config=boto3.session.Config(signature_version=UNSIGNED))  # type: ignore
-
-        paginator = s3_client.get_paginator("list_object_versions")
-        page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=object_key)
-
-        selected_version = None
-        for page in page_iterator:
-            for version in page.get("Versions", []):
-                version_date = version["LastModified"]
-                if version_date <= date:
-                    if selected_version is None or version_date > selected_version["LastModified"]:
-                        selected_version = version
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                object_key: executor.submit(
+                    _list_s3_key_versions, s3_client, bucket_name, object_key, known_date, max_keys
+                )
+                for object_key, known_date in newer_than.items()
+            }
+            versions = {object_key: future.result() for object_key, future in futures.items()}
     except (BotoCoreError, ClientError, NoCredentialsError) as e:
         logger.error("S3 client error", error=e)
         raise e
@@ -72,10 +410,64 @@ def _get_s3_object_url(bucket_name: str, object_key: str, date: datetime) -> Tup
         logger.error("Unexpected error", error=e)
         raise e
 
-    if selected_version is None:
-        raise ValueError(f"No version of {object_key} found before {date}")
+    return versions
+
+
+def _list_s3_key_versions(
+    s3_client: "S3Client", bucket_name: str, object_key: str, newer_than: datetime | None, max_keys: int
+) -> list[tuple[datetime, str]]:
+    """
+    List (LastModified, VersionId) pairs of a single S3 object.
+
+    S3 returns an object's versions newest first, so when newer_than is provided
+    paging stops at the first page that reaches versions older than that date.
+    """
+    paginator = s3_client.get_paginator("list_object_versions")
+    page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=object_key, PaginationConfig={"PageSize": max_keys})
+
+    versions = []
+    for page in page_iterator:
+        reached_known_versions = False
+        for version in page.get("Versions", []):
+            if version["Key"] != object_key:
+                continue
+            version_date = version["LastModified"]
+            if newer_than is not None and version_date < newer_than:
+                reached_known_versions = True
+                continue
+            versions.append((version_date, version["VersionId"]))
+        if reached_known_versions:
+            break
+
+    return versions
+
+
+def _get_version_index_path(bucket_name: str, object_key: str, cache_path: Path) -> Path:
+    """Return the location of the local version index for an S3 object."""
+    return Path(cache_path) / "s3_versions" / bucket_name / f"{object_key}.json"
+
+
+def _read_version_index(index_path: Path) -> list[tuple[datetime, str]]:
+    """Read a local S3 version index, returning an empty list if it doesn't exist or can't be parsed."""
+    try:
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        return [(datetime.fromisoformat(last_modified), version_id) for last_modified, version_id in index["versions"]]
+    except FileNotFoundError:
+        return []
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning("Ignoring unreadable S3 version index", index_path=str(index_path), error=e)
+        return []
 
-    version_id = selected_version["VersionId"]
-    version_url = f"https://{bucket_name}.s3.amazonaws.com/{object_key}?versionId={version_id}"
 
-    return version_id, version_url
+def _write_version_index(
+    index_path: Path, bucket_name: str, object_key: str, versions: list[tuple[datetime, str]]
+) -> None:
+    """Atomically write a local S3 version index."""
+    index = {
+        "bucket": bucket_name,
+        "key": object_key,
+        "versions": [[last_modified.isoformat(), version_id] for last_modified, version_id in versions],
+    }
+    with _atomic_open(index_path, "w") as f:
+        json.dump(index, f)
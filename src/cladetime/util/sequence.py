@@ -2,6 +2,7 @@
 
 import json
 import lzma
+import os
 import zipfile
 from datetime import datetime, timezone
 from pathlib import Path
@@ -10,18 +11,31 @@ import polars as pl
 import structlog
 import us
 from requests import Session
-
+from requests.exceptions import HTTPError
+
+from cladetime.util.cache import (
+    _atomic_open,
+    _evict_lru,
+    _get_cached_s3_object,
+    _get_object_cache_file,
+    _parse_s3_object_url,
+)
+from cladetime.util.download import ranged_download, stream_download
 from cladetime.util.reference import _get_s3_object_url
 from cladetime.util.session import _check_response, _get_session
+from cladetime.util.storage import _get_local_object
 from cladetime.util.timing import time_function
 
 logger = structlog.get_logger()
 
+# Number of rows per row group in Parquet copies of genome metadata
+METADATA_PARQUET_ROW_GROUP_SIZE = 100_000
+
 
 @time_function
-def get_covid_genome_data(released_since_date: str, base_url: str, filename: str):
+def get_covid_genome_data(released_since_date: str, base_url: str, filename: str) -> str:
     """
-    Download genome data package from NCBI.
+    Download genome data package from NCBI and return its sha256 checksum.
     FIXME: Download the Nextclade-processed GenBank sequence data (which originates from NCBI)
     from https://data.nextstrain.org/files/ncov/open/sequences.fasta.zst instead of using
     the NCBI API.
@@ -49,16 +63,17 @@ def get_covid_genome_data(released_since_date: str, base_url: str, filename: str
 
     logger.info("NCBI API call starting", released_since_date=released_since_date)
 
-    response = session.post(base_url, data=json.dumps(request_body), timeout=(300, 300))
-    _check_response(response)
+    # The package is streamed to disk, so memory use doesn't depend on the size of the package, and
+    # downloads that end prematurely (ChunkedEncodingError) resume from the last byte received
+    try:
+        checksum = stream_download(
+            session, base_url, Path(filename), method="POST", data=json.dumps(request_body), timeout=(300, 300)
+        )
+    except HTTPError as e:
+        _check_response(e.response)
+        raise
 
-    # Originally tried saving the NCBI package via a stream call and iter_content (to prevent potential
-    # memory issues that can arise when download large files). However, ran into an intermittent error:
-    # ChunkedEncodingError(ProtocolError('Response ended prematurely').
-    # We may need to revisit this at some point, depending on how much data we place to request via the
-    # API and what kind of machine the pipeline will run on.
-    with open(filename, "wb") as f:
-        f.write(response.content)
+    return checksum
 
 
 @time_function
@@ -79,18 +94,18 @@ def download_covid_genome_metadata(
         logger.info("using existing genome metadata file", metadata_file=str(filename))
         return filename
 
+    # a version held in a local mirror is copied from the mirror rather than downloaded
     logger.info("starting genome metadata download", source=s3_url, destination=str(filename))
-    with session.get(s3_url, stream=True) as result:
-        result.raise_for_status()
-        with open(filename, "wb") as f:
-            for chunk in result.iter_content(chunk_size=None):
-                f.write(chunk)
+    ranged_download(session, s3_url, filename)
 
     return filename
 
 
 def get_covid_genome_metadata(
-    metadata_path: Path | None = None, metadata_url: str | None = None, num_rows: int | None = None
+    metadata_path: Path | None = None,
+    metadata_url: str | None = None,
+    num_rows: int | None = None,
+    use_parquet: bool = False,
 ) -> pl.LazyFrame:
     """
     Read GenBank genome metadata into a Polars LazyFrame.
@@ -106,6 +121,11 @@ def get_covid_genome_metadata(
     num_rows : int | None, default = None
         The number of genome metadata rows to request.
         When not supplied, request all rows.
+    use_parquet : bool, default = False
+        If metadata_path has an up-to-date Parquet copy at its default
+        location (see materialize_covid_genome_metadata), scan the Parquet
+        file instead, so column projections and filters are pushed down to
+        the file reader.
     """
 
     path_flag = metadata_path is not None
@@ -118,7 +138,13 @@ def get_covid_genome_metadata(
         return metadata
 
     if metadata_path:
-        if (compression_type := metadata_path.suffix) in [".tsv", ".zst"]:
+        if metadata_path.suffix == ".parquet":
+            metadata = pl.scan_parquet(metadata_path, n_rows=num_rows)
+        elif use_parquet and _is_current_parquet(
+            parquet_path := _get_metadata_parquet_path(metadata_path), metadata_path
+        ):
+            metadata = pl.scan_parquet(parquet_path, n_rows=num_rows)
+        elif (compression_type := metadata_path.suffix) in [".tsv", ".zst"]:
             metadata = pl.scan_csv(metadata_path, separator="\t", n_rows=num_rows)
         elif compression_type == ".xz":
             metadata = pl.read_csv(
@@ -128,11 +154,141 @@ def get_covid_genome_metadata(
     return metadata
 
 
+@time_function
+def materialize_covid_genome_metadata(metadata_path: Path, parquet_path: Path | None = None) -> Path:
+    """
+    Write a Parquet copy of a GenBank genome metadata file.
+
+    The metadata is sorted by country and date before it's written, so each
+    Parquet row group covers a narrow range of those columns and queries that
+    filter on them (e.g., USA sequences) can skip most of the file.
+
+    Parameters
+    ----------
+    metadata_path : Path
+        Path to a NextStrain GenBank genome metadata file.
+    parquet_path : Path | None
+        Location of the Parquet file. Defaults to a .parquet file alongside
+        metadata_path, which get_covid_genome_metadata(use_parquet=True) will
+        then use in place of metadata_path.
+
+    Returns
+    -------
+    Path
+        Location of the Parquet file.
+    """
+    if metadata_path.suffix == ".parquet":
+        return metadata_path
+    if parquet_path is None:
+        parquet_path = _get_metadata_parquet_path(metadata_path)
+    if _is_current_parquet(parquet_path, metadata_path):
+        return parquet_path
+
+    metadata = get_covid_genome_metadata(metadata_path=metadata_path)
+    logger.info("materializing genome metadata as parquet", metadata_file=str(metadata_path), parquet=str(parquet_path))
+    with _atomic_open(parquet_path) as f:
+        metadata.sort("country", "date", nulls_last=True).sink_parquet(
+            f.name, row_group_size=METADATA_PARQUET_ROW_GROUP_SIZE, statistics=True
+        )
+
+    return parquet_path
+
+
+def _get_metadata_parquet_path(metadata_path: Path) -> Path:
+    """Return the default location of a metadata file's Parquet copy (e.g., metadata.tsv.zst -> metadata.parquet)."""
+    name = metadata_path.name
+    # only the metadata's own suffixes are replaced (names can contain other dots, e.g., S3 version IDs)
+    for suffix in [".zst", ".xz", ".tsv"]:
+        name = name.removesuffix(suffix)
+    return metadata_path.with_name(f"{name}.parquet")
+
+
+def _is_current_parquet(parquet_path: Path, metadata_path: Path) -> bool:
+    """Return True if parquet_path exists and was written after metadata_path last changed."""
+    if not parquet_path.exists():
+        return False
+    return not metadata_path.exists() or parquet_path.stat().st_mtime >= metadata_path.stat().st_mtime
+
+
+def _get_cached_covid_genome_metadata(
+    metadata_url: str, cache_path: Path, max_bytes: int | None = None, use_parquet: bool = False
+) -> Path | None:
+    """
+    Return a local copy of a versioned Nextstrain metadata file, downloading it on first use.
+
+    The metadata file is downloaded into the object cache. If use_parquet is set,
+    it's also materialized as Parquet alongside it, and the Parquet copy is
+    returned. Returns None if metadata_url doesn't reference a specific object
+    version.
+    """
+    object_version = _parse_s3_object_url(metadata_url)
+    if object_version is None:
+        return None
+    if not use_parquet:
+        return _get_cached_s3_object(metadata_url, cache_path, max_bytes)
+
+    parquet_path = _get_metadata_parquet_path(_get_object_cache_file(cache_path, *object_version))
+    if parquet_path.exists():
+        os.utime(parquet_path)
+        return parquet_path
+
+    metadata_path = _get_cached_s3_object(metadata_url, cache_path)
+    materialize_covid_genome_metadata(metadata_path, parquet_path)
+    if max_bytes is not None:
+        # the raw file was used before its Parquet copy was written, so it's evicted first
+        _evict_lru(parquet_path.parent.parent, max_bytes, keep=parquet_path)
+
+    return parquet_path
+
+
+def _get_versioned_covid_genome_metadata(
+    metadata_url: str, cache_path: Path | None = None, max_bytes: int | None = None, use_parquet: bool = False
+) -> pl.LazyFrame:
+    """
+    Return a LazyFrame of a Nextstrain metadata file, preferring a cached copy.
+
+    When cache_path is provided, versioned metadata files are downloaded once into
+    the object cache and the cached file is scanned (or its Parquet copy, if
+    use_parquet is set; see _get_cached_covid_genome_metadata); otherwise the
+    local mirror's copy of the file (if any) or the remote file is scanned
+    directly.
+    """
+    if cache_path:
+        metadata_path = _get_cached_covid_genome_metadata(
+            metadata_url, cache_path, max_bytes=max_bytes, use_parquet=use_parquet
+        )
+        if metadata_path:
+            return get_covid_genome_metadata(metadata_path=metadata_path)
+    elif (local_file := _get_local_object(metadata_url)) is not None:
+        return get_covid_genome_metadata(metadata_path=local_file)
+
+    return get_covid_genome_metadata(metadata_url=metadata_url)
+
+
 def _get_ncov_metadata(
     url_ncov_metadata: str,
     session: Session | None = None,
+    cache_path: Path | None = None,
 ) -> dict:
-    """Return metadata emitted by the Nextstrain ncov pipeline."""
+    """
+    Return metadata emitted by the Nextstrain ncov pipeline.
+
+    If cache_path is provided, metadata retrieved from a versioned S3 URL is
+    cached on disk under cache_path, keyed by the object's versionId (S3 object
+    versions never change, so cached entries don't expire).
+    """
+    cache_file = _get_ncov_metadata_cache_file(url_ncov_metadata, cache_path) if cache_path else None
+    if cache_file and cache_file.exists():
+        try:
+            with open(cache_file, "r") as f:
+                return json.load(f)
+        except ValueError as e:
+            logger.warning("Ignoring unreadable ncov metadata cache file", cache_file=str(cache_file), error=e)
+
+    if (local_file := _get_local_object(url_ncov_metadata)) is not None:
+        with open(local_file, "r") as f:
+            return json.load(f)
+
     if not session:
         session = _get_session(retry=False)
 
@@ -147,7 +303,21 @@ def _get_ncov_metadata(
         )
         return {}
 
-    return response.json()
+    metadata = response.json()
+    if cache_file:
+        with _atomic_open(cache_file, "w") as f:
+            json.dump(metadata, f)
+
+    return metadata
+
+
+def _get_ncov_metadata_cache_file(url_ncov_metadata: str, cache_path: Path) -> Path | None:
+    """Return the on-disk cache location for a versioned ncov metadata URL (None if the URL isn't versioned)."""
+    object_version = _parse_s3_object_url(url_ncov_metadata)
+    if object_version is None:
+        return None
+    _, version_id = object_version
+    return Path(cache_path) / "ncov_metadata" / f"{version_id}.json"
 
 
 def filter_covid_genome_metadata(metadata: pl.LazyFrame, cols: list = []) -> pl.LazyFrame:
@@ -201,6 +371,47 @@ def get_clade_counts(filtered_metadata: pl.LazyFrame) -> pl.LazyFrame:
     return counts
 
 
+def get_clade_proportions(
+    clade_counts: pl.LazyFrame, clades: list[str] | None = None, other_label: str = "other"
+) -> pl.LazyFrame:
+    """
+    Return weekly clade counts and proportions by location.
+
+    Parameters
+    ----------
+    clade_counts : polars.LazyFrame
+        Clade counts by location and date (as returned by get_clade_counts or
+        CladeTime.clade_counts).
+    clades : list[str] | None
+        If provided, clades that aren't in this list (e.g., the clades chosen by
+        get_clades) are combined into a single clade named other_label.
+    other_label : str
+        Name of the combined clade when clades is provided.
+
+    Returns
+    -------
+    polars.LazyFrame
+        location, week (the Sunday that starts the week, as in get_clades),
+        clade, count, and proportion (count / all sequences in that location
+        and week).
+    """
+    clade = pl.col("clade")
+    if clades is not None:
+        clade = pl.when(clade.is_in(clades)).then(clade).otherwise(pl.lit(other_label))
+
+    # Polars weekdays run from 1 (Monday) to 7 (Sunday), and weeks start on Sunday
+    week = pl.col("date") - pl.duration(days=pl.col("date").dt.weekday() % 7)
+
+    proportions = (
+        clade_counts.group_by("location", week.alias("week"), clade.alias("clade"))
+        .agg(pl.col("count").sum())
+        .with_columns((pl.col("count") / pl.col("count").sum().over("location", "week")).alias("proportion"))
+        .sort("location", "week", "clade")
+    )
+
+    return proportions
+
+
 def _unzip_sequence_package(filename: Path, data_path: Path):
     """Unzip the downloaded virus genome data package."""
     with zipfile.ZipFile(filename, "r") as package_zip:
@@ -215,19 +426,30 @@ def _unzip_sequence_package(filename: Path, data_path: Path):
             raise SystemExit("Error downloading NCBI package")
 
 
-def parse_sequence_assignments(df_assignments: pl.DataFrame) -> pl.DataFrame:
-    """Parse out the sequence number from the seqName column returned by the clade assignment tool."""
+def parse_sequence_assignments(df_assignments: pl.DataFrame | pl.LazyFrame) -> pl.DataFrame | pl.LazyFrame:
+    """
+    Parse out the sequence number from the seqName column returned by the clade assignment tool.
 
-    # polars apparently can't split out the sequence number from that big name column
-    # without resorting an apply, so here we're dropping into pandas to do that
-    # (might be a premature optimization, since this manoever requires both pandas and pyarrow)
-    seq = pl.from_pandas(df_assignments.to_pandas()["seqName"].str.split(" ").str[0].rename("seq"))
+    The sequence number (the first word of seqName) is added as a "seq" column
+    after seqName. A DataFrame is checked for duplicate sequences immediately;
+    for a LazyFrame the check is left to the caller (see merge_metadata), so the
+    assignments can be scanned as part of a larger query.
+
+    Raises
+    ------
+    ValueError
+        If a DataFrame contains more than one row for a sequence.
+    """
+    seq = pl.col("seqName").str.split(" ").list.first().alias("seq")
+
+    if isinstance(df_assignments, pl.LazyFrame):
+        columns = df_assignments.collect_schema().names()
+        return df_assignments.select(*columns[:1], seq, *columns[1:])
 
     # we're expecting one row per sequence
-    if seq.n_unique() != df_assignments.shape[0]:
+    if df_assignments.select(seq.n_unique()).item() != df_assignments.shape[0]:
         raise ValueError("Clade assignment data contains duplicate sequence. Stopping assignment process.")
 
-    # add the parsed sequence number as a new column
-    df_assignments = df_assignments.insert_column(1, seq)  # type: ignore
-
-    return df_assignments
+    # add the parsed sequence number as a new column (without modifying the caller's DataFrame)
+    columns = df_assignments.columns
+    return df_assignments.select(*columns[:1], seq, *columns[1:])
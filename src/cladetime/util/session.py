@@ -2,14 +2,18 @@
 
 import requests
 import structlog
-from requests.adapters import HTTPAdapter
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
 from urllib3.util import Retry
 
 logger = structlog.get_logger()
 
 
-def _get_session(retry: bool = True) -> requests.Session:
-    """Return a requests session with retry logic."""
+def _get_session(retry: bool = True, pool_maxsize: int = DEFAULT_POOLSIZE) -> requests.Session:
+    """Return a requests session with retry logic.
+
+    pool_maxsize is the number of connections kept open per host, which
+    should be at least the number of threads that share the session.
+    """
 
     headers = {
         "Accept-Encoding": "br, deflate, gzip, x-xz, zstd",
@@ -27,7 +31,9 @@ def _get_session(retry: bool = True) -> requests.Session:
             backoff_factor=1,
             status_forcelist=[401, 403, 404, 429, 500, 502, 503, 504],
         )
-        session.mount("https://", HTTPAdapter(max_retries=retries))
+        session.mount("https://", HTTPAdapter(max_retries=retries, pool_maxsize=pool_maxsize))
+    elif pool_maxsize != DEFAULT_POOLSIZE:
+        session.mount("https://", HTTPAdapter(pool_maxsize=pool_maxsize))
 
     return session
 
@@ -0,0 +1,270 @@
+"""Storage backends for the versioned Nextstrain objects that cladetime reads."""
+
+import shutil
+from abc import ABC, abstractmethod
+from datetime import datetime
+from pathlib import Path
+from typing import IO
+from urllib.parse import urlparse
+
+import structlog
+
+from cladetime.util import reference
+from cladetime.util.cache import _atomic_open, _parse_s3_object_url
+from cladetime.util.config import _get_mirror_path
+from cladetime.util.timing import record_bytes_downloaded, time_function
+
+logger = structlog.get_logger()
+
+# Name of the version manifest stored with each mirrored object
+MIRROR_MANIFEST_NAME = "versions.json"
+
+
+class StorageBackend(ABC):
+    """
+    Versioned object storage that holds Nextstrain's files.
+
+    Objects are addressed by key and version ID, and a version never changes
+    once it's published.
+
+    Parameters
+    ----------
+    bucket_name : str
+        Name of the S3 bucket that the objects are published to.
+    """
+
+    # the backend is on a local (or network) filesystem, so reading it doesn't cost an S3 request
+    is_local = False
+
+    def __init__(self, bucket_name: str):
+        self.bucket_name = bucket_name
+
+    @abstractmethod
+    def list_versions(self, newer_than: dict[str, datetime | None]) -> dict[str, list[tuple[datetime, str]]]:
+        """
+        List (LastModified, VersionId) pairs of one or more objects.
+
+        newer_than maps each object key to the LastModified date of its newest
+        known version (or None to list every version). Versions older than that
+        date may be left out.
+        """
+
+    @abstractmethod
+    def open(self, object_key: str, version_id: str) -> IO[bytes]:
+        """Open a version of an object as a binary stream."""
+
+    @abstractmethod
+    def read_range(self, object_key: str, version_id: str, start: int, size: int) -> bytes:
+        """Read size bytes of a version of an object, starting at byte offset start."""
+
+    def get_path(self, object_key: str, version_id: str) -> Path | None:
+        """
+        Return a local file that holds a version of an object, or None if the backend doesn't have one.
+
+        Readers use the local file in place (for example, to scan it with
+        Polars) and download the object's URL when there isn't one.
+        """
+        return None
+
+    def get_url(self, object_key: str, version_id: str) -> str:
+        """Return the S3 URL of a version of an object."""
+        return f"https://{self.bucket_name}.s3.amazonaws.com/{object_key}?versionId={version_id}"
+
+
+class S3Backend(StorageBackend):
+    """Read objects from their public, versioned S3 bucket."""
+
+    def list_versions(self, newer_than: dict[str, datetime | None]) -> dict[str, list[tuple[datetime, str]]]:
+        return reference._list_s3_object_versions(self.bucket_name, newer_than)
+
+    def open(self, object_key: str, version_id: str) -> IO[bytes]:
+        s3_object = reference._get_s3_client().get_object(Bucket=self.bucket_name, Key=object_key, VersionId=version_id)
+        return s3_object["Body"]  # type: ignore
+
+    def read_range(self, object_key: str, version_id: str, start: int, size: int) -> bytes:
+        s3_object = reference._get_s3_client().get_object(
+            Bucket=self.bucket_name, Key=object_key, VersionId=version_id, Range=f"bytes={start}-{start + size - 1}"
+        )
+        return s3_object["Body"].read()
+
+
+class LocalMirrorBackend(StorageBackend):
+    """
+    Read objects from a local (or network filesystem) mirror of an S3 bucket.
+
+    Each object's versions are stored under root/bucket_name/object_key, one
+    file per version ID (keeping the key's suffixes, e.g. .tsv.zst, so readers
+    can infer the file's format), alongside a manifest of the versions that
+    are in the mirror. A version is only added to the manifest once its file
+    is complete, so the manifest never lists a partial download.
+
+    Mirrors are populated with sync_mirror (or the sync_mirror command). Only
+    one sync should write to a mirror at a time; any number of processes can
+    read from it.
+
+    Parameters
+    ----------
+    root : Path
+        Root directory of the mirror.
+    bucket_name : str
+        Name of the mirrored S3 bucket.
+    """
+
+    is_local = True
+
+    def __init__(self, root: Path, bucket_name: str):
+        super().__init__(bucket_name)
+        self.root = Path(root)
+
+    def list_versions(self, newer_than: dict[str, datetime | None]) -> dict[str, list[tuple[datetime, str]]]:
+        versions = {}
+        for object_key, known_date in newer_than.items():
+            key_versions = self.get_versions(object_key)
+            versions[object_key] = [
+                version for version in reversed(key_versions) if known_date is None or version[0] >= known_date
+            ]
+        return versions
+
+    def open(self, object_key: str, version_id: str) -> IO[bytes]:
+        return open(self._get_version_file(object_key, version_id), "rb")
+
+    def read_range(self, object_key: str, version_id: str, start: int, size: int) -> bytes:
+        with self.open(object_key, version_id) as f:
+            f.seek(start)
+            return f.read(size)
+
+    def get_versions(self, object_key: str) -> list[tuple[datetime, str]]:
+        """Return the (LastModified, VersionId) pairs of an object's mirrored versions, sorted by LastModified."""
+        return reference._read_version_index(self._get_object_path(object_key) / MIRROR_MANIFEST_NAME)
+
+    def get_path(self, object_key: str, version_id: str) -> Path | None:
+        version_file = self._get_version_file(object_key, version_id)
+        return version_file if version_file.exists() else None
+
+    def add_version(self, object_key: str, last_modified: datetime, version_id: str, source: IO[bytes]) -> Path:
+        """Copy a version of an object into the mirror and record it in the object's manifest."""
+        version_file = self._get_version_file(object_key, version_id)
+        with _atomic_open(version_file) as f:
+            shutil.copyfileobj(source, f, length=1024 * 1024)
+
+        versions = [version for version in self.get_versions(object_key) if version[1] != version_id]
+        reference._write_version_index(
+            self._get_object_path(object_key) / MIRROR_MANIFEST_NAME,
+            self.bucket_name,
+            object_key,
+            sorted(versions + [(last_modified, version_id)]),
+        )
+
+        return version_file
+
+    def _get_object_path(self, object_key: str) -> Path:
+        return self.root / self.bucket_name / object_key
+
+    def _get_version_file(self, object_key: str, version_id: str) -> Path:
+        return self._get_object_path(object_key) / f"{version_id}{''.join(Path(object_key).suffixes)}"
+
+
+def get_storage_backend(bucket_name: str) -> StorageBackend:
+    """
+    Return the backend that cladetime reads a bucket's objects from.
+
+    Objects are read from the local mirror in CLADETIME_MIRROR_DIR when one
+    is configured, and from S3 otherwise.
+    """
+    mirror_path = _get_mirror_path()
+    if mirror_path is not None:
+        return LocalMirrorBackend(mirror_path, bucket_name)
+    return S3Backend(bucket_name)
+
+
+def _get_object_backend(url: str) -> tuple[StorageBackend, str, str] | None:
+    """
+    Return the storage backend, object key and version ID of a versioned S3 object URL.
+
+    Returns None if url doesn't reference a specific version of an S3 object.
+    """
+    object_version = _parse_s3_object_url(url)
+    hostname = urlparse(url).hostname or ""
+    if object_version is None or not hostname.endswith(".s3.amazonaws.com"):
+        return None
+
+    bucket_name = hostname.removesuffix(".s3.amazonaws.com")
+    return get_storage_backend(bucket_name), *object_version
+
+
+def _get_local_object(url: str) -> Path | None:
+    """
+    Return a local file that holds a versioned S3 object URL, from the bucket's storage backend.
+
+    This is how cladetime's readers go through get_storage_backend: they read
+    the returned file in place, and download url when it's None (url doesn't
+    reference a specific object version, or its backend has no local copy).
+    """
+    object_backend = _get_object_backend(url)
+    if object_backend is None:
+        return None
+
+    backend, object_key, version_id = object_backend
+    return backend.get_path(object_key, version_id)
+
+
+@time_function
+def sync_mirror(
+    mirror: LocalMirrorBackend,
+    object_keys: list[str],
+    since: datetime | None = None,
+    source: StorageBackend | None = None,
+) -> dict[str, list[str]]:
+    """
+    Copy object versions that aren't in a local mirror into it.
+
+    Versions are copied oldest first, so the versions in the mirror are always
+    every version from the oldest one it holds up to the newest: an
+    interrupted sync resumes where it stopped, and each sync only lists the
+    versions published since the mirror's newest version.
+
+    Parameters
+    ----------
+    mirror : LocalMirrorBackend
+        The mirror to update.
+    object_keys : list[str]
+        Keys of the objects to mirror.
+    since : datetime | None
+        Skip versions published before this date (UTC). By default, every
+        version is mirrored.
+    source : StorageBackend | None
+        Backend the versions are copied from. Defaults to the mirror's S3 bucket.
+
+    Returns
+    -------
+    dict[str, list[str]]
+        The version IDs that were added to the mirror, by object key.
+    """
+    if source is None:
+        source = S3Backend(mirror.bucket_name)
+
+    mirrored = {object_key: mirror.get_versions(object_key) for object_key in object_keys}
+    newer_than = {}
+    for object_key, versions in mirrored.items():
+        known_dates = [date for date in [versions[-1][0] if versions else None, since] if date is not None]
+        newer_than[object_key] = max(known_dates) if known_dates else None
+    listed_versions = source.list_versions(newer_than)
+
+    added: dict[str, list[str]] = {}
+    for object_key in object_keys:
+        known_ids = {version_id for _, version_id in mirrored[object_key]}
+        new_versions = sorted(
+            version
+            for version in listed_versions[object_key]
+            if version[1] not in known_ids and (since is None or version[0] >= since)
+        )
+        added[object_key] = []
+        for last_modified, version_id in new_versions:
+            logger.info("mirroring object version", key=object_key, version_id=version_id)
+            with source.open(object_key, version_id) as body:
+                version_file = mirror.add_version(object_key, last_modified, version_id, body)
+            record_bytes_downloaded(version_file.stat().st_size)
+            added[object_key].append(version_id)
+
+    logger.info("mirror synced", mirror=str(mirror.root), new_versions={key: len(ids) for key, ids in added.items()})
+    return added
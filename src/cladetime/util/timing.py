@@ -1,21 +1,330 @@
 """Code to support the timing of functions."""
 
 import functools
+import json
+import os
+import resource
+import sys
+import threading
 import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Iterator
 
+import polars as pl
 import structlog
 
+from cladetime.util.cache import _atomic_open
+
 logger = structlog.get_logger()
 
+# How often (in seconds) the collector samples the process's resident set size
+METRICS_SAMPLE_INTERVAL = 0.05
+
+# Span metrics exported as Prometheus gauges: (attribute, metric name, help text, aggregation across calls)
+PROMETHEUS_METRICS: list[tuple[str, str, str, Callable[[list], float]]] = [
+    ("seconds", "cladetime_stage_seconds", "Wall time of the stage", sum),
+    ("cpu_seconds", "cladetime_stage_cpu_seconds", "CPU time of the cladetime process during the stage", sum),
+    ("child_cpu_seconds", "cladetime_stage_child_cpu_seconds", "CPU time of subprocesses run by the stage", sum),
+    ("peak_rss_bytes", "cladetime_stage_peak_rss_bytes", "Peak resident set size during the stage", max),
+    ("python_peak_bytes", "cladetime_stage_python_peak_bytes", "Peak Python heap allocations during the stage", max),
+    ("rows_in", "cladetime_stage_rows_in", "Rows of the DataFrames passed to the stage", sum),
+    ("rows_out", "cladetime_stage_rows_out", "Rows of the DataFrame returned by the stage", sum),
+    ("bytes_downloaded", "cladetime_stage_bytes_downloaded", "Bytes downloaded by the stage", sum),
+    ("calls", "cladetime_stage_calls", "Number of times the stage ran", sum),
+]
+
+_current_collector: ContextVar["MetricsCollector | None"] = ContextVar("cladetime_metrics_collector", default=None)
+_current_span: ContextVar["Span | None"] = ContextVar("cladetime_metrics_span", default=None)
+
+
+@dataclass
+class Span:
+    """Resource use of one run of a pipeline stage (and of the stages nested inside it)."""
+
+    name: str
+    path: str
+    started: str | None = None
+    seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    child_cpu_seconds: float = 0.0
+    peak_rss_bytes: int | None = None
+    python_peak_bytes: int | None = None
+    rows_in: int | None = None
+    rows_out: int | None = None
+    bytes_downloaded: int = 0
+    error: str | None = None
+    children: list["Span"] = field(default_factory=list)
+    # running Python heap peak, including the peaks of finished child spans
+    _python_peak: int = field(default=0, repr=False)
+
+    def to_dict(self) -> dict:
+        span = {key: value for key, value in self.__dict__.items() if not key.startswith("_") and key != "children"}
+        span["children"] = [child.to_dict() for child in self.children]
+        return span
+
+
+class MetricsCollector:
+    """
+    Collect the resource use of pipeline stages as a tree of spans.
+
+    While a collector is active (``with MetricsCollector() as metrics:``),
+    every function decorated with time_function, and every ``with span(name)``
+    block, is recorded as a span nested under the span that was open when it
+    started. Each span records its wall time, the CPU time of the process and
+    of the subprocesses it waited for (for example, Nextclade and dataformat),
+    the peak resident set size of the process, bytes downloaded, and the rows
+    of the DataFrames it received and returned.
+
+    Parameters
+    ----------
+    labels : dict | None
+        Labels that identify the run (for example, its run_time), included in
+        the exported reports.
+    trace_python_memory : bool
+        Also record the high-water mark of Python heap allocations with
+        tracemalloc. This slows down allocation-heavy Python code, and it
+        doesn't see memory allocated by Polars.
+    sample_interval : float
+        How often (in seconds) the resident set size is sampled.
+
+    Notes
+    -----
+    Resident set size and subprocess CPU time are measured for the whole
+    process, so stages that run concurrently in different threads are
+    charged for each other's use. Spans opened in worker threads are only
+    nested under the span that submitted them when the thread runs in a copy
+    of the submitter's context (see contextvars.copy_context).
+    """
+
+    def __init__(
+        self,
+        labels: dict | None = None,
+        trace_python_memory: bool = False,
+        sample_interval: float = METRICS_SAMPLE_INTERVAL,
+    ):
+        self.labels = dict(labels or {})
+        self.trace_python_memory = trace_python_memory
+        self.sample_interval = sample_interval
+        self.spans: list[Span] = []
+        self.started: str | None = None
+        self._open_spans: list[Span] = []
+        self._lock = threading.Lock()
+        self._stop_sampling = threading.Event()
+        self._sampler: threading.Thread | None = None
+        self._started_tracemalloc = False
+        self._token: Token | None = None
+
+    def __enter__(self) -> "MetricsCollector":
+        self.started = datetime.now(timezone.utc).isoformat()
+        if self.trace_python_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self._stop_sampling.clear()
+        self._sampler = threading.Thread(target=self._sample_rss, name="cladetime-metrics", daemon=True)
+        self._sampler.start()
+        self._token = _current_collector.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _current_collector.reset(self._token)
+        self._stop_sampling.set()
+        self._sampler.join()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def iter_spans(self) -> Iterator[Span]:
+        """Iterate over all recorded spans, parents before their children."""
+        stack = list(reversed(self.spans))
+        while stack:
+            span = stack.pop()
+            yield span
+            stack.extend(reversed(span.children))
+
+    def get_spans(self, name: str) -> list[Span]:
+        """Return the recorded spans of a stage, by name (e.g., "merge_metadata") or path (e.g., "main/merge_metadata")."""
+        return [span for span in self.iter_spans() if name in (span.name, span.path)]
+
+    def report(self) -> dict:
+        """Return the collected metrics as a JSON-serializable run report."""
+        return {
+            "labels": self.labels,
+            "started": self.started,
+            "spans": [span.to_dict() for span in self.spans],
+        }
+
+    def write_json(self, path: Path) -> Path:
+        """Write the run report (see report) to a JSON file."""
+        with _atomic_open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        return Path(path)
+
+    def write_prometheus(self, path: Path) -> Path:
+        """
+        Write the collected metrics to a file in the Prometheus text exposition format.
+
+        The file can be picked up by node_exporter's textfile collector. Each
+        stage is labeled with its path, and stages that ran more than once are
+        combined (times and counts are summed, peaks are maximums).
+        """
+        stages: dict[str, list[Span]] = {}
+        for span in self.iter_spans():
+            stages.setdefault(span.path, []).append(span)
+
+        lines = []
+        for attribute, metric, help_text, aggregate in PROMETHEUS_METRICS:
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+            for stage, spans in stages.items():
+                if attribute == "calls":
+                    values = [1 for _ in spans]
+                else:
+                    values = [getattr(span, attribute) for span in spans if getattr(span, attribute) is not None]
+                if values:
+                    labels = _format_prometheus_labels({**self.labels, "stage": stage})
+                    lines.append(f"{metric}{{{labels}}} {aggregate(values)}")
+
+        with _atomic_open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return Path(path)
+
+    @contextmanager
+    def _span(self, name: str) -> Iterator[Span]:
+        parent = _current_span.get()
+        span = Span(name=name, path=f"{parent.path}/{name}" if parent else name)
+        span.started = datetime.now(timezone.utc).isoformat()
+        span.peak_rss_bytes = _get_rss_bytes()
+        with self._lock:
+            (parent.children if parent else self.spans).append(span)
+            self._open_spans.append(span)
+
+        if self.trace_python_memory and tracemalloc.is_tracing():
+            # tracemalloc has one peak for the whole process: hand the peak so far to the
+            # parent, and give this span a fresh one
+            if parent is not None:
+                parent._python_peak = max(parent._python_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+        token = _current_span.set(span)
+        start_time = time.perf_counter()
+        start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        start_child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start_time
+            span.cpu_seconds = _get_cpu_seconds(resource.getrusage(resource.RUSAGE_SELF), start_usage)
+            span.child_cpu_seconds = _get_cpu_seconds(resource.getrusage(resource.RUSAGE_CHILDREN), start_child_usage)
+            _current_span.reset(token)
+            with self._lock:
+                self._open_spans.remove(span)
+                span.peak_rss_bytes = max(span.peak_rss_bytes, _get_rss_bytes())
+                if parent is not None:
+                    parent.peak_rss_bytes = max(parent.peak_rss_bytes or 0, span.peak_rss_bytes)
+                    parent.bytes_downloaded += span.bytes_downloaded
+            if self.trace_python_memory and tracemalloc.is_tracing():
+                span.python_peak_bytes = max(span._python_peak, tracemalloc.get_traced_memory()[1])
+                if parent is not None:
+                    parent._python_peak = max(parent._python_peak, span.python_peak_bytes)
+
+    def _sample_rss(self):
+        """Update the peak resident set size of the open spans until the collector exits."""
+        while not self._stop_sampling.wait(self.sample_interval):
+            rss = _get_rss_bytes()
+            with self._lock:
+                for span in self._open_spans:
+                    span.peak_rss_bytes = max(span.peak_rss_bytes or 0, rss)
+
+
+def get_metrics_collector() -> MetricsCollector | None:
+    """Return the active metrics collector, if there is one."""
+    return _current_collector.get()
+
+
+@contextmanager
+def span(name: str) -> Iterator[Span | None]:
+    """Record a block of code as a span of the active metrics collector (if there is one)."""
+    collector = _current_collector.get()
+    if collector is None:
+        yield None
+        return
+    with collector._span(name) as current_span:
+        yield current_span
+
+
+def record_bytes_downloaded(num_bytes: int):
+    """Add downloaded bytes to the current span of the active metrics collector (if there is one)."""
+    current_span = _current_span.get()
+    if current_span is not None:
+        current_span.bytes_downloaded += num_bytes
+
 
 def time_function(func):
+    """
+    Log the elapsed time of a function and record it as a span of the active metrics collector.
+
+    When the function receives or returns Polars DataFrames, their row counts
+    are recorded as the span's rows_in and rows_out (LazyFrames aren't
+    counted, because that would require collecting them).
+    """
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        start_time = time.perf_counter()
-        value = func(*args, **kwargs)
-        end_time = time.perf_counter()
-        run_time = end_time - start_time
-        logger.info(f"{repr(func.__name__)} complete", elapsed_seconds=round(run_time, ndigits=2))
+        with span(func.__name__) as current_span:
+            start_time = time.perf_counter()
+            value = func(*args, **kwargs)
+            end_time = time.perf_counter()
+            run_time = end_time - start_time
+
+            metrics = {}
+            if current_span is not None:
+                current_span.rows_in = _count_rows([*args, *kwargs.values()])
+                current_span.rows_out = _count_rows([value])
+                metrics = {
+                    "rows_in": current_span.rows_in,
+                    "rows_out": current_span.rows_out,
+                    "peak_rss_mb": round((current_span.peak_rss_bytes or 0) / 2**20, ndigits=1),
+                }
+            logger.info(
+                f"{repr(func.__name__)} complete",
+                elapsed_seconds=round(run_time, ndigits=2),
+                **{key: metric for key, metric in metrics.items() if metric is not None},
+            )
         return value
 
     return wrapper
+
+
+def _count_rows(values: list) -> int | None:
+    """Return the total rows of the DataFrames in values, or None if there aren't any."""
+    frames = [value for value in values if isinstance(value, pl.DataFrame)]
+    return sum(frame.height for frame in frames) if frames else None
+
+
+def _get_cpu_seconds(end: resource.struct_rusage, start: resource.struct_rusage) -> float:
+    return (end.ru_utime - start.ru_utime) + (end.ru_stime - start.ru_stime)
+
+
+def _get_rss_bytes() -> int:
+    """Return the current resident set size of the process (or its peak, where the current size isn't available)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in bytes on macOS and kB elsewhere
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def _format_prometheus_labels(labels: dict) -> str:
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return ",".join(f'{key}="{escape(value)}"' for key, value in labels.items())
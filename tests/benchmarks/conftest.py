@@ -0,0 +1,146 @@
+import json
+import os
+import resource
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import pytest
+from synthetic import generate_genome_metadata, generate_ncbi_metadata, generate_nextclade_output
+
+# Benchmarks only run when CLADETIME_BENCHMARK is set; sizes, rounds and the
+# allowed slowdown relative to the baseline can be overridden with these variables
+BENCHMARK_ENABLED = bool(os.environ.get("CLADETIME_BENCHMARK"))
+BENCHMARK_ROWS = [int(n) for n in os.environ.get("CLADETIME_BENCHMARK_ROWS", "10000,100000").split(",")]
+BENCHMARK_ROUNDS = int(os.environ.get("CLADETIME_BENCHMARK_ROUNDS", 3))
+BENCHMARK_TOLERANCE = float(os.environ.get("CLADETIME_BENCHMARK_TOLERANCE", 1.5))
+BENCHMARK_SAVE = bool(os.environ.get("CLADETIME_BENCHMARK_SAVE"))
+BENCHMARK_BASELINE = Path(__file__).parent / "baseline.json"
+
+_PROC_STATUS = Path("/proc/self/status")
+_PROC_CLEAR_REFS = Path("/proc/self/clear_refs")
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    num_rows: int
+    seconds: float
+    peak_memory_mb: float
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}[{self.num_rows}]"
+
+
+def _read_proc_status_kb(field: str) -> int:
+    for line in _PROC_STATUS.read_text().splitlines():
+        if line.startswith(f"{field}:"):
+            return int(line.split()[1])
+    raise KeyError(field)
+
+
+def _reset_peak_rss() -> int:
+    """Reset the process's peak RSS (Linux only) and return the current RSS in kB."""
+    try:
+        _PROC_CLEAR_REFS.write_text("5")
+        return _read_proc_status_kb("VmRSS")
+    except OSError:
+        return 0
+
+
+def _get_peak_rss() -> int:
+    """Return the process's peak RSS in kB (since the last _reset_peak_rss, on Linux)."""
+    try:
+        return _read_proc_status_kb("VmHWM")
+    except OSError:
+        # ru_maxrss is in bytes on macOS and kB elsewhere, and can't be reset
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss // 1024 if sys.platform == "darwin" else max_rss
+
+
+def measure(func, name: str, num_rows: int, rounds: int = BENCHMARK_ROUNDS) -> BenchmarkResult:
+    """
+    Run func rounds times and return its fastest wall time and its peak memory use.
+
+    Peak memory is the largest increase of the process's resident set size over
+    its size at the start of a round, which (unlike tracemalloc) includes
+    memory allocated by Polars outside of the Python heap.
+    """
+    seconds = []
+    peak_memory_kb = 0
+    for _ in range(rounds):
+        start_rss = _reset_peak_rss()
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+        peak_memory_kb = max(peak_memory_kb, _get_peak_rss() - start_rss)
+
+    return BenchmarkResult(name, num_rows, min(seconds), peak_memory_kb / 1024)
+
+
+def pytest_generate_tests(metafunc):
+    if "num_rows" in metafunc.fixturenames:
+        metafunc.parametrize("num_rows", BENCHMARK_ROWS, scope="session")
+
+
+@pytest.fixture(scope="session")
+def benchmark_baseline() -> dict:
+    if not BENCHMARK_BASELINE.exists():
+        return {}
+    return json.loads(BENCHMARK_BASELINE.read_text())
+
+
+@pytest.fixture(scope="session")
+def benchmark_results(benchmark_baseline):
+    """Collect benchmark results, and write them to the baseline file when CLADETIME_BENCHMARK_SAVE is set."""
+    results: list[BenchmarkResult] = []
+    yield results
+
+    if BENCHMARK_SAVE and results:
+        baseline = dict(benchmark_baseline)
+        for result in results:
+            baseline[result.key] = {
+                "seconds": round(result.seconds, 4),
+                "peak_memory_mb": round(result.peak_memory_mb, 1),
+            }
+        BENCHMARK_BASELINE.write_text(json.dumps(dict(sorted(baseline.items())), indent=2) + "\n")
+
+
+@pytest.fixture
+def check_benchmark(benchmark_results, benchmark_baseline):
+    """Return a function that records a benchmark result and compares it to the baseline."""
+
+    def check(result: BenchmarkResult):
+        benchmark_results.append(result)
+        baseline = benchmark_baseline.get(result.key)
+        print(f"\n{result.key}: {result.seconds:.3f}s, {result.peak_memory_mb:.1f} MB (baseline {baseline})")
+        if baseline is None or BENCHMARK_SAVE:
+            return
+        # timings of a few milliseconds are noisy, so they have 50 ms of slack
+        assert (
+            result.seconds <= baseline["seconds"] * BENCHMARK_TOLERANCE + 0.05
+        ), f"{result.key} took {result.seconds:.3f}s (baseline {baseline['seconds']}s)"
+        # likewise, small allocations are noisy, so memory only regresses by more than 16 MB
+        assert result.peak_memory_mb <= max(
+            baseline["peak_memory_mb"] * BENCHMARK_TOLERANCE, 16
+        ), f"{result.key} used {result.peak_memory_mb:.1f} MB (baseline {baseline['peak_memory_mb']} MB)"
+
+    return check
+
+
+@pytest.fixture(scope="session")
+def benchmark_data(tmp_path_factory, num_rows) -> dict[str, Path]:
+    """Write synthetic genome metadata, Nextclade output and NCBI metadata files of num_rows rows."""
+    data_path = tmp_path_factory.mktemp(f"benchmark_{num_rows}")
+    files = {
+        "genome_metadata": data_path / "metadata.tsv",
+        "nextclade_output": data_path / "clade_assignments_no_metadata.csv",
+        "ncbi_metadata": data_path / "metadata_ncbi.tsv",
+    }
+    generate_genome_metadata(num_rows).write_csv(files["genome_metadata"], separator="\t")
+    generate_nextclade_output(num_rows).write_csv(files["nextclade_output"], separator=";")
+    generate_ncbi_metadata(num_rows).write_csv(files["ncbi_metadata"], separator="\t")
+
+    return files
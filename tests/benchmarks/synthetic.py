@@ -0,0 +1,163 @@
+"""Deterministic generators of synthetic Nextstrain metadata and Nextclade output for benchmarks."""
+
+from datetime import date, timedelta
+
+import numpy as np
+import polars as pl
+import us
+
+# Clades are assigned in waves: each clade's share of sequences peaks on a different day
+NUM_CLADES = 40
+CLADE_WAVE_DAYS = 60
+
+STATES = [state.name for state in us.states.STATES] + ["Washington DC", "Puerto Rico"]
+# divisions that are in the real data but are filtered out by filter_covid_genome_metadata
+OTHER_DIVISIONS = ["Guam", "Northern Mariana Islands", "Virgin Islands", "USA"]
+OTHER_COUNTRIES = ["Canada", "Mexico", "United Kingdom", "Germany", "Japan", "Brazil"]
+OTHER_HOSTS = ["Felis catus", "Odocoileus virginianus", "Mustela lutreola", "Environment"]
+
+
+def _get_clades() -> list[str]:
+    """Return Nextstrain-style clade names (e.g., 23A, 23B, ...)."""
+    return [f"{20 + i // 10}{chr(ord('A') + i % 10)}" for i in range(NUM_CLADES)]
+
+
+def _get_accessions(num_rows: int, rng: np.random.Generator) -> pl.DataFrame:
+    """Return unique GenBank-style accessions and their revisions."""
+    return pl.DataFrame(
+        {"number": rng.permutation(num_rows) + 100_000, "revision": rng.choice([1, 1, 1, 2], num_rows)}
+    ).select(
+        accession=pl.concat_str(pl.lit("PP"), pl.col("number")),
+        accession_rev=pl.concat_str(pl.lit("PP"), pl.col("number"), pl.lit("."), pl.col("revision")),
+    )
+
+
+def generate_genome_metadata(
+    num_rows: int, seed: int = 42, start_date: date = date(2023, 5, 1), num_days: int = 540
+) -> pl.DataFrame:
+    """
+    Return a synthetic Nextstrain GenBank metadata table.
+
+    The table has the columns that cladetime reads from metadata.tsv.zst, plus
+    a few text columns that are never used, and mimics the shape of the real
+    data: rows are in no particular order, about 80% are human USA sequences
+    from a state (the rest are dropped by filter_covid_genome_metadata), some
+    dates are incomplete, and clade prevalence rises and falls over time. The
+    same arguments always produce the same table.
+    """
+    rng = np.random.default_rng(seed)
+    clades = _get_clades()
+
+    # clade prevalence by day: overlapping waves, with a small background of every clade
+    days = np.arange(num_days)
+    peaks = np.linspace(-CLADE_WAVE_DAYS, num_days + CLADE_WAVE_DAYS, len(clades))
+    weights = np.exp(-(((days[:, None] - peaks[None, :]) / CLADE_WAVE_DAYS) ** 2)) + 0.002
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    # sequences per day, then clades per day (so rows don't need a per-row weighted draw)
+    rows_per_day = rng.multinomial(num_rows, np.full(num_days, 1 / num_days))
+    clade_counts = np.stack([rng.multinomial(n, p) for n, p in zip(rows_per_day, weights)])
+    row_days = np.repeat(np.repeat(days, len(clades)), clade_counts.ravel())
+    row_clades = np.tile(np.arange(len(clades)), num_days).repeat(clade_counts.ravel())
+    order = rng.permutation(num_rows)
+
+    is_usa = rng.random(num_rows) < 0.85
+    rows = pl.DataFrame(
+        {
+            "day": row_days[order],
+            "clade": row_clades[order],
+            # some sequences only have a collection month
+            "incomplete_date": rng.random(num_rows) < 0.02,
+            "is_usa": is_usa,
+            "other_country": rng.integers(0, len(OTHER_COUNTRIES), num_rows),
+            "in_state": rng.random(num_rows) < 0.97,
+            "state": rng.integers(0, len(STATES), num_rows),
+            "other_division": rng.integers(0, len(OTHER_DIVISIONS), num_rows),
+            "is_human": rng.random(num_rows) < 0.99,
+            "other_host": rng.integers(0, len(OTHER_HOSTS), num_rows),
+            "location": rng.integers(0, 4, num_rows),
+            "length": rng.integers(29_000, 29_904, num_rows),
+        }
+    )
+    accessions = _get_accessions(num_rows, rng)
+
+    def lookup(values: list[str], index: str) -> pl.Expr:
+        return pl.lit(pl.Series(values)).gather(pl.col(index))
+
+    collection_date = (pl.lit(start_date) + pl.duration(days=pl.col("day"))).dt.to_string("%Y-%m-%d")
+
+    return pl.concat([accessions, rows], how="horizontal").select(
+        strain=pl.concat_str(pl.lit("USA/CDC-"), pl.col("accession")),
+        genbank_accession=pl.col("accession"),
+        genbank_accession_rev=pl.col("accession_rev"),
+        date=pl.when(pl.col("incomplete_date"))
+        .then(collection_date.str.slice(0, 7) + pl.lit("-XX"))
+        .otherwise(collection_date),
+        region=pl.when(pl.col("is_usa")).then(pl.lit("North America")).otherwise(pl.lit("Europe")),
+        country=pl.when(pl.col("is_usa")).then(pl.lit("USA")).otherwise(lookup(OTHER_COUNTRIES, "other_country")),
+        division=pl.when(pl.col("in_state"))
+        .then(lookup(STATES, "state"))
+        .otherwise(lookup(OTHER_DIVISIONS, "other_division")),
+        location=lookup(["", "Cook County", "King County", "Harris County"], "location"),
+        host=pl.when(pl.col("is_human")).then(pl.lit("Homo sapiens")).otherwise(lookup(OTHER_HOSTS, "other_host")),
+        clade_nextstrain=lookup(clades, "clade"),
+        Nextclade_pango=lookup(clades, "clade") + pl.lit(".1"),
+        length=pl.col("length"),
+        authors=pl.lit("Centers for Disease Control and Prevention Division of Viral Diseases, Pathogen Discovery"),
+    )
+
+
+def generate_nextclade_output(num_rows: int, seed: int = 42) -> pl.DataFrame:
+    """
+    Return a synthetic Nextclade CSV output table (as read from assignment_no_metadata_file).
+
+    Sequence names match the accessions of generate_ncbi_metadata with the same
+    arguments, in a different order (as when Nextclade runs in parallel).
+    """
+    rng = np.random.default_rng(seed)
+    revisions = _get_accessions(num_rows, rng)["accession_rev"]
+    clades = pl.Series(_get_clades()).gather(rng.integers(0, NUM_CLADES, num_rows))
+
+    return pl.DataFrame(
+        {
+            "index": np.arange(num_rows),
+            "seqName": revisions.gather(rng.permutation(num_rows))
+            + " Severe acute respiratory syndrome coronavirus 2 isolate SARS-CoV-2",
+            "clade": clades,
+            "clade_nextstrain": clades,
+            "Nextclade_pango": clades + ".1",
+            "partiallyAliased": "B.1.1.529." + clades,
+            "clade_who": pl.Series(["Omicron", None]).gather(rng.integers(0, 2, num_rows)),
+            "clade_display": clades + " (Omicron)",
+            "qc.overallScore": rng.random(num_rows) * 100,
+            "qc.overallStatus": pl.Series(["good", "mediocre", "bad"]).gather(
+                rng.choice(3, num_rows, p=[0.9, 0.07, 0.03])
+            ),
+        }
+    )
+
+
+def generate_ncbi_metadata(num_rows: int, seed: int = 42) -> pl.DataFrame:
+    """Return a synthetic NCBI sequence metadata table (as written by get_sequence_metadata)."""
+    rng = np.random.default_rng(seed)
+    revisions = _get_accessions(num_rows, rng)["accession_rev"]
+    collection_dates = pl.Series(np.datetime64("2024-01-01") + rng.integers(0, 240, num_rows).astype("timedelta64[D]"))
+    release_dates = (collection_dates + timedelta(days=14)).dt.to_string("%Y-%m-%d")
+
+    return pl.DataFrame(
+        {
+            "Accession": revisions,
+            "Source database": pl.repeat("GenBank", num_rows, eager=True),
+            "Isolate Lineage": "SARS-CoV-2/human/USA/" + revisions,
+            "Geographic Region": pl.repeat("North America", num_rows, eager=True),
+            "Geographic Location": pl.Series(STATES).gather(rng.integers(0, len(STATES), num_rows)),
+            "Isolate Collection date": collection_dates.dt.to_string("%Y-%m-%d"),
+            "Release date": release_dates,
+            "Update date": release_dates,
+            "Virus Pangolin Classification": pl.Series(["JN.1", "KP.2", "KP.3", "XEC"]).gather(
+                rng.integers(0, 4, num_rows)
+            ),
+            "Length": rng.integers(29_000, 29_904, num_rows),
+            "Host Name": pl.repeat("Homo sapiens", num_rows, eager=True),
+        }
+    )
@@ -0,0 +1,114 @@
+"""
+Benchmarks of cladetime's metadata hot paths against synthetic data.
+
+These are skipped unless CLADETIME_BENCHMARK is set, for example:
+
+    CLADETIME_BENCHMARK=1 CLADETIME_BENCHMARK_ROWS=10000,1000000 pytest tests/benchmarks
+
+Each benchmark fails if it's slower, or uses more memory, than its entry in
+baseline.json by more than CLADETIME_BENCHMARK_TOLERANCE (default 1.5x).
+Set CLADETIME_BENCHMARK_SAVE=1 to record new baseline values instead.
+"""
+
+import json
+import subprocess
+import sys
+import textwrap
+from datetime import datetime
+
+import polars as pl
+import pytest
+from cladetime.assign_clades import merge_metadata, write_merged_metadata
+from cladetime.get_clade_list import get_clades
+from cladetime.util.config import Config
+from cladetime.util.sequence import (
+    filter_covid_genome_metadata,
+    get_clade_counts,
+    get_covid_genome_metadata,
+    parse_sequence_assignments,
+)
+from conftest import BENCHMARK_ENABLED, BENCHMARK_ROUNDS, BenchmarkResult, measure
+
+pytestmark = [
+    pytest.mark.benchmark,
+    pytest.mark.skipif(not BENCHMARK_ENABLED, reason="set CLADETIME_BENCHMARK to run benchmarks"),
+]
+
+
+def test_get_covid_genome_metadata(benchmark_data, num_rows, check_benchmark):
+    def run():
+        get_covid_genome_metadata(benchmark_data["genome_metadata"]).collect()
+
+    check_benchmark(measure(run, "get_covid_genome_metadata", num_rows))
+
+
+def test_filter_covid_genome_metadata(benchmark_data, num_rows, check_benchmark):
+    def run():
+        filter_covid_genome_metadata(get_covid_genome_metadata(benchmark_data["genome_metadata"])).collect()
+
+    check_benchmark(measure(run, "filter_covid_genome_metadata", num_rows))
+
+
+def test_get_clade_counts(benchmark_data, num_rows, check_benchmark):
+    def run():
+        metadata = get_covid_genome_metadata(benchmark_data["genome_metadata"])
+        get_clade_counts(filter_covid_genome_metadata(metadata)).collect()
+
+    check_benchmark(measure(run, "get_clade_counts", num_rows))
+
+
+def test_get_clades(benchmark_data, num_rows, check_benchmark):
+    metadata = get_covid_genome_metadata(benchmark_data["genome_metadata"])
+    clade_counts = get_clade_counts(filter_covid_genome_metadata(metadata)).collect().lazy()
+
+    def run():
+        assert get_clades(clade_counts, 0.01, 3, 9)
+
+    check_benchmark(measure(run, "get_clades", num_rows))
+
+
+def test_parse_sequence_assignments(benchmark_data, num_rows, check_benchmark):
+    assignments = pl.read_csv(benchmark_data["nextclade_output"], separator=";")
+
+    def run():
+        parse_sequence_assignments(assignments)
+
+    check_benchmark(measure(run, "parse_sequence_assignments", num_rows))
+
+
+def test_merge_metadata(benchmark_data, num_rows, check_benchmark, tmp_path):
+    config = Config(datetime(2024, 10, 1), datetime(2024, 10, 1), data_path_root=str(tmp_path))
+    config.ncbi_sequence_metadata_file = benchmark_data["ncbi_metadata"]
+    config.assignment_no_metadata_file = benchmark_data["nextclade_output"]
+
+    def run():
+        write_merged_metadata(merge_metadata(config), tmp_path / "merged.parquet")
+
+    check_benchmark(measure(run, "merge_metadata", num_rows))
+    assert pl.scan_parquet(tmp_path / "merged.parquet").select(pl.col("clade").null_count()).collect().item() == 0
+
+
+def test_cladetime_import_and_construction(check_benchmark):
+    # imports are timed in fresh interpreters (an interpreter only imports a module once)
+    script = textwrap.dedent(
+        """
+        import json, time
+        start = time.perf_counter()
+        import cladetime
+        import_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(500):
+            repr(cladetime.CladeTime(sequence_as_of="2024-09-01", tree_as_of="2024-08-01"))
+        construction_seconds = (time.perf_counter() - start) / 500
+
+        print(json.dumps(dict(import_seconds=import_seconds, construction_seconds=construction_seconds)))
+        """
+    )
+    timings = []
+    for _ in range(BENCHMARK_ROUNDS):
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, check=True, text=True)
+        timings.append(json.loads(result.stdout.splitlines()[-1]))
+
+    check_benchmark(BenchmarkResult("cladetime_import", 1, min(t["import_seconds"] for t in timings), 0.0))
+    check_benchmark(BenchmarkResult("CladeTime", 1, min(t["construction_seconds"] for t in timings), 0.0))
@@ -8,6 +8,14 @@ from freezegun import freeze_time
 from moto import mock_aws
 
 
+@pytest.fixture(autouse=True)
+def cache_path(tmp_path, monkeypatch):
+    """Isolate cladetime's persistent caches to a per-test directory."""
+    cache_path = tmp_path / "cladetime_cache"
+    monkeypatch.setenv("CLADETIME_CACHE_DIR", str(cache_path))
+    return cache_path
+
+
 @pytest.fixture
 def s3_object_keys():
     return {
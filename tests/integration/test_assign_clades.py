@@ -1,4 +1,5 @@
 import datetime
+import json
 
 import click
 from cladetime.assign_clades import main
@@ -28,6 +29,21 @@ def test_main(tmp_path):
         )
         assert result.exit_code == 0
 
+    # every stage of the run is recorded in the run metrics report
+    run_metrics_file = next(tmp_path.glob("*_run_metrics.json"))
+    report = json.loads(run_metrics_file.read_text())
+    # (independent stages run concurrently, so they're recorded in no particular order)
+    stages = {stage["name"] for stage in report["spans"][0]["children"]}
+    assert stages == {
+        "get_nextclade_dataset",
+        "get_sequences",
+        "get_sequence_metadata",
+        "prefilter_sequences",
+        "assign_clades",
+        "merge_metadata",
+        "write_merged_metadata",
+    }
+
 
 def test_main_bad_date(tmp_path):
     today = datetime.date.today()
@@ -0,0 +1,342 @@
+import threading
+from datetime import datetime
+
+import polars as pl
+import pytest
+from cladetime.assign_clades import (
+    _run_nextclade,
+    _run_pipeline,
+    assign_clades,
+    merge_metadata,
+    setup_config,
+    write_merged_metadata,
+)
+from cladetime.exceptions import NextcladeRunError
+from cladetime.util.fasta import read_fasta
+
+
+@pytest.fixture
+def test_config(tmp_path):
+    config = setup_config(str(tmp_path), datetime(2024, 9, 1), datetime(2024, 9, 1))
+    config.ncbi_sequence_file.parent.mkdir(parents=True)
+    config.ncbi_sequence_file.write_text(
+        "".join(f">ACC{i}.1 Severe acute respiratory syndrome coronavirus 2\nACGT{'A' * i}\n" for i in range(20))
+    )
+    return config
+
+
+def fake_nextclade(fail_shards=None, hang_shards=()):
+    """Return a subprocess.Popen stand-in that mimics nextclade run's CSV output."""
+    fail_shards = fail_shards if fail_shards is not None else {}
+
+    class FakeProcess:
+        instances = []
+
+        def __init__(self, args, **kwargs):
+            self.instances.append(self)
+            self.args = args
+            self.returncode = None
+            self.terminated = threading.Event()
+
+        def communicate(self):
+            input_file = self.args[2]
+            output_file = self.args[self.args.index("--output-csv") + 1]
+            if any(shard_name in input_file for shard_name in hang_shards) and self.terminated.wait(timeout=10):
+                self.returncode = -15
+                return "", "terminated"
+            for shard_name in fail_shards:
+                if shard_name in input_file and fail_shards[shard_name] > 0:
+                    fail_shards[shard_name] -= 1
+                    self.returncode = 1
+                    return "", "shard exploded"
+            with open(output_file, "w") as f:
+                f.write("index;seqName;clade\n")
+                for i, (accession, sequence) in enumerate(read_fasta(input_file)):
+                    f.write(f"{i};{accession} Severe acute respiratory syndrome coronavirus 2;{len(sequence)}\n")
+            self.returncode = 0
+            return "", ""
+
+        def terminate(self):
+            self.terminated.set()
+
+    return FakeProcess
+
+
+@pytest.mark.parametrize("shards", [1, 3, 50])
+def test_assign_clades_sharded(mocker, test_config, shards):
+    mock_run = mocker.patch("cladetime.assign_clades.subprocess.Popen", side_effect=fake_nextclade())
+
+    assign_clades(test_config, "dataset.zip", shards=shards, jobs=2)
+
+    assignments = pl.read_csv(test_config.assignment_no_metadata_file, separator=";")
+    assert assignments.columns == ["index", "seqName", "clade"]
+    assert sorted(assignments["seqName"].str.split(" ").list.first().to_list()) == sorted(
+        f"ACC{i}.1" for i in range(20)
+    )
+    assert assignments.filter(pl.col("seqName").str.starts_with("ACC7.1 "))["clade"].item() == 11
+
+    assert mock_run.call_count == min(shards, 20)
+    assert all(call.args[0][call.args[0].index("--jobs") + 1] == "2" for call in mock_run.call_args_list)
+
+
+@pytest.mark.parametrize("shards", [1, 3])
+def test_run_nextclade_index(mocker, test_config, shards):
+    mocker.patch("cladetime.assign_clades.subprocess.Popen", side_effect=fake_nextclade())
+    output_file = test_config.data_path / "nextclade.csv"
+
+    _run_nextclade(test_config.ncbi_sequence_file, "dataset.zip", output_file, shards=shards)
+
+    # the index is each record's position in the sequence file, as it is without sharding
+    assignments = pl.read_csv(output_file, separator=";").sort("index")
+    assert assignments["index"].to_list() == list(range(20))
+    assert assignments["seqName"].str.split(" ").list.first().to_list() == [f"ACC{i}.1" for i in range(20)]
+
+
+def test_assign_clades_sharded_retry(mocker, test_config):
+    mock_run = mocker.patch(
+        "cladetime.assign_clades.subprocess.Popen", side_effect=fake_nextclade(fail_shards={"genomic_001": 1})
+    )
+
+    assign_clades(test_config, "dataset.zip", shards=3, retries=1)
+
+    # only the failed shard is re-run
+    assert mock_run.call_count == 4
+    assert len(pl.read_csv(test_config.assignment_no_metadata_file, separator=";")) == 20
+
+
+def test_assign_clades_sharded_failure(mocker, test_config):
+    mocker.patch("cladetime.assign_clades.subprocess.Popen", side_effect=fake_nextclade(fail_shards={"genomic_002": 5}))
+
+    with pytest.raises(NextcladeRunError, match="genomic_002.fasta.*shard exploded"):
+        assign_clades(test_config, "dataset.zip", shards=3, retries=2)
+
+
+def test_assign_clades_sharded_failure_cancels_shards(mocker, test_config):
+    mock_run = mocker.patch(
+        "cladetime.assign_clades.subprocess.Popen",
+        side_effect=fake_nextclade(fail_shards={"genomic_002": 1}, hang_shards=["genomic_000", "genomic_001"]),
+    )
+
+    with pytest.raises(NextcladeRunError, match="genomic_002.fasta.*shard exploded"):
+        assign_clades(test_config, "dataset.zip", shards=3, retries=0)
+
+    # the shards that were still running are stopped (and not retried)
+    assert mock_run.call_count == 3
+    hung = [process for process in mock_run.side_effect.instances if "genomic_002" not in process.args[2]]
+    assert [process.terminated.is_set() for process in hung] == [True, True]
+
+
+def test_assign_clades_incremental(mocker, test_config):
+    mock_run = mocker.patch("cladetime.assign_clades.subprocess.Popen", side_effect=fake_nextclade())
+
+    assign_clades(test_config, "dataset.zip", dataset_tag="2024-07-17--12-57-03Z")
+    first_run = pl.read_csv(test_config.assignment_no_metadata_file, separator=";")
+    assert mock_run.call_count == 1
+    assert len(first_run) == 20
+
+    # next week's sequence file: new records, plus a previously-assigned sequence under a new header
+    with open(test_config.ncbi_sequence_file, "a") as f:
+        f.write(
+            "".join(
+                f">NEW{i}.1 Severe acute respiratory syndrome coronavirus 2\nacgt\nTTTT{'C' * i}\n" for i in range(5)
+            )
+        )
+        f.write(">REV3.2 Severe acute respiratory syndrome coronavirus 2\nACGTAAA\n")
+    mock_run.reset_mock()
+
+    assign_clades(test_config, "dataset.zip", shards=2, dataset_tag="2024-07-17--12-57-03Z")
+
+    # only unseen sequences are sent to Nextclade
+    sent_to_nextclade = [accession for call in mock_run.call_args_list for accession, _ in read_fasta(call.args[0][2])]
+    assert sorted(sent_to_nextclade) == sorted(f"NEW{i}.1" for i in range(5))
+
+    assignments = pl.read_csv(test_config.assignment_no_metadata_file, separator=";")
+    assert assignments.columns == ["index", "seqName", "clade"]
+    assert assignments["index"].to_list() == list(range(26))
+    assert assignments["seqName"].str.split(" ").list.first().to_list() == (
+        [f"ACC{i}.1" for i in range(20)] + [f"NEW{i}.1" for i in range(5)] + ["REV3.2"]
+    )
+    assert assignments["clade"].to_list() == [4 + i for i in range(20)] + [8 + i for i in range(5)] + [7]
+
+    # assignments are stored per Nextclade dataset version (REV3.2 is sent once, as ACC3.1)
+    mock_run.reset_mock()
+    assign_clades(test_config, "dataset.zip", dataset_tag="2024-09-01--00-00-00Z")
+    assert len(list(read_fasta(mock_run.call_args_list[0].args[0][2]))) == 25
+
+
+def test_assign_clades_incremental_all_stored(mocker, test_config):
+    mock_run = mocker.patch("cladetime.assign_clades.subprocess.Popen", side_effect=fake_nextclade())
+    assign_clades(test_config, "dataset.zip", dataset_tag="tag")
+    expected = pl.read_csv(test_config.assignment_no_metadata_file, separator=";")
+    mock_run.reset_mock()
+
+    assign_clades(test_config, "dataset.zip", dataset_tag="tag")
+
+    mock_run.assert_not_called()
+    assert pl.read_csv(test_config.assignment_no_metadata_file, separator=";").equals(expected)
+
+
+def test_assign_clades_cache_disabled(mocker, test_config):
+    mock_run = mocker.patch("cladetime.assign_clades.subprocess.Popen", side_effect=fake_nextclade())
+    test_config.cache_path = None
+
+    assign_clades(test_config, "dataset.zip", dataset_tag="tag")
+    assign_clades(test_config, "dataset.zip", dataset_tag="tag")
+
+    assert mock_run.call_count == 2
+
+
+def test_assign_clades_duplicates(mocker, test_config):
+    mock_run = mocker.patch("cladetime.assign_clades.subprocess.Popen", side_effect=fake_nextclade())
+    with open(test_config.ncbi_sequence_file, "a") as f:
+        f.write(">DUP7.1 Severe acute respiratory syndrome coronavirus 2\nacgtaaa\naaaa\n")
+        f.write(">DUP0.1 Severe acute respiratory syndrome coronavirus 2\nACGT\n")
+
+    assign_clades(test_config, "dataset.zip", shards=2)
+
+    # each distinct sequence is sent to Nextclade once
+    sent_to_nextclade = [accession for call in mock_run.call_args_list for accession, _ in read_fasta(call.args[0][2])]
+    assert sorted(sent_to_nextclade) == sorted(f"ACC{i}.1" for i in range(20))
+
+    # and its assignment is copied to the duplicates
+    assignments = pl.read_csv(test_config.assignment_no_metadata_file, separator=";")
+    assert assignments["index"].to_list() == list(range(22))
+    assert assignments["seqName"].str.split(" ").list.first().to_list()[-2:] == ["DUP7.1", "DUP0.1"]
+    assert assignments["clade"].to_list() == [4 + i for i in range(20)] + [11, 4]
+
+
+def test_assign_clades_qc(mocker, test_config):
+    mock_run = mocker.patch("cladetime.assign_clades.subprocess.Popen", side_effect=fake_nextclade())
+    with open(test_config.ncbi_sequence_file, "a") as f:
+        f.write(">MASKED1.1 Severe acute respiratory syndrome coronavirus 2\nACGTNNNNNNNNNNNNNNNN\n")
+        f.write(">MIXED1.1 Severe acute respiratory syndrome coronavirus 2\nACGTACGTACGTACGTRYKM\n")
+    test_config.sequence_min_length = 10
+    test_config.sequence_max_ambiguous_fraction = 0.5
+
+    assign_clades(test_config, "dataset.zip")
+
+    sequence_qc = pl.read_parquet(test_config.sequence_qc_file)
+    assert sequence_qc.columns == [
+        "record",
+        "seqName",
+        "seq_hash",
+        "length",
+        "ambiguous_fraction",
+        "passed_qc",
+        "representative",
+    ]
+    assert sequence_qc["ambiguous_fraction"].to_list()[-2:] == pytest.approx([0.8, 0.2])
+
+    # short and mostly-ambiguous sequences aren't sent to Nextclade or assigned a clade
+    expected = [f"ACC{i}.1" for i in range(6, 20)] + ["MIXED1.1"]
+    sent_to_nextclade = [accession for accession, _ in read_fasta(mock_run.call_args.args[0][2])]
+    assert sent_to_nextclade == expected
+    assignments = pl.read_csv(test_config.assignment_no_metadata_file, separator=";")
+    assert assignments["seqName"].str.split(" ").list.first().to_list() == expected
+    assert assignments["index"].to_list() == list(range(6, 20)) + [21]
+
+
+@pytest.fixture
+def merge_inputs(test_config):
+    metadata = pl.DataFrame(
+        {
+            "Accession": ["ACC1.1", "ACC2.1", "ACC3.1"],
+            "Source database": ["GenBank"] * 3,
+            "Release date": ["2024-09-01"] * 3,
+            "Update date": ["2024-09-02"] * 3,
+            "Isolate Collection date": ["2024-08-20", "2024-08-21", "2024-08-22"],
+            "Virus Pangolin Classification": ["KP.2", "KP.3", "JN.1"],
+        }
+    )
+    metadata.write_csv(test_config.ncbi_sequence_metadata_file, separator="\t")
+    assignments = pl.DataFrame(
+        {
+            "index": [0, 1],
+            "seqName": [f"ACC{i}.1 Severe acute respiratory syndrome coronavirus 2" for i in [2, 1]],
+            "clade": ["24C", "24B"],
+            "clade_nextstrain": ["24C", "24B"],
+            "Nextclade_pango": ["KP.3", "KP.2"],
+            "partiallyAliased": ["B.1.KP.3", "B.1.KP.2"],
+            "clade_who": [None, None],
+            "clade_display": ["24C (KP.3)", "24B (KP.2)"],
+        }
+    )
+    assignments.write_csv(test_config.assignment_no_metadata_file, separator=";")
+    return test_config
+
+
+@pytest.mark.parametrize("suffix", [".csv", ".parquet"])
+def test_merge_metadata(merge_inputs, tmp_path, suffix):
+    merged_data = merge_metadata(merge_inputs)
+    assert isinstance(merged_data, pl.LazyFrame)
+
+    output_file = write_merged_metadata(merged_data, tmp_path / f"clade_assignments{suffix}")
+    merged = pl.read_parquet(output_file) if suffix == ".parquet" else pl.read_csv(output_file)
+
+    assert merged.columns == merge_inputs.assignment_file_columns
+    assert merged["Accession"].to_list() == ["ACC1.1", "ACC2.1", "ACC3.1"]
+    assert merged["clade_nextstrain"].to_list() == ["24B", "24C", None]
+
+
+@pytest.mark.parametrize("duplicate_file", ["metadata", "assignments"])
+def test_merge_metadata_duplicates(merge_inputs, duplicate_file):
+    if duplicate_file == "metadata":
+        input_file, separator = merge_inputs.ncbi_sequence_metadata_file, "\t"
+    else:
+        input_file, separator = merge_inputs.assignment_no_metadata_file, ";"
+    data = pl.read_csv(input_file, separator=separator)
+    pl.concat([data, data.head(1)]).write_csv(input_file, separator=separator)
+
+    with pytest.raises(ValueError, match="duplicate"):
+        merge_metadata(merge_inputs)
+
+
+@pytest.fixture
+def pipeline_stages(mocker, test_config, tmp_path):
+    """Replace the pipeline's stages with fakes that write their outputs."""
+    dataset_path = tmp_path / "nextclade_dataset_2024-09-01--00-00-00Z.zip"
+
+    def write(*paths):
+        for path in paths:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(path.name)
+
+    stages = {
+        "get_nextclade_dataset": lambda *args: write(dataset_path) or dataset_path,
+        "get_sequences": lambda config: write(
+            config.data_path / config.ncbi_package_name, config.ncbi_sequence_file, config.ncbi_sequence_report_file
+        ),
+        "get_sequence_metadata": lambda config: write(config.ncbi_sequence_metadata_file),
+        "prefilter_sequences": lambda config: write(config.sequence_qc_file) or config.sequence_qc_file,
+        "assign_clades": lambda config, *args, **kwargs: write(config.assignment_no_metadata_file),
+        "merge_metadata": lambda config: None,
+        "write_merged_metadata": lambda merged_data, assignment_file: write(assignment_file) or assignment_file,
+    }
+    return {name: mocker.patch(f"cladetime.assign_clades.{name}", side_effect=stage) for name, stage in stages.items()}
+
+
+def test_run_pipeline_resume(test_config, pipeline_stages):
+    assignment_file = _run_pipeline(test_config, 1, None, "csv")
+    assert assignment_file == test_config.assignment_file
+    assert all(stage.call_count == 1 for stage in pipeline_stages.values())
+
+    # nothing changed, so every stage is skipped
+    assert _run_pipeline(test_config, 1, None, "csv", resume=True) == assignment_file
+    assert all(stage.call_count == 1 for stage in pipeline_stages.values())
+
+    # a lost Nextclade output is re-created, and the merge is skipped because the new output is identical
+    test_config.assignment_no_metadata_file.unlink()
+    _run_pipeline(test_config, 1, None, "csv", resume=True)
+    assert pipeline_stages["assign_clades"].call_count == 2
+    assert pipeline_stages["write_merged_metadata"].call_count == 1
+
+    # a damaged metadata file is regenerated
+    test_config.ncbi_sequence_metadata_file.write_text("truncated")
+    _run_pipeline(test_config, 1, None, "csv", resume=True)
+    assert pipeline_stages["get_sequence_metadata"].call_count == 2
+    assert pipeline_stages["write_merged_metadata"].call_count == 1
+
+    # a different output format reruns the merge
+    assert _run_pipeline(test_config, 1, None, "parquet", resume=True) == assignment_file.with_suffix(".parquet")
+    assert pipeline_stages["write_merged_metadata"].call_count == 2
+    assert pipeline_stages["get_sequences"].call_count == 1
@@ -1,11 +1,19 @@
-from datetime import datetime, timezone
+import json
+import shutil
+import subprocess
+import sys
+import textwrap
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
 from unittest.mock import MagicMock, patch
 from urllib.parse import parse_qs, urlparse
 
 import dateutil.tz
+import polars as pl
 import pytest
 from cladetime.cladetime import CladeTime
 from cladetime.exceptions import CladeTimeFutureDateWarning, CladeTimeInvalidDateError, CladeTimeInvalidURLError
+from cladetime.util.reference import _get_s3_object_urls, _list_s3_object_versions
 from freezegun import freeze_time
 
 
@@ -154,3 +162,139 @@ def test_cladetime_sequence_metadata_no_url(test_config):
 
     with pytest.raises(CladeTimeInvalidURLError):
         ct.sequence_metadata
+
+
+def test_cladetime_urls_resolved_lazily(s3_setup, test_config):
+    mock = MagicMock(return_value=test_config, name="CladeTime._get_config_mock")
+
+    with patch("cladetime.CladeTime._get_config", mock):
+        with patch("cladetime.util.reference._get_s3_object_urls", wraps=_get_s3_object_urls) as mock_urls:
+            ct = CladeTime(sequence_as_of="2023-03-01")
+            repr(ct)
+            assert ct.tree_as_of == datetime(2023, 3, 1, tzinfo=timezone.utc)
+            mock_urls.assert_not_called()
+
+            url_sequence = ct.url_sequence
+            assert ct.url_sequence_metadata is not None
+            assert ct.url_ncov_metadata is None
+            assert ct.url_sequence == url_sequence
+            mock_urls.assert_called_once()
+
+            # changing sequence_as_of invalidates the memoized URLs
+            ct.sequence_as_of = "2023-02-01"
+            assert ct.url_sequence != url_sequence
+            assert mock_urls.call_count == 2
+
+
+def test_cladetime_import_is_lightweight():
+    """Importing cladetime and instantiating CladeTime don't load data libraries (timings are in tests/benchmarks)."""
+    heavy_modules = ["boto3", "botocore", "cloudpathlib", "pandas", "polars", "requests", "structlog", "us"]
+    # a CladeTime can be built (and repr'd) without any S3 lookups or data libraries
+    data_modules = ["boto3", "botocore", "pandas", "polars", "requests", "us"]
+    script = textwrap.dedent(
+        f"""
+        import json, sys
+        import cladetime
+        imported_on_import = [m for m in {heavy_modules} if m in sys.modules]
+        repr(cladetime.CladeTime(sequence_as_of="2024-09-01", tree_as_of="2024-08-01"))
+        imported_on_construction = [m for m in {data_modules} if m in sys.modules]
+        print(json.dumps(dict(imported_on_import=imported_on_import, imported_on_construction=imported_on_construction)))
+        """
+    )
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, check=True, text=True)
+    imported = json.loads(result.stdout.splitlines()[-1])
+
+    assert imported["imported_on_import"] == []
+    assert imported["imported_on_construction"] == []
+
+
+def test_cladetime_ncov_metadata_memoized(test_config):
+    mock = MagicMock(return_value=test_config, name="CladeTime._get_config_mock")
+    with patch("cladetime.CladeTime._get_config", mock):
+        ct = CladeTime(sequence_as_of="2024-09-01")
+
+    ct.url_ncov_metadata = "https://nextstrain-data.s3.amazonaws.com/metadata_version.json?versionId=1"
+    with patch("cladetime.util.sequence._get_ncov_metadata", return_value={"schema_version": "v1"}) as mock_get:
+        assert ct.ncov_metadata == {"schema_version": "v1"}
+        assert ct.ncov_metadata == {"schema_version": "v1"}
+        mock_get.assert_called_once_with(ct.url_ncov_metadata, cache_path=test_config.cache_path)
+
+        ct.url_ncov_metadata = "https://nextstrain-data.s3.amazonaws.com/metadata_version.json?versionId=2"
+        ct.ncov_metadata
+        assert mock_get.call_count == 2
+
+    # failed requests are not memoized
+    with patch("cladetime.util.sequence._get_ncov_metadata", return_value={}) as mock_get:
+        ct.url_ncov_metadata = "https://nextstrain-data.s3.amazonaws.com/metadata_version.json?versionId=3"
+        assert ct.ncov_metadata == {}
+        assert ct.ncov_metadata == {}
+        assert mock_get.call_count == 2
+
+
+def test_cladetime_sequence_metadata_cached(test_config, tmp_path):
+    mock = MagicMock(return_value=test_config, name="CladeTime._get_config_mock")
+    with patch("cladetime.CladeTime._get_config", mock):
+        ct = CladeTime()
+    ct.url_sequence_metadata = "https://nextstrain-data.s3.amazonaws.com/metadata.tsv.zst?versionId=1"
+
+    cached_file = tmp_path / "metadata.tsv"
+    cached_file.write_text("genbank_accession\tdate\nabc\t2024-09-01\n")
+    with patch("cladetime.util.sequence._get_cached_covid_genome_metadata", return_value=cached_file) as mock_cache:
+        metadata = ct.sequence_metadata.collect()
+
+    mock_cache.assert_called_once_with(
+        ct.url_sequence_metadata, test_config.cache_path, max_bytes=test_config.cache_max_bytes, use_parquet=False
+    )
+    assert metadata.shape == (1, 2)
+
+
+def test_cladetime_series(s3_setup, test_config):
+    mock = MagicMock(return_value=test_config, name="CladeTime._get_config_mock")
+    counts = pl.DataFrame({"location": ["Vulcan"], "date": [date(2023, 1, 1)], "clade": ["AA.ZZ"], "count": [1]})
+
+    with patch("cladetime.CladeTime._get_config", mock):
+        with patch("cladetime.util.reference._list_s3_object_versions", wraps=_list_s3_object_versions) as mock_list:
+            with patch("cladetime.util.counts._get_version_clade_counts", return_value=counts) as mock_counts:
+                series = CladeTime.series("2023-01-15", "2023-03-27", freq="2w")
+
+    # all of the dates are resolved from one listing
+    mock_list.assert_called_once()
+    # 2023-01-15 and 2023-01-29 share version 1, and 2023-02-12 through 2023-03-12 share version 3
+    assert mock_counts.call_count == 3
+    assert series["sequence_as_of"].to_list() == [
+        datetime(2023, 1, 15, tzinfo=timezone.utc) + timedelta(weeks=2 * i) for i in range(6)
+    ]
+    assert series.columns == ["location", "date", "clade", "count", "sequence_as_of"]
+
+
+def test_cladetime_series_processes(test_config, tmp_path):
+    mock = MagicMock(return_value=test_config, name="CladeTime._get_config_mock")
+    test_metadata = Path(__file__).parents[1] / "data" / "test_metadata.tsv"
+    metadata_files = [tmp_path / f"metadata_{i}.tsv" for i in range(2)]
+    for metadata_file in metadata_files:
+        shutil.copy(test_metadata, metadata_file)
+    metadata_urls = [("v1", str(metadata_files[0])), ("v1", str(metadata_files[0])), ("v2", str(metadata_files[1]))]
+
+    with patch("cladetime.CladeTime._get_config", mock):
+        with patch("cladetime.util.reference._get_s3_object_url_series", return_value=metadata_urls):
+            series = CladeTime.series("2024-09-01", "2024-09-03", freq="1d", processes=2)
+            serial = CladeTime.series("2024-09-01", "2024-09-03", freq="1d")
+
+    sort_cols = ["sequence_as_of", "location", "date", "clade"]
+    assert series.sort(sort_cols).equals(serial.sort(sort_cols))
+    assert series.group_by("sequence_as_of").agg(pl.col("count").sum()).sort("sequence_as_of")["count"].n_unique() == 1
+
+
+def test_cladetime_clade_counts(test_config):
+    mock = MagicMock(return_value=test_config, name="CladeTime._get_config_mock")
+    with patch("cladetime.CladeTime._get_config", mock):
+        ct = CladeTime()
+    ct.url_sequence_metadata = "https://nextstrain-data.s3.amazonaws.com/metadata.tsv.zst?versionId=1"
+    counts = pl.DataFrame({"location": ["Utah"], "date": [date(2024, 9, 1)], "clade": ["24A"], "count": [3]})
+
+    with patch("cladetime.util.counts._get_version_clade_counts", return_value=counts) as mock_counts:
+        assert ct.clade_counts.collect().equals(counts)
+
+    mock_counts.assert_called_once_with(
+        ct.url_sequence_metadata, test_config.cache_path, max_bytes=test_config.cache_max_bytes, use_parquet=False
+    )
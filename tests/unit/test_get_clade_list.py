@@ -1,8 +1,11 @@
+import shutil
 from pathlib import Path
 from unittest.mock import MagicMock, patch
 
+import polars as pl
 import pytest
-from cladetime.get_clade_list import main
+from cladetime.get_clade_list import get_clades, get_clades_sweep, main
+from cladetime.util.sequence import filter_covid_genome_metadata, get_clade_counts, get_covid_genome_metadata
 
 
 @pytest.fixture
@@ -29,11 +32,68 @@ def test_file_path() -> Path:
         (1, 3, 9, []),
     ],
 )
-def test_clade_list(test_file_path, tmp_path, threshold, weeks, max_clades, expected_list):
-    test_genome_metadata = test_file_path / "test_metadata.tsv"
+@pytest.mark.parametrize("use_parquet", [False, True])
+def test_clade_list(test_file_path, tmp_path, monkeypatch, threshold, weeks, max_clades, expected_list, use_parquet):
+    # without the persistent cache, the metadata file is downloaded and counted on every run
+    monkeypatch.setenv("CLADETIME_NO_CACHE", "1")
+    test_genome_metadata = tmp_path / "test_metadata.tsv"
+    shutil.copy(test_file_path / "test_metadata.tsv", test_genome_metadata)
     mock = MagicMock(return_value=test_genome_metadata, name="genome_metadata_download_mock")
 
     with patch("cladetime.get_clade_list.download_covid_genome_metadata", mock):
-        actual_list = main("some_bucket", "some_key", tmp_path, threshold, weeks, max_clades)
+        actual_list = main("some_bucket", "some_key", tmp_path, threshold, weeks, max_clades, use_parquet)
 
     assert set(expected_list) == set(actual_list)
+
+
+def test_clade_list_count_cube(test_file_path, tmp_path):
+    metadata_url = "https://nextstrain-data.s3.amazonaws.com/files/ncov/open/metadata.tsv.zst?versionId=abc"
+    metadata = get_covid_genome_metadata(test_file_path / "test_metadata.tsv")
+
+    with (
+        patch("cladetime.get_clade_list._get_s3_object_url", return_value=("abc", metadata_url)),
+        patch("cladetime.util.counts._get_versioned_covid_genome_metadata", return_value=metadata) as mock_metadata,
+        patch("cladetime.get_clade_list.download_covid_genome_metadata") as mock_download,
+    ):
+        clade_lists = [main("some_bucket", "some_key", tmp_path, 0.3, 3, 9) for _ in range(2)]
+
+    assert [set(clade_list) for clade_list in clade_lists] == [{"AA", "AA.ZZ", "EE"}] * 2
+    # the metadata version is counted into its clade count cube once, and the second run reads the cube
+    mock_metadata.assert_called_once()
+    mock_download.assert_not_called()
+
+
+@pytest.fixture
+def clade_counts(test_file_path):
+    metadata = get_covid_genome_metadata(test_file_path / "test_metadata.tsv")
+    return get_clade_counts(filter_covid_genome_metadata(metadata))
+
+
+def test_get_clades_single_collect(clade_counts):
+    with patch.object(pl.LazyFrame, "collect", autospec=True, side_effect=pl.LazyFrame.collect) as mock_collect:
+        clades = get_clades(clade_counts, 0.1, 3, 4)
+
+    mock_collect.assert_called_once()
+    # when too many clades cross the threshold, clades are ranked by count (ties broken alphabetically)
+    assert clades == ["AA", "AA.ZZ", "BB", "CC"]
+
+
+def test_get_clades_sweep(clade_counts):
+    parameters = [
+        (threshold, weeks, max_clades) for threshold in [0.1, 0.3, 1] for weeks in [1, 2, 3] for max_clades in [2, 3, 9]
+    ]
+
+    with patch.object(pl.LazyFrame, "collect", autospec=True, side_effect=pl.LazyFrame.collect) as mock_collect:
+        sweep = get_clades_sweep(clade_counts, parameters)
+    # one scan of the clade counts, plus one weekly frame per distinct threshold_weeks
+    assert mock_collect.call_count == 4
+
+    assert sweep.columns == ["threshold", "threshold_weeks", "max_clades", "clades"]
+    assert len(sweep) == len(parameters)
+    for row, (threshold, weeks, max_clades) in zip(sweep.iter_rows(named=True), parameters):
+        assert (row["threshold"], row["threshold_weeks"], row["max_clades"]) == (threshold, weeks, max_clades)
+        assert row["clades"] == get_clades(clade_counts, threshold, weeks, max_clades)
+
+
+def test_get_clades_sweep_no_parameters(clade_counts):
+    assert get_clades_sweep(clade_counts, []).is_empty()
@@ -0,0 +1,239 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+
+import httpx
+import pytest
+from cladetime import CladeTime
+from cladetime.util.aio import (
+    _get_ncov_metadata_async,
+    _get_s3_object_urls_async,
+    download_covid_genome_metadata_async,
+    get_async_client,
+)
+from cladetime.util.config import Config
+from cladetime.util.reference import _get_version_index_path, _read_version_index
+from cladetime.util.timing import MetricsCollector, span
+
+
+class FakeS3:
+    """A versioned, public S3 bucket served over httpx.MockTransport."""
+
+    def __init__(self, bucket_name: str, versions: dict[str, list[tuple[str, bytes]]]):
+        self.bucket_name = bucket_name
+        # object versions by key, oldest first: (LastModified, content)
+        self.versions = versions
+        self.requests: list[httpx.Request] = []
+        self.transport = httpx.MockTransport(self.handle)
+
+    def version_id(self, key: str, index: int) -> str:
+        return f"{key.split('/')[-1]}-v{index + 1}"
+
+    def listings(self, key: str | None = None) -> list[httpx.Request]:
+        return [
+            request
+            for request in self.requests
+            if "versions" in request.url.params and key in (None, request.url.params["prefix"])
+        ]
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        assert request.url.host == f"{self.bucket_name}.s3.amazonaws.com"
+        if "versions" in request.url.params:
+            return self.list_versions(request.url.params)
+
+        key = request.url.path.lstrip("/")
+        version_id = request.url.params["versionId"]
+        for index, (_, content) in enumerate(self.versions.get(key, [])):
+            if self.version_id(key, index) == version_id:
+                return httpx.Response(200, content=content)
+        return httpx.Response(404)
+
+    def list_versions(self, params) -> httpx.Response:
+        key = params["prefix"]
+        # S3 lists versions newest first
+        listing = [
+            (self.version_id(key, index), last_modified)
+            for index, (last_modified, _) in reversed(list(enumerate(self.versions.get(key, []))))
+        ]
+        if "version-id-marker" in params:
+            start = [version_id for version_id, _ in listing].index(params["version-id-marker"]) + 1
+            listing = listing[start:]
+        max_keys = int(params["max-keys"])
+        page, is_truncated = listing[:max_keys], len(listing) > max_keys
+
+        entries = "".join(
+            f"<Version><Key>{escape(key)}</Key><VersionId>{version_id}</VersionId>"
+            f"<IsLatest>false</IsLatest><LastModified>{last_modified}</LastModified></Version>"
+            for version_id, last_modified in page
+        )
+        markers = (
+            f"<NextKeyMarker>{escape(key)}</NextKeyMarker><NextVersionIdMarker>{page[-1][0]}</NextVersionIdMarker>"
+            if is_truncated
+            else ""
+        )
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<ListVersionsResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            f"<Name>{self.bucket_name}</Name><Prefix>{escape(key)}</Prefix>"
+            f"<MaxKeys>{max_keys}</MaxKeys><IsTruncated>{str(is_truncated).lower()}</IsTruncated>"
+            f"{markers}{entries}</ListVersionsResult>"
+        )
+        return httpx.Response(200, content=body.encode(), headers={"Content-Type": "application/xml"})
+
+
+@pytest.fixture
+def fake_s3(s3_object_keys):
+    versions = {
+        object_key: [
+            ("2023-01-01T03:05:01.000Z", f"{file} version 1".encode()),
+            ("2023-02-05T03:33:06.000Z", f"{file} version 2".encode()),
+            ("2023-02-05T14:33:06.000Z", f"{file} version 3".encode()),
+            ("2023-03-22T22:55:12.000Z", f"{file} version 4".encode()),
+        ]
+        for file, object_key in s3_object_keys.items()
+    }
+    return FakeS3("versioned-bucket", versions)
+
+
+@pytest.mark.parametrize("max_keys", [1000, 1])
+def test__get_s3_object_urls_async(fake_s3, s3_object_keys, cache_path, max_keys, monkeypatch):
+    from cladetime.util import aio
+
+    list_versions = aio._list_s3_key_versions_async
+    monkeypatch.setattr(
+        aio,
+        "_list_s3_key_versions_async",
+        lambda *args: list_versions(*args, max_keys=max_keys),
+    )
+    object_keys = list(s3_object_keys.values())
+
+    async def get_urls():
+        async with get_async_client(transport=fake_s3.transport) as client:
+            return await _get_s3_object_urls_async(
+                client, fake_s3.bucket_name, object_keys, datetime(2023, 2, 15, tzinfo=timezone.utc)
+            )
+
+    urls = asyncio.run(get_urls())
+
+    for object_key in object_keys:
+        version_id = fake_s3.version_id(object_key, 2)
+        assert urls[object_key] == (
+            version_id,
+            f"https://{fake_s3.bucket_name}.s3.amazonaws.com/{object_key}?versionId={version_id}",
+        )
+        # the versions are recorded in the same local index as synchronous lookups
+        index = _read_version_index(_get_version_index_path(fake_s3.bucket_name, object_key, cache_path))
+        assert [version_id for _, version_id in index] == [fake_s3.version_id(object_key, i) for i in range(4)]
+    # with one version per page, paging continues until the listing isn't truncated
+    assert len(fake_s3.listings()) == (3 if max_keys == 1000 else 12)
+
+
+def test__get_s3_object_urls_async_shared_listing(fake_s3, s3_object_keys):
+    object_key = s3_object_keys["sequence_metadata"]
+    dates = [datetime(2023, month, 1, tzinfo=timezone.utc) for month in [2, 3, 3]]
+
+    async def get_urls():
+        async with get_async_client(transport=fake_s3.transport) as client:
+            return await asyncio.gather(
+                *[_get_s3_object_urls_async(client, fake_s3.bucket_name, [object_key], date) for date in dates]
+            )
+
+    urls = asyncio.run(get_urls())
+
+    assert [url[object_key][0] for url in urls] == [fake_s3.version_id(object_key, i) for i in [0, 2, 2]]
+    # concurrent lookups of the same object wait for, and then reuse, a single listing
+    assert len(fake_s3.listings()) == 1
+
+
+def test__get_s3_object_urls_async_no_version(fake_s3, s3_object_keys):
+    async def get_urls():
+        async with get_async_client(transport=fake_s3.transport) as client:
+            return await _get_s3_object_urls_async(
+                client,
+                fake_s3.bucket_name,
+                [s3_object_keys["sequence"]],
+                datetime(2022, 12, 31, tzinfo=timezone.utc),
+            )
+
+    with pytest.raises(ValueError, match="No version"):
+        asyncio.run(get_urls())
+
+
+def test_cladetime_create_many(fake_s3, s3_object_keys, monkeypatch):
+    test_config = Config(datetime.now(), datetime.now())
+    test_config.nextstrain_min_seq_date = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    test_config.nextstrain_ncov_bucket = fake_s3.bucket_name
+    test_config.nextstrain_genome_sequence_key = s3_object_keys["sequence"]
+    test_config.nextstrain_genome_metadata_key = s3_object_keys["sequence_metadata"]
+    test_config.nextstrain_ncov_metadata_key = s3_object_keys["ncov_metadata"]
+    test_config.nextstrain_min_ncov_metadata_date = datetime(2023, 2, 1, tzinfo=timezone.utc)
+    monkeypatch.setattr(CladeTime, "_get_config", lambda self: test_config)
+    ncov_metadata_key = s3_object_keys["ncov_metadata"]
+    fake_s3.versions[ncov_metadata_key][2] = (
+        "2023-02-05T14:33:06.000Z",
+        json.dumps({"nextclade_version": "3.8.2"}).encode(),
+    )
+
+    async def create():
+        async with get_async_client(transport=fake_s3.transport) as client:
+            clade_times = await CladeTime.create_many(["2023-01-15", "2023-02-15", "2023-03-01"], client=client)
+            return clade_times, await clade_times[1].ncov_metadata_async(client)
+
+    clade_times, ncov_metadata = asyncio.run(create())
+
+    assert [ct.sequence_as_of.date().isoformat() for ct in clade_times] == ["2023-01-15", "2023-02-15", "2023-03-01"]
+    sequence_key = s3_object_keys["sequence"]
+    assert [ct.url_sequence.rsplit("=", 1)[1] for ct in clade_times] == [
+        fake_s3.version_id(sequence_key, i) for i in [0, 2, 2]
+    ]
+    # ncov metadata isn't published before nextstrain_min_ncov_metadata_date
+    assert clade_times[0].url_ncov_metadata is None
+    assert ncov_metadata == {"nextclade_version": "3.8.2"}
+    # one listing per object, shared by all of the instances
+    assert len(fake_s3.listings()) == 3
+
+
+def test__get_ncov_metadata_async(cache_path):
+    requests = []
+
+    def handle(request):
+        requests.append(request)
+        if "missing" in str(request.url):
+            return httpx.Response(404, text="NoSuchVersion")
+        return httpx.Response(200, json={"nextclade_dataset_version": "2024-07-17--12-57-03Z"})
+
+    url = "https://nextstrain-data.s3.amazonaws.com/files/ncov/open/metadata_version.json?versionId=abc"
+
+    async def get_metadata(url):
+        async with get_async_client(transport=httpx.MockTransport(handle)) as client:
+            return await _get_ncov_metadata_async(client, url, cache_path=cache_path)
+
+    assert asyncio.run(get_metadata(url)) == {"nextclade_dataset_version": "2024-07-17--12-57-03Z"}
+    # the metadata is cached on disk by version
+    assert asyncio.run(get_metadata(url)) == {"nextclade_dataset_version": "2024-07-17--12-57-03Z"}
+    assert len(requests) == 1
+
+    assert asyncio.run(get_metadata(url.replace("abc", "missing"))) == {}
+
+
+def test_download_covid_genome_metadata_async(fake_s3, s3_object_keys, tmp_path):
+    key = s3_object_keys["sequence_metadata"]
+    content = b"\x28\xb5\x2f\xfd" + b"0" * 3000000
+    fake_s3.versions[key][0] = ("2023-01-01T03:05:01.000Z", content)
+
+    async def download():
+        async with get_async_client(transport=fake_s3.transport) as client:
+            return await download_covid_genome_metadata_async(
+                client, fake_s3.bucket_name, key, tmp_path, as_of="2023-02-01"
+            )
+
+    with MetricsCollector() as metrics:
+        with span("download"):
+            filename = asyncio.run(download())
+
+    assert filename == tmp_path / "2023-02-01-metadata.tsv.zst"
+    assert filename.read_bytes() == content
+    assert metrics.spans[0].bytes_downloaded == len(content)
+    assert fake_s3.requests[-1].headers["Accept-Encoding"] == "identity"
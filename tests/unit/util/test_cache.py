@@ -0,0 +1,84 @@
+import os
+
+import pytest
+from cladetime.util.cache import _atomic_open, _evict_lru, _get_cached_s3_object, _get_object_cache_file
+
+
+@pytest.fixture
+def object_url():
+    return "https://nextstrain-data.s3.amazonaws.com/files/ncov/open/metadata.tsv.zst?versionId=abc.123"
+
+
+@pytest.fixture
+def mock_object_session(mocker):
+    session = mocker.MagicMock()
+    response = session.get.return_value.__enter__.return_value
+    response.iter_content.return_value = [b"genbank_accession\tdate\n", b"abc\t2024-09-01\n"]
+    return session
+
+
+def test__atomic_open(tmp_path):
+    path = tmp_path / "nested" / "file.txt"
+    with _atomic_open(path, "w") as f:
+        f.write("howdy")
+        assert not path.exists()
+    assert path.read_text() == "howdy"
+
+    with pytest.raises(RuntimeError):
+        with _atomic_open(path, "w") as f:
+            f.write("partial")
+            raise RuntimeError("interrupted")
+    # a failed write leaves the existing file (and no temp files) in place
+    assert path.read_text() == "howdy"
+    assert os.listdir(path.parent) == ["file.txt"]
+
+
+def test__get_object_cache_file(tmp_path):
+    cache_file = _get_object_cache_file(tmp_path, "files/ncov/open/metadata.tsv.zst", "abc.123")
+    assert cache_file.name.endswith(".tsv.zst")
+    assert cache_file == _get_object_cache_file(tmp_path, "files/ncov/open/metadata.tsv.zst", "abc.123")
+    assert cache_file != _get_object_cache_file(tmp_path, "files/ncov/open/metadata.tsv.zst", "abc.456")
+    assert cache_file != _get_object_cache_file(tmp_path, "files/ncov/open/sequences.fasta.zst", "abc.123")
+
+
+def test__get_cached_s3_object(tmp_path, object_url, mock_object_session):
+    cache_file = _get_cached_s3_object(object_url, tmp_path, session=mock_object_session)
+    assert cache_file == _get_object_cache_file(tmp_path, "files/ncov/open/metadata.tsv.zst", "abc.123")
+    assert cache_file.read_bytes() == b"genbank_accession\tdate\nabc\t2024-09-01\n"
+
+    # cache hits don't download the object again and are marked as recently used
+    os.utime(cache_file, (0, 0))
+    assert _get_cached_s3_object(object_url, tmp_path, session=mock_object_session) == cache_file
+    mock_object_session.get.assert_called_once()
+    assert cache_file.stat().st_mtime > 0
+
+
+def test__get_cached_s3_object_unversioned(tmp_path, mock_object_session):
+    url = "https://nextstrain-data.s3.amazonaws.com/files/ncov/open/metadata.tsv.zst"
+    assert _get_cached_s3_object(url, tmp_path, session=mock_object_session) is None
+    mock_object_session.get.assert_not_called()
+
+
+def test__get_cached_s3_object_eviction(tmp_path, object_url, mock_object_session):
+    old_file = _get_object_cache_file(tmp_path, "files/ncov/open/metadata.tsv.zst", "old")
+    old_file.parent.mkdir(parents=True)
+    old_file.write_bytes(b"x" * 100)
+    os.utime(old_file, (0, 0))
+
+    cache_file = _get_cached_s3_object(object_url, tmp_path, max_bytes=100, session=mock_object_session)
+    assert cache_file.exists()
+    assert not old_file.exists()
+
+
+def test__evict_lru(tmp_path):
+    for i, name in enumerate(["a", "b", "c", "d"]):
+        path = tmp_path / name
+        path.write_bytes(b"x" * 10)
+        os.utime(path, (i, i))
+    # recently used
+    os.utime(tmp_path / "a", (10, 10))
+
+    evicted = _evict_lru(tmp_path, 20, keep=tmp_path / "b")
+
+    assert [path.name for path in evicted] == ["c", "d"]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["a", "b"]
@@ -0,0 +1,104 @@
+from pathlib import Path
+
+import polars as pl
+import pytest
+from cladetime.util.counts import _get_version_clade_counts, _get_version_clade_proportions, get_clade_count_cube
+from cladetime.util.sequence import (
+    filter_covid_genome_metadata,
+    get_clade_counts,
+    get_clade_proportions,
+    get_covid_genome_metadata,
+)
+
+
+@pytest.fixture
+def metadata_versions() -> list[pl.LazyFrame]:
+    """Return three versions of genome metadata: the test file, and two later revisions of it."""
+    v1 = get_covid_genome_metadata(Path(__file__).parents[2] / "data" / "test_metadata.tsv").collect()
+
+    v2 = pl.concat(
+        [
+            # drop one of the identical "abc" rows
+            v1.slice(1),
+            # new sequences
+            v1.filter(pl.col("genbank_accession") == "ghi").with_columns(genbank_accession=pl.lit("xyz")),
+        ]
+    ).with_columns(
+        # reassign a clade without a new revision, and revise a sequence's collection date
+        clade_nextstrain=pl.when(pl.col("genbank_accession") == "jkl").then(pl.lit("DD")).otherwise("clade_nextstrain"),
+        date=pl.when(pl.col("genbank_accession_rev") == "def.1").then(pl.lit("2024-09-02")).otherwise("date"),
+        genbank_accession_rev=pl.when(pl.col("genbank_accession") == "def")
+        .then(pl.lit("def.2"))
+        .otherwise("genbank_accession_rev"),
+    )
+
+    v3 = v2.filter(pl.col("division") != "Utah")
+
+    return [v.lazy() for v in [v1, v2, v3]]
+
+
+def expected_counts(metadata: pl.LazyFrame) -> pl.DataFrame:
+    return get_clade_counts(filter_covid_genome_metadata(metadata)).sort("location", "date", "clade").collect()
+
+
+def test_get_clade_count_cube(tmp_path, metadata_versions):
+    cube_path = tmp_path / "clade_counts"
+
+    for i, metadata in enumerate(metadata_versions):
+        cube_file = get_clade_count_cube(metadata, cube_path, f"v{i + 1}")
+        assert cube_file == cube_path / f"v{i + 1}.parquet"
+        assert pl.read_parquet(cube_file).equals(expected_counts(metadata))
+
+    # each version's cube is a separate file (nothing is shared between versions)
+    assert sorted(f.name for f in cube_path.iterdir()) == ["v1.parquet", "v2.parquet", "v3.parquet"]
+
+
+def test_get_clade_count_cube_existing(tmp_path, metadata_versions):
+    cube_path = tmp_path / "clade_counts"
+    get_clade_count_cube(metadata_versions[0], cube_path, "v1")
+
+    # an existing cube is returned as-is
+    cube_file = get_clade_count_cube(metadata_versions[2], cube_path, "v1")
+    assert pl.read_parquet(cube_file).equals(expected_counts(metadata_versions[0]))
+
+
+def test__get_version_clade_counts(tmp_path, mocker, metadata_versions):
+    url = "https://nextstrain-data.s3.amazonaws.com/files/ncov/open/metadata.tsv.zst?versionId=abc"
+    mock_metadata = mocker.patch(
+        "cladetime.util.counts._get_versioned_covid_genome_metadata", return_value=metadata_versions[1]
+    )
+
+    counts = _get_version_clade_counts(url, cache_path=tmp_path)
+    assert counts.equals(expected_counts(metadata_versions[1]))
+    assert (tmp_path / "clade_counts" / "files/ncov/open/metadata.tsv.zst" / "abc.parquet").exists()
+
+    # counted versions don't need the metadata file
+    assert _get_version_clade_counts(url, cache_path=tmp_path).equals(counts)
+    mock_metadata.assert_called_once()
+
+    # without a cache, counts are computed from the metadata (with the same schema as cached counts)
+    uncached_counts = _get_version_clade_counts(url, cache_path=None)
+    assert uncached_counts.schema == counts.schema
+    assert uncached_counts.sort("location", "date", "clade").equals(
+        expected_counts(metadata_versions[1]), null_equal=True
+    )
+    assert mock_metadata.call_count == 2
+
+
+def test__get_version_clade_proportions(tmp_path, mocker, metadata_versions):
+    url = "https://nextstrain-data.s3.amazonaws.com/files/ncov/open/metadata.tsv.zst?versionId=abc"
+    mock_metadata = mocker.patch(
+        "cladetime.util.counts._get_versioned_covid_genome_metadata", return_value=metadata_versions[0]
+    )
+    expected = get_clade_proportions(expected_counts(metadata_versions[0]).lazy(), clades=["AA"]).collect()
+
+    for _ in range(2):
+        proportions = _get_version_clade_proportions(url, cache_path=tmp_path, clades=["AA"])
+        assert proportions.collect().equals(expected)
+    assert len(list(tmp_path.rglob("abc.proportions.*.parquet"))) == 1
+
+    # each grouping of clades is cached separately
+    all_clades = _get_version_clade_proportions(url, cache_path=tmp_path).collect()
+    assert "other" not in all_clades["clade"].to_list()
+    assert len(list(tmp_path.rglob("abc.proportions.*.parquet"))) == 2
+    mock_metadata.assert_called_once()
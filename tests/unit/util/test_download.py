@@ -0,0 +1,191 @@
+import hashlib
+import threading
+from unittest import mock
+
+import pytest
+import requests
+from cladetime.util.download import ranged_download, stream_download
+from cladetime.util.timing import MetricsCollector, span
+
+BODY = bytes(range(256)) * 40
+
+
+class FakeResponse:
+    """Streamed response that can drop the connection after a number of bytes."""
+
+    def __init__(self, body, status_code=200, headers=None, fail_after=None):
+        self.body = body
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.fail_after = fail_after
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(response=self)
+
+    def iter_content(self, chunk_size=None):
+        end = len(self.body) if self.fail_after is None else self.fail_after
+        for start in range(0, end, 1000):
+            yield self.body[start : min(start + 1000, end)]
+        if self.fail_after is not None:
+            raise requests.exceptions.ChunkedEncodingError("Response ended prematurely")
+
+
+def ranged_server(fail_after=None, honor_range=True):
+    """Return a session.request stand-in that serves BODY, dropping the first connection after fail_after bytes."""
+    failures = [fail_after]
+
+    def request(url, headers=None, **kwargs):
+        fail = failures.pop() if failures else None
+        range_header = (headers or {}).get("Range")
+        if range_header and honor_range:
+            start = int(range_header.removeprefix("bytes=").rstrip("-"))
+            return FakeResponse(
+                BODY[start:], status_code=206, headers={"Content-Range": f"bytes {start}-{len(BODY) - 1}/{len(BODY)}"}
+            )
+        return FakeResponse(BODY, fail_after=fail)
+
+    return request
+
+
+@pytest.mark.parametrize("fail_after", [None, 0, 2500])
+def test_stream_download(tmp_path, fail_after):
+    session = mock.MagicMock()
+    session.get.side_effect = ranged_server(fail_after=fail_after)
+
+    checksum = stream_download(session, "https://test.org/package.zip", tmp_path / "package.zip")
+
+    assert (tmp_path / "package.zip").read_bytes() == BODY
+    assert checksum == hashlib.sha256(BODY).hexdigest()
+    assert session.get.call_count == (1 if fail_after is None else 2)
+    if fail_after:
+        assert session.get.call_args.kwargs["headers"]["Range"] == f"bytes={fail_after}-"
+    # nothing but the downloaded file is left behind
+    assert [f.name for f in tmp_path.iterdir()] == ["package.zip"]
+
+
+@pytest.mark.parametrize("honor_range, expected_bytes", [(True, len(BODY)), (False, 2500 + len(BODY))])
+def test_stream_download_metrics(tmp_path, honor_range, expected_bytes):
+    session = mock.MagicMock()
+    session.get.side_effect = ranged_server(fail_after=2500, honor_range=honor_range)
+
+    with MetricsCollector() as metrics, span("download"):
+        stream_download(session, "https://test.org/package.zip", tmp_path / "package.zip")
+
+    # every byte received is counted, including those discarded when the download restarts
+    assert metrics.get_spans("download")[0].bytes_downloaded == expected_bytes
+
+
+def test_stream_download_range_not_supported(tmp_path):
+    session = mock.MagicMock()
+    session.post.side_effect = ranged_server(fail_after=2500, honor_range=False)
+
+    checksum = stream_download(session, "https://test.org/package.zip", tmp_path / "package.zip", method="POST")
+
+    # the download restarts from the beginning
+    assert (tmp_path / "package.zip").read_bytes() == BODY
+    assert checksum == hashlib.sha256(BODY).hexdigest()
+    assert session.post.call_count == 2
+
+
+def test_stream_download_too_many_interruptions(tmp_path):
+    session = mock.MagicMock()
+    session.get.return_value = FakeResponse(BODY, fail_after=10)
+
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        stream_download(session, "https://test.org/package.zip", tmp_path / "package.zip", max_resumes=2)
+
+    assert session.get.call_count == 3
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_stream_download_http_error(tmp_path):
+    session = mock.MagicMock()
+    session.get.return_value = FakeResponse(b"", status_code=500)
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        stream_download(session, "https://test.org/package.zip", tmp_path / "package.zip")
+
+    assert list(tmp_path.iterdir()) == []
+
+
+class RangedSession:
+    """Session stand-in that serves BODY with byte-range support, failing the first request for some ranges."""
+
+    def __init__(self, accept_ranges="bytes", fail_ranges=()):
+        self.accept_ranges = accept_ranges
+        self.fail_ranges = set(fail_ranges)
+        self.requested_ranges = []
+        self.lock = threading.Lock()
+
+    def head(self, url, **kwargs):
+        headers = {"Content-Length": str(len(BODY))}
+        if self.accept_ranges:
+            headers["Accept-Ranges"] = self.accept_ranges
+        return FakeResponse(b"", headers=headers)
+
+    def get(self, url, headers=None, **kwargs):
+        range_header = (headers or {}).get("Range")
+        if not range_header:
+            return FakeResponse(BODY)
+        start, end = (int(byte) for byte in range_header.removeprefix("bytes=").split("-"))
+        with self.lock:
+            self.requested_ranges.append((start, end))
+            fail = start in self.fail_ranges
+            self.fail_ranges.discard(start)
+        return FakeResponse(
+            BODY[start : end + 1],
+            status_code=206,
+            headers={"Content-Range": f"bytes {start}-{end}/{len(BODY)}"},
+            fail_after=300 if fail else None,
+        )
+
+
+@pytest.mark.parametrize("part_size", [1000, 4096, 5000])
+def test_ranged_download(tmp_path, part_size):
+    session = RangedSession()
+
+    filename = ranged_download(session, "https://test.org/metadata.tsv.zst", tmp_path / "metadata.tsv.zst", part_size)
+
+    assert filename.read_bytes() == BODY
+    assert sorted(session.requested_ranges) == [
+        (start, min(start + part_size, len(BODY)) - 1) for start in range(0, len(BODY), part_size)
+    ]
+    assert [f.name for f in tmp_path.iterdir()] == ["metadata.tsv.zst"]
+
+
+def test_ranged_download_part_retry(tmp_path):
+    session = RangedSession(fail_ranges=[2000, 6000])
+
+    filename = ranged_download(session, "https://test.org/metadata.tsv.zst", tmp_path / "metadata.tsv.zst", 2000)
+
+    assert filename.read_bytes() == BODY
+    # failed parts resume from the last byte received, and other parts aren't re-requested
+    assert len(session.requested_ranges) == 8
+    assert (2300, 3999) in session.requested_ranges
+    assert (6300, 7999) in session.requested_ranges
+
+
+def test_ranged_download_part_failure(tmp_path):
+    session = RangedSession(fail_ranges=[4000])
+
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        ranged_download(session, "https://test.org/metadata.tsv.zst", tmp_path / "metadata.tsv.zst", 2000, retries=0)
+
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("accept_ranges", [None, "none"])
+def test_ranged_download_no_range_support(tmp_path, accept_ranges):
+    session = RangedSession(accept_ranges=accept_ranges)
+
+    filename = ranged_download(session, "https://test.org/metadata.tsv.zst", tmp_path / "metadata.tsv.zst", 1000)
+
+    assert filename.read_bytes() == BODY
+    assert session.requested_ranges == []
@@ -0,0 +1,201 @@
+import hashlib
+import io
+import lzma
+import mmap
+import os
+
+import polars as pl
+import pytest
+import zstandard
+from cladetime.util.fasta import IndexedFasta, build_fasta_index, profile_fasta, read_fasta, split_fasta
+
+FASTA = (
+    b">PP782799.1 Severe acute respiratory syndrome coronavirus 2 isolate SARS-CoV-2/human/USA/NY-PV74597/2022\n"
+    b"ACGTACGTAC\n"
+    b"GTACGT\n"
+    b">ABCDEFG Severe caffeine deprivation virus\n"
+    b"NNNNACGT\n"
+    b">12345678\n"
+    b"\n"
+    b">XYZ.2\r\n"
+    b"TTTT\r\n"
+    b"GGGG"
+)
+
+EXPECTED_RECORDS = [
+    ("PP782799.1", "ACGTACGTACGTACGT"),
+    ("ABCDEFG", "NNNNACGT"),
+    ("12345678", ""),
+    ("XYZ.2", "TTTTGGGG"),
+]
+
+
+@pytest.fixture
+def fasta_files(tmp_path):
+    plain = tmp_path / "sequences.fasta"
+    plain.write_bytes(FASTA)
+    zst = tmp_path / "sequences.fasta.zst"
+    zst.write_bytes(zstandard.ZstdCompressor().compress(FASTA))
+    xz = tmp_path / "sequences.fasta.xz"
+    xz.write_bytes(lzma.compress(FASTA))
+    return {"plain": plain, "zst": zst, "xz": xz}
+
+
+@pytest.mark.parametrize("file_type", ["plain", "zst", "xz"])
+def test_read_fasta(fasta_files, file_type):
+    assert list(read_fasta(fasta_files[file_type])) == EXPECTED_RECORDS
+
+
+@pytest.mark.parametrize("file_type", ["plain", "zst"])
+def test_read_fasta_accessions(fasta_files, file_type):
+    records = list(read_fasta(fasta_files[file_type], accessions={"XYZ.2", "PP782799.1", "not in file"}))
+    assert records == [EXPECTED_RECORDS[0], EXPECTED_RECORDS[3]]
+
+    assert list(read_fasta(fasta_files[file_type], accessions=[])) == []
+
+
+def test_read_fasta_stops_after_accessions_found(fasta_files):
+    records = read_fasta(fasta_files["plain"], accessions=["ABCDEFG"])
+    assert next(records) == EXPECTED_RECORDS[1]
+    with pytest.raises(StopIteration):
+        next(records)
+
+
+def test_read_fasta_url(mocker):
+    url = "https://nextstrain-data.s3.amazonaws.com/files/ncov/open/sequences.fasta.zst?versionId=abc"
+    session = mocker.MagicMock()
+    response = session.get.return_value.__enter__.return_value
+    # a multi-frame zstd stream
+    compressor = zstandard.ZstdCompressor()
+    response.raw = io.BytesIO(compressor.compress(FASTA[:100]) + compressor.compress(FASTA[100:]))
+
+    records = list(read_fasta(url, session=session))
+
+    assert records == EXPECTED_RECORDS
+    session.get.assert_called_once_with(url, stream=True)
+
+
+@pytest.mark.parametrize("num_shards", [1, 2, 3, 10])
+def test_split_fasta(fasta_files, tmp_path, num_shards):
+    shards = split_fasta(fasta_files["zst"], tmp_path / "shards", num_shards)
+
+    assert len(shards) == min(num_shards, len(EXPECTED_RECORDS))
+    assert all(shard.exists() for shard in shards)
+    assert sorted(path.name for path in (tmp_path / "shards").iterdir()) == sorted(shard.name for shard in shards)
+
+    # every record ends up in exactly one shard, unchanged
+    records = [record for shard in shards for record in read_fasta(shard)]
+    assert sorted(records) == sorted(EXPECTED_RECORDS)
+    headers = [line for shard in shards for line in shard.read_bytes().splitlines() if line.startswith(b">")]
+    assert sorted(headers) == sorted(line for line in FASTA.splitlines() if line.startswith(b">"))
+
+
+def test_split_fasta_balanced(tmp_path):
+    fasta = tmp_path / "genomic.fna"
+    fasta.write_bytes(b"".join(f">seq{i}\n".encode() + b"A" * 100 + b"\n" for i in range(100)))
+
+    shards = split_fasta(fasta, tmp_path / "shards", 4)
+
+    sizes = [shard.stat().st_size for shard in shards]
+    assert max(sizes) - min(sizes) <= 110
+
+
+@pytest.mark.parametrize("file_type", ["plain", "zst"])
+def test_profile_fasta(fasta_files, file_type):
+    profile = profile_fasta(fasta_files[file_type])
+
+    assert profile.columns == ["record", "seqName", "seq_hash", "length", "ambiguous_fraction"]
+    assert profile["record"].to_list() == [0, 1, 2, 3]
+    assert profile["length"].to_list() == [16, 8, 0, 8]
+    assert profile["ambiguous_fraction"].to_list() == [0.0, 0.5, 1.0, 0.0]
+    # sequences are hashed without their line breaks
+    assert profile["seq_hash"].to_list() == [
+        hashlib.sha256(sequence.encode()).hexdigest() for _, sequence in EXPECTED_RECORDS
+    ]
+
+
+def test_build_fasta_index(fasta_files):
+    index_path = build_fasta_index(fasta_files["plain"])
+
+    assert index_path == fasta_files["plain"].with_name("sequences.fasta.idx.parquet")
+    index = pl.read_parquet(index_path)
+    assert index.columns == ["accession", "offset", "length"]
+    assert index.get_column("accession").to_list() == sorted(accession for accession, _ in EXPECTED_RECORDS)
+    # offsets and lengths cover each record's sequence, including its line breaks
+    sequences = {accession: FASTA[offset : offset + length] for accession, offset, length in index.iter_rows()}
+    assert sequences == {
+        "PP782799.1": b"ACGTACGTAC\nGTACGT",
+        "ABCDEFG": b"NNNNACGT",
+        "12345678": b"",
+        "XYZ.2": b"TTTT\r\nGGGG",
+    }
+
+
+def test_indexed_fasta(fasta_files):
+    with IndexedFasta(fasta_files["plain"]) as fasta:
+        assert len(fasta) == 4
+        assert "ABCDEFG" in fasta
+        assert "not in file" not in fasta
+
+        sequence = fasta.get("ABCDEFG")
+        # sequences are views of the memory-mapped file, not copies
+        assert isinstance(sequence, memoryview)
+        assert isinstance(sequence.obj, mmap.mmap)
+        assert sequence == b"NNNNACGT"
+        with pytest.raises(KeyError):
+            fasta.get("not in file")
+
+        records = [(accession, bytes(sequence)) for accession, sequence in fasta.get_many(["XYZ.2", "x", "ABCDEFG"])]
+        assert records == [("ABCDEFG", b"NNNNACGT"), ("XYZ.2", b"TTTT\r\nGGGG")]
+        assert list(fasta.read_many(["XYZ.2", "PP782799.1"])) == [EXPECTED_RECORDS[0], EXPECTED_RECORDS[3]]
+
+    # sequences that outlive the file keep the memory map open
+    assert sequence == b"NNNNACGT"
+
+
+def test_indexed_fasta_duplicate_accessions(tmp_path):
+    fasta_file = tmp_path / "genomic.fna"
+    fasta_file.write_bytes(b">B\nCC\n>A\nGG\n>B\nTT\n")
+
+    with IndexedFasta(fasta_file) as fasta:
+        assert fasta.get("B") == b"CC"
+        assert [(accession, bytes(sequence)) for accession, sequence in fasta.get_many(["B", "A", "B"])] == [
+            ("B", b"CC"),
+            ("A", b"GG"),
+        ]
+
+
+def test_indexed_fasta_stale_index(fasta_files):
+    build_fasta_index(fasta_files["plain"])
+    index_time = fasta_files["plain"].with_name("sequences.fasta.idx.parquet").stat().st_mtime
+    fasta_files["plain"].write_bytes(FASTA + b"\n>NEW.1\nACGT\n")
+    os.utime(fasta_files["plain"], (index_time + 1, index_time + 1))
+
+    # an index that's older than its file is rebuilt
+    with IndexedFasta(fasta_files["plain"]) as fasta:
+        assert fasta.get("NEW.1") == b"ACGT"
+
+
+def test_indexed_fasta_empty(tmp_path):
+    fasta_file = tmp_path / "empty.fasta"
+    fasta_file.write_bytes(b"")
+
+    with IndexedFasta(fasta_file) as fasta:
+        assert len(fasta) == 0
+        assert list(fasta.get_many(["A"])) == []
+
+
+def test_indexed_fasta_compressed(fasta_files):
+    with pytest.raises(ValueError, match="compressed"):
+        IndexedFasta(fasta_files["zst"])
+
+
+def test_read_fasta_uses_index(fasta_files, mocker):
+    build_fasta_index(fasta_files["plain"])
+    open_fasta = mocker.patch("cladetime.util.fasta._open_fasta")
+
+    records = list(read_fasta(fasta_files["plain"], accessions={"XYZ.2", "PP782799.1", "not in file"}))
+
+    assert records == [EXPECTED_RECORDS[0], EXPECTED_RECORDS[3]]
+    # only the requested records are read
+    open_fasta.assert_not_called()
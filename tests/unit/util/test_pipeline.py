@@ -0,0 +1,241 @@
+import functools
+import json
+import os
+import threading
+import time
+from unittest import mock
+
+import pytest
+from cladetime.util.pipeline import Pipeline, Stage
+
+
+@pytest.fixture
+def stage_files(tmp_path):
+    input_file = tmp_path / "input.txt"
+    input_file.write_text("sequences")
+    return input_file, tmp_path / "output.txt"
+
+
+def copy_stage(input_file, output_file, **kwargs):
+    """Return a stage that copies input_file to output_file, with a mock that counts its runs."""
+
+    def copy():
+        output_file.write_text(input_file.read_text().upper())
+        return output_file
+
+    run = mock.MagicMock(side_effect=copy)
+    return Stage("copy", run, inputs=[input_file], **kwargs), run
+
+
+def test_pipeline_manifest(tmp_path, stage_files):
+    input_file, output_file = stage_files
+    stage, run = copy_stage(input_file, output_file, params={"date": "2024-10-01"})
+
+    result = Pipeline(tmp_path / "manifests").run(stage)
+
+    assert result == output_file
+    manifest = json.loads((tmp_path / "manifests" / "copy.json").read_text())
+    assert manifest["params"] == {"date": "2024-10-01"}
+    assert set(manifest["inputs"]) == {str(input_file)}
+    # returned paths are recorded as outputs
+    assert set(manifest["outputs"]) == {str(output_file)}
+    assert manifest["outputs"][str(output_file)]["size"] == len("SEQUENCES")
+
+
+def test_pipeline_resume(tmp_path, stage_files):
+    input_file, output_file = stage_files
+    stage, run = copy_stage(input_file, output_file)
+    Pipeline(tmp_path).run(stage)
+
+    assert Pipeline(tmp_path, resume=True).run(stage) == output_file
+    run.assert_called_once()
+
+    # without resume, stages always run
+    Pipeline(tmp_path).run(stage)
+    assert run.call_count == 2
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        lambda input_file, output_file: input_file.write_text("different sequences"),
+        lambda input_file, output_file: output_file.write_text("SEQ"),
+        lambda input_file, output_file: output_file.unlink(),
+    ],
+)
+def test_pipeline_resume_changed_files(tmp_path, stage_files, change):
+    input_file, output_file = stage_files
+    stage, run = copy_stage(input_file, output_file)
+    Pipeline(tmp_path).run(stage)
+
+    change(input_file, output_file)
+    Pipeline(tmp_path, resume=True).run(stage)
+
+    assert run.call_count == 2
+    assert output_file.read_text() == input_file.read_text().upper()
+
+
+def test_pipeline_resume_changed_params(tmp_path, stage_files):
+    input_file, output_file = stage_files
+    stage, run = copy_stage(input_file, output_file, params={"date": "2024-10-01"})
+    Pipeline(tmp_path).run(stage)
+
+    stage.params = {"date": "2024-10-02"}
+    Pipeline(tmp_path, resume=True).run(stage)
+
+    assert run.call_count == 2
+
+
+def test_pipeline_resume_same_size_edit(tmp_path, stage_files):
+    input_file, output_file = stage_files
+    stage, run = copy_stage(input_file, output_file)
+    Pipeline(tmp_path).run(stage)
+
+    # an edit that keeps the file's size is caught by its modification time and hash
+    input_file.write_text("SEQUENCES")
+    os.utime(input_file, ns=(0, 0))
+    Pipeline(tmp_path, resume=True).run(stage)
+
+    assert run.call_count == 2
+
+
+def test_pipeline_failed_stage(tmp_path, stage_files):
+    input_file, output_file = stage_files
+    stage, run = copy_stage(input_file, output_file)
+    Pipeline(tmp_path).run(stage)
+
+    run.side_effect = RuntimeError("Nextclade crashed")
+    with pytest.raises(RuntimeError):
+        Pipeline(tmp_path).run(stage)
+
+    # a stage that failed isn't skipped by the next run
+    assert not (tmp_path / "copy.json").exists()
+
+
+def test_pipeline_reuses_hashes(tmp_path, stage_files):
+    input_file, output_file = stage_files
+    stage, _ = copy_stage(input_file, output_file)
+    Pipeline(tmp_path).run(stage)
+
+    with mock.patch("cladetime.util.pipeline._sha256sum") as mock_sha256sum:
+        Pipeline(tmp_path, resume=True).run(stage)
+
+    # unchanged files aren't re-hashed
+    mock_sha256sum.assert_not_called()
+
+
+def write_stage(name, output_file, inputs=(), record=None, **kwargs):
+    """Return a stage that writes its name to output_file (recording the order in which stages run)."""
+
+    def write():
+        if record is not None:
+            record.append(name)
+        output_file.write_text(name)
+        return output_file
+
+    return Stage(name, write, inputs=list(inputs), outputs=[output_file], **kwargs)
+
+
+def test_pipeline_run_all_dependencies(tmp_path):
+    files = {name: tmp_path / f"{name}.txt" for name in ["a", "b", "c"]}
+    order = []
+    stages = [
+        write_stage("c", files["c"], inputs=[files["a"], files["b"]], record=order),
+        write_stage("b", files["b"], inputs=[files["a"]], record=order),
+        write_stage("a", files["a"], record=order),
+    ]
+
+    results = Pipeline(tmp_path / "manifests").run_all(stages)
+
+    assert order == ["a", "b", "c"]
+    assert results == files
+
+
+def test_pipeline_run_all_concurrent(tmp_path):
+    # each stage waits for the other to start, so they only finish if they run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+
+    def run(name):
+        barrier.wait()
+        return write_stage(name, tmp_path / f"{name}.txt").run()
+
+    stages = [Stage(name, functools.partial(run, name)) for name in ["dataset", "sequences"]]
+
+    assert set(Pipeline(tmp_path).run_all(stages)) == {"dataset", "sequences"}
+
+
+def test_pipeline_run_all_heavy_limit(tmp_path):
+    lock = threading.Lock()
+    running = set()
+    max_running = {"heavy": 0, "all": 0}
+
+    def run(name):
+        with lock:
+            running.add(name)
+            max_running["heavy"] = max(max_running["heavy"], len([name for name in running if "nextclade" in name]))
+            max_running["all"] = max(max_running["all"], len(running))
+        time.sleep(0.1)
+        with lock:
+            running.remove(name)
+
+    stages = [Stage(f"nextclade_{i}", functools.partial(run, f"nextclade_{i}"), heavy=True) for i in range(3)]
+    stages.append(Stage("download", functools.partial(run, "download")))
+
+    Pipeline(tmp_path).run_all(stages, max_heavy=2)
+
+    # the light stage runs alongside two heavy stages, but three heavy stages never run at once
+    assert max_running == {"heavy": 2, "all": 3}
+
+
+def test_pipeline_run_all_callable_inputs(tmp_path):
+    pipeline = Pipeline(tmp_path)
+    dataset_file = tmp_path / "dataset.zip"
+    stages = [
+        write_stage("dataset", dataset_file),
+        Stage(
+            "assign",
+            lambda: write_stage("assign", tmp_path / "assign.txt").run(),
+            inputs=lambda: [pipeline.results["dataset"]],
+            depends_on=["dataset"],
+        ),
+    ]
+
+    pipeline.run_all(stages)
+
+    manifest = json.loads((tmp_path / "assign.json").read_text())
+    assert set(manifest["inputs"]) == {str(dataset_file)}
+
+
+def test_pipeline_run_all_failure(tmp_path):
+    files = {name: tmp_path / f"{name}.txt" for name in ["a", "b"]}
+    order = []
+
+    def fail():
+        raise RuntimeError("NCBI download failed")
+
+    stages = [
+        Stage("a", fail, outputs=[files["a"]]),
+        write_stage("b", files["b"], inputs=[files["a"]], record=order),
+    ]
+
+    with pytest.raises(RuntimeError, match="NCBI download failed"):
+        Pipeline(tmp_path).run_all(stages)
+
+    # stages that depend on a failed stage don't run
+    assert order == []
+
+
+@pytest.mark.parametrize(
+    "depends_on, error",
+    [
+        ({"a": ["b"], "b": ["a"]}, "circular"),
+        ({"a": ["missing"], "b": []}, "unknown"),
+    ],
+)
+def test_pipeline_run_all_bad_dependencies(tmp_path, depends_on, error):
+    stages = [Stage(name, mock.MagicMock(return_value=None), depends_on=after) for name, after in depends_on.items()]
+
+    with pytest.raises(ValueError, match=error):
+        Pipeline(tmp_path).run_all(stages)
+
+    assert all(stage.run.call_count == 0 for stage in stages)
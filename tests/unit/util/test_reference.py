@@ -1,17 +1,131 @@
 from datetime import datetime, timezone
+from pathlib import Path
 from unittest import mock
 
-from cladetime.util.reference import _get_s3_object_url, get_nextclade_dataset
+import pytest
+import requests
+from cladetime.util.reference import (
+    _get_nextclade_dataset_tag,
+    _get_s3_object_url,
+    _get_s3_object_urls,
+    _get_version_index_path,
+    _list_s3_key_versions,
+    _list_s3_object_versions,
+    _read_version_index,
+    _select_s3_object_version,
+    get_nextclade_dataset,
+)
+from freezegun import freeze_time
 
 
-@mock.patch("subprocess.run")
-def test_get_nextclade_dataset(tmp_path):
-    dataset_path = get_nextclade_dataset("2021-09-01", tmp_path)
+@pytest.fixture
+def nextclade_index():
+    return {
+        "collections": [
+            {
+                "datasets": [
+                    {
+                        "path": "nextstrain/sars-cov-2/wuhan-hu-1/orfs",
+                        "shortcuts": ["sars-cov-2", "nextstrain/sars-cov-2"],
+                        "version": {"tag": "2024-08-27--02-51-00Z"},
+                        "versions": [
+                            {"tag": "2024-08-27--02-51-00Z"},
+                            {"tag": "2024-07-17--12-57-03Z"},
+                            {"tag": "2024-04-15--20-23-43Z"},
+                        ],
+                    },
+                    {
+                        "path": "nextstrain/flu/h3n2/ha",
+                        "versions": [{"tag": "2024-08-30--00-00-00Z"}],
+                    },
+                ]
+            }
+        ]
+    }
 
-    # the dataset_path being returned should contain the correct nextclade
-    # datasetset version, as determined by the as_of_date being passed
-    # (returned version is temporarily hard-coded until Nextstrain provides the info we need)
-    assert "2024-07-17--12-57-03Z" in str(dataset_path)
+
+@pytest.fixture
+def index_session(nextclade_index):
+    session = mock.MagicMock()
+    session.get.return_value.json.return_value = nextclade_index
+    return session
+
+
+def fake_dataset_get(args, **kwargs):
+    """Stand-in for nextclade dataset get that writes a dummy dataset zip."""
+    output_zip = Path(args[args.index("--output-zip") + 1])
+    output_zip.write_bytes(f"dataset {args[args.index('--tag') + 1]}".encode())
+
+
+@pytest.mark.parametrize(
+    "as_of_date, expected_tag",
+    [
+        ("2024-07-17", "2024-07-17--12-57-03Z"),
+        ("2024-07-16", "2024-04-15--20-23-43Z"),
+        (datetime(2024, 7, 17, 12, 0, tzinfo=timezone.utc), "2024-04-15--20-23-43Z"),
+        ("2024-09-01", "2024-08-27--02-51-00Z"),
+    ],
+)
+@freeze_time("2024-09-02")
+def test_get_nextclade_dataset(tmp_path, cache_path, index_session, as_of_date, expected_tag):
+    with mock.patch("subprocess.run", side_effect=fake_dataset_get) as mock_run:
+        dataset_path = get_nextclade_dataset(as_of_date, tmp_path, session=index_session)
+        assert dataset_path.name == f"nextclade_dataset_{expected_tag}.zip"
+        assert dataset_path.read_text() == f"dataset {expected_tag}"
+        assert _get_nextclade_dataset_tag(dataset_path) == expected_tag
+
+        # the stored dataset and cached index are reused
+        assert get_nextclade_dataset(as_of_date, tmp_path, session=index_session) == dataset_path
+        mock_run.assert_called_once()
+        index_session.get.assert_called_once()
+
+
+def test_get_nextclade_dataset_checksum_mismatch(tmp_path, index_session):
+    with mock.patch("subprocess.run", side_effect=fake_dataset_get) as mock_run:
+        dataset_path = get_nextclade_dataset("2024-09-01", tmp_path, session=index_session)
+        dataset_path.write_bytes(b"corrupted")
+
+        assert get_nextclade_dataset("2024-09-01", tmp_path, session=index_session) == dataset_path
+        assert mock_run.call_count == 2
+        assert dataset_path.read_text() == "dataset 2024-08-27--02-51-00Z"
+
+
+def test_get_nextclade_dataset_index_refresh(tmp_path, index_session):
+    with mock.patch("subprocess.run", side_effect=fake_dataset_get):
+        with freeze_time("2024-08-01"):
+            get_nextclade_dataset("2024-07-31", tmp_path, session=index_session)
+        with freeze_time("2024-09-02"):
+            get_nextclade_dataset("2024-07-31", tmp_path, session=index_session)
+            assert index_session.get.call_count == 1
+            # the cached index predates this as_of_date, so the index is re-fetched
+            get_nextclade_dataset("2024-09-01", tmp_path, session=index_session)
+            assert index_session.get.call_count == 2
+
+
+def test_get_nextclade_dataset_no_index(tmp_path):
+    session = mock.MagicMock()
+    session.get.side_effect = requests.exceptions.ConnectionError("no network")
+
+    with mock.patch("subprocess.run", side_effect=fake_dataset_get):
+        dataset_path = get_nextclade_dataset("2021-09-01", tmp_path, session=session)
+
+    assert _get_nextclade_dataset_tag(dataset_path) == "2024-07-17--12-57-03Z"
+
+
+def test_get_nextclade_dataset_no_cache(tmp_path, index_session, monkeypatch):
+    monkeypatch.setenv("CLADETIME_NO_CACHE", "1")
+
+    with mock.patch("subprocess.run", side_effect=fake_dataset_get) as mock_run:
+        dataset_path = get_nextclade_dataset("2024-09-01", tmp_path, session=index_session)
+        get_nextclade_dataset("2024-09-01", tmp_path, session=index_session)
+
+    assert dataset_path == tmp_path / "nextclade_dataset_2024-08-27--02-51-00Z.zip"
+    assert mock_run.call_count == 2
+
+
+def test_get_nextclade_dataset_before_first_version(tmp_path, index_session):
+    with pytest.raises(ValueError, match="No Nextclade sars-cov-2 dataset found"):
+        get_nextclade_dataset("2024-01-01", tmp_path, session=index_session)
 
 
 def test__get_s3_object_url(s3_setup):
@@ -29,3 +143,124 @@ def test__get_s3_object_url(s3_setup):
     assert last_modified <= target_date
     assert last_modified == datetime.strptime("2023-02-05 14:33:06", "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
     assert version_url == f"https://{bucket_name}.s3.amazonaws.com/{object_key}?versionId={version_id}"
+
+
+def test__get_s3_object_url_version_index(s3_setup, cache_path):
+    s3_client, bucket_name, s3_object_keys = s3_setup
+    object_key = s3_object_keys["sequence_metadata"]
+
+    target_date = datetime(2023, 3, 1, tzinfo=timezone.utc)
+    version_id, _ = _get_s3_object_url(bucket_name, object_key, target_date)
+
+    index_path = _get_version_index_path(bucket_name, object_key, cache_path)
+    assert index_path.exists()
+    assert len(_read_version_index(index_path)) == 4
+
+    # lookups for dates covered by the index are answered locally
+    with mock.patch("cladetime.util.reference._list_s3_object_versions") as mock_list:
+        assert _get_s3_object_url(bucket_name, object_key, target_date)[0] == version_id
+        early_version_id, _ = _get_s3_object_url(bucket_name, object_key, datetime(2023, 1, 2, tzinfo=timezone.utc))
+    mock_list.assert_not_called()
+
+    s3_object = s3_client.get_object(Bucket=bucket_name, Key=object_key, VersionId=early_version_id)
+    assert s3_object["Body"].read() == b"sequence_metadata version 1"
+
+
+def test__get_s3_object_url_version_index_refresh(s3_setup, cache_path):
+    s3_client, bucket_name, s3_object_keys = s3_setup
+    object_key = s3_object_keys["sequence_metadata"]
+    _get_s3_object_url(bucket_name, object_key, datetime(2023, 3, 1, tzinfo=timezone.utc))
+
+    with freeze_time("2023-05-01 12:00:00"):
+        s3_client.put_object(Bucket=bucket_name, Key=object_key, Body="sequence_metadata version 5")
+
+    # a date past the newest indexed version triggers an incremental refresh
+    with mock.patch("cladetime.util.reference._list_s3_object_versions", wraps=_list_s3_object_versions) as mock_list:
+        version_id, _ = _get_s3_object_url(bucket_name, object_key, datetime(2023, 6, 1, tzinfo=timezone.utc))
+    newer_than = mock_list.call_args.args[1]
+    assert newer_than == {object_key: datetime(2023, 3, 22, 22, 55, 12, tzinfo=timezone.utc)}
+
+    index = _read_version_index(_get_version_index_path(bucket_name, object_key, cache_path))
+    assert len(index) == 5
+    assert index == sorted(index)
+    s3_object = s3_client.get_object(Bucket=bucket_name, Key=object_key, VersionId=version_id)
+    assert s3_object["Body"].read() == b"sequence_metadata version 5"
+
+
+@pytest.mark.parametrize(
+    "date, expected_index",
+    [
+        (datetime(2022, 12, 31, tzinfo=timezone.utc), None),
+        (datetime(2023, 1, 1, tzinfo=timezone.utc), 0),
+        (datetime(2023, 1, 15, tzinfo=timezone.utc), 0),
+        (datetime(2023, 2, 1, tzinfo=timezone.utc), 1),
+        (datetime(2024, 1, 1, tzinfo=timezone.utc), 2),
+    ],
+)
+def test__select_s3_object_version(date, expected_index):
+    versions = [
+        (datetime(2023, 1, 1, tzinfo=timezone.utc), "a"),
+        (datetime(2023, 2, 1, tzinfo=timezone.utc), "b"),
+        (datetime(2023, 3, 1, tzinfo=timezone.utc), "c"),
+    ]
+    selected = _select_s3_object_version(versions, date)
+    if expected_index is None:
+        assert selected is None
+    else:
+        assert selected == versions[expected_index]
+
+
+def test__get_s3_object_urls(s3_setup):
+    s3_client, bucket_name, s3_object_keys = s3_setup
+    object_keys = list(s3_object_keys.values())
+
+    with (
+        mock.patch("cladetime.util.reference._list_s3_object_versions", wraps=_list_s3_object_versions) as mock_list,
+        mock.patch("cladetime.util.reference._list_s3_key_versions", wraps=_list_s3_key_versions) as mock_key_list,
+    ):
+        urls = _get_s3_object_urls(bucket_name, object_keys, datetime(2023, 2, 15, tzinfo=timezone.utc))
+    # the keys are resolved together, by one (concurrent) listing per key
+    assert mock_list.call_count == 1
+    assert sorted(call.args[2] for call in mock_key_list.call_args_list) == sorted(object_keys)
+
+    assert set(urls.keys()) == set(object_keys)
+    for file, object_key in s3_object_keys.items():
+        version_id, version_url = urls[object_key]
+        assert version_url == f"https://{bucket_name}.s3.amazonaws.com/{object_key}?versionId={version_id}"
+        s3_object = s3_client.get_object(Bucket=bucket_name, Key=object_key, VersionId=version_id)
+        assert s3_object["Body"].read().decode("utf-8") == f"{file} version 3"
+
+
+@pytest.mark.parametrize("max_keys", [1, 3, 1000])
+def test__list_s3_object_versions(s3_setup, max_keys):
+    s3_client, bucket_name, s3_object_keys = s3_setup
+    with freeze_time("2023-04-01"):
+        s3_client.put_object(Bucket=bucket_name, Key="data/object-key/not-requested.txt", Body="skip me")
+
+    sequence_key = s3_object_keys["sequence"]
+    metadata_key = s3_object_keys["sequence_metadata"]
+    newer_than = {
+        sequence_key: None,
+        metadata_key: datetime(2023, 2, 5, 14, 33, 6, tzinfo=timezone.utc),
+    }
+    versions = _list_s3_object_versions(bucket_name, newer_than, max_keys=max_keys)
+
+    assert set(versions.keys()) == {sequence_key, metadata_key}
+    assert len(versions[sequence_key]) == 4
+    # only versions on or after the newest known version are listed
+    assert [last_modified for last_modified, _ in versions[metadata_key]] == [
+        datetime(2023, 3, 22, 22, 55, 12, tzinfo=timezone.utc),
+        datetime(2023, 2, 5, 14, 33, 6, tzinfo=timezone.utc),
+    ]
+
+
+@pytest.mark.parametrize(
+    "dataset_path, expected_tag",
+    [
+        ("data/nextclade_dataset_2024-07-17--12-57-03Z.zip", "2024-07-17--12-57-03Z"),
+        (Path("nextclade_dataset_2024-09-01--00-00-00Z.zip"), "2024-09-01--00-00-00Z"),
+        ("data/sars-cov-2.zip", None),
+    ],
+)
+def test_get_nextclade_dataset_tag(dataset_path, expected_tag):
+    assert _get_nextclade_dataset_tag(dataset_path) == expected_tag
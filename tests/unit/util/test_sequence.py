@@ -1,3 +1,6 @@
+import hashlib
+import os
+import shutil
 from collections import Counter
 from datetime import datetime
 from pathlib import Path
@@ -5,9 +8,16 @@ from pathlib import Path
 import polars as pl
 import pytest
 from cladetime.util.sequence import (
+    _get_cached_covid_genome_metadata,
+    _get_metadata_parquet_path,
+    _get_ncov_metadata,
     download_covid_genome_metadata,
     filter_covid_genome_metadata,
+    get_clade_counts,
+    get_clade_proportions,
+    get_covid_genome_data,
     get_covid_genome_metadata,
+    materialize_covid_genome_metadata,
     parse_sequence_assignments,
 )
 
@@ -134,9 +144,161 @@ def test_parse_sequence_assignments(df_assignments):
     # check resulting sequence numbers
     assert Counter(result["seq"].to_list()) == Counter(["PP782799.1", "ABCDEFG", "12345678"])
 
+    # the caller's dataframe is left unchanged
+    assert df_assignments.columns == ["seqName", "clade"]
+
+
+def test_parse_sequence_assignments_lazy(df_assignments):
+    result = parse_sequence_assignments(df_assignments.lazy())
+
+    assert isinstance(result, pl.LazyFrame)
+    assert result.collect().equals(parse_sequence_assignments(df_assignments))
+
 
 def test_parse_sequence_duplicates(df_assignments):
     df_duplicates = pl.concat([df_assignments, df_assignments])
 
     with pytest.raises(ValueError):
         parse_sequence_assignments(df_duplicates)
+
+
+def test__get_ncov_metadata_cache(mocker, tmp_path):
+    url = "https://nextstrain-data.s3.amazonaws.com/files/ncov/open/metadata_version.json?versionId=abc.123"
+    session = mocker.MagicMock()
+    session.get.return_value.ok = True
+    session.get.return_value.json.return_value = {"nextclade_dataset_version": "2024-07-17--12-57-03Z"}
+
+    metadata = _get_ncov_metadata(url, session=session, cache_path=tmp_path)
+    assert metadata == {"nextclade_dataset_version": "2024-07-17--12-57-03Z"}
+    assert (tmp_path / "ncov_metadata" / "abc.123.json").exists()
+
+    # subsequent requests for the same object version are served from the cache
+    cached_metadata = _get_ncov_metadata(url, session=session, cache_path=tmp_path)
+    assert cached_metadata == metadata
+    session.get.assert_called_once()
+
+
+def test__get_ncov_metadata_cache_failed_request(mocker, tmp_path):
+    url = "https://nextstrain-data.s3.amazonaws.com/files/ncov/open/metadata_version.json?versionId=abc.123"
+    session = mocker.MagicMock()
+    session.get.return_value.ok = False
+
+    assert _get_ncov_metadata(url, session=session, cache_path=tmp_path) == {}
+    assert not (tmp_path / "ncov_metadata" / "abc.123.json").exists()
+
+
+def test_materialize_covid_genome_metadata(test_file_path, tmp_path):
+    metadata_path = tmp_path / "test_metadata.tsv"
+    shutil.copy(test_file_path / "test_metadata.tsv", metadata_path)
+    expected = get_covid_genome_metadata(metadata_path).collect()
+
+    parquet_path = materialize_covid_genome_metadata(metadata_path)
+    assert parquet_path == tmp_path / "test_metadata.parquet"
+
+    # the Parquet copy is only read when it's requested
+    assert "Parquet SCAN" not in get_covid_genome_metadata(metadata_path).explain()
+
+    # get_covid_genome_metadata now reads the Parquet copy, which is sorted by country and date
+    metadata = get_covid_genome_metadata(metadata_path, use_parquet=True)
+    assert "Parquet SCAN" in metadata.explain()
+    actual = metadata.collect()
+    assert actual.equals(actual.sort("country", "date", nulls_last=True))
+    assert actual.sort(actual.columns).equals(expected.sort(expected.columns))
+
+    # materializing again is a no-op
+    mtime = parquet_path.stat().st_mtime
+    assert materialize_covid_genome_metadata(metadata_path) == parquet_path
+    assert parquet_path.stat().st_mtime == mtime
+
+
+def test_get_covid_genome_metadata_stale_parquet(test_file_path, tmp_path):
+    metadata_path = tmp_path / "test_metadata.tsv"
+    shutil.copy(test_file_path / "test_metadata.tsv", metadata_path)
+    parquet_path = materialize_covid_genome_metadata(metadata_path)
+
+    # a metadata file that changed after its Parquet copy was written is read directly
+    os.utime(parquet_path, (0, 0))
+    assert "Parquet SCAN" not in get_covid_genome_metadata(metadata_path, use_parquet=True).explain()
+
+
+@pytest.mark.parametrize(
+    "metadata_file, parquet_file",
+    [
+        ("metadata.tsv.zst", "metadata.parquet"),
+        ("metadata.tsv", "metadata.parquet"),
+        ("2024-09-01.metadata.tsv.xz", "2024-09-01.metadata.parquet"),
+        ("Xq1.8_abc.tsv.zst", "Xq1.8_abc.parquet"),
+    ],
+)
+def test__get_metadata_parquet_path(tmp_path, metadata_file, parquet_file):
+    assert _get_metadata_parquet_path(tmp_path / metadata_file) == tmp_path / parquet_file
+
+
+def test_get_covid_genome_metadata_explicit_parquet(test_file_path, tmp_path):
+    parquet_path = tmp_path / "metadata.v2.parquet"
+    get_covid_genome_metadata(test_file_path / "test_metadata.tsv").sink_parquet(parquet_path)
+    # a sibling file with the name of the default Parquet copy isn't read in its place
+    pl.DataFrame({"x": [1]}).write_parquet(tmp_path / "metadata.parquet")
+
+    assert len(get_covid_genome_metadata(parquet_path).collect()) == 29
+
+
+def test__get_cached_covid_genome_metadata(test_file_path, tmp_path, mocker):
+    url = "https://nextstrain-data.s3.amazonaws.com/files/ncov/open/metadata.tsv.zst?versionId=abc.123"
+    mock_session = mocker.MagicMock()
+    response = mock_session.get.return_value.__enter__.return_value
+    response.iter_content.return_value = [(test_file_path / "test_metadata.tsv").read_bytes()]
+    mocker.patch("cladetime.util.cache._get_session", return_value=mock_session)
+
+    # by default, the cached metadata file is returned as-is
+    metadata_path = _get_cached_covid_genome_metadata(url, tmp_path, max_bytes=10**9)
+    assert metadata_path.name.endswith(".tsv.zst")
+    assert list(tmp_path.rglob("*.parquet")) == []
+
+    parquet_path = _get_cached_covid_genome_metadata(url, tmp_path, max_bytes=10**9, use_parquet=True)
+    assert parquet_path.suffix == ".parquet"
+    assert len(get_covid_genome_metadata(parquet_path).collect()) == 29
+
+    # later requests for the same object version reuse the cached file and its Parquet copy
+    assert _get_cached_covid_genome_metadata(url, tmp_path, use_parquet=True) == parquet_path
+    assert _get_cached_covid_genome_metadata(url, tmp_path) == metadata_path
+    mock_session.get.assert_called_once()
+
+
+def test_get_covid_genome_data(mocker, tmp_path):
+    package = b"PK" + os.urandom(5000)
+    response = mocker.MagicMock(status_code=200)
+    response.__enter__.return_value = response
+    response.iter_content.return_value = [package[:2000], package[2000:]]
+    mock_session = mocker.patch("cladetime.util.sequence._get_session").return_value
+    mock_session.post.return_value = response
+
+    checksum = get_covid_genome_data("2024-09-01T00:00:00.000Z", "https://ncbi.test/download", tmp_path / "pkg.zip")
+
+    assert (tmp_path / "pkg.zip").read_bytes() == package
+    assert checksum == hashlib.sha256(package).hexdigest()
+    assert mock_session.post.call_args.args == ("https://ncbi.test/download",)
+    assert '"released_since": "2024-09-01T00:00:00.000Z"' in mock_session.post.call_args.kwargs["data"]
+
+
+@pytest.mark.parametrize("clades", [None, ["AA", "BB"]])
+def test_get_clade_proportions(test_file_path, clades):
+    metadata = get_covid_genome_metadata(test_file_path / "test_metadata.tsv")
+    counts = get_clade_counts(filter_covid_genome_metadata(metadata))
+
+    proportions = get_clade_proportions(counts, clades=clades)
+    assert isinstance(proportions, pl.LazyFrame)
+    proportions = proportions.collect()
+
+    assert proportions.columns == ["location", "week", "clade", "count", "proportion"]
+    # weeks start on Sunday
+    assert set(proportions["week"].dt.weekday().to_list()) == {7}
+    totals = proportions.group_by("location", "week").agg(pl.col("proportion").sum(), pl.col("count").sum())
+    assert all(abs(total - 1) < 1e-9 for total in totals["proportion"])
+    assert proportions["count"].sum() == counts.collect()["count"].sum()
+
+    if clades is None:
+        assert set(proportions["clade"]) == set(counts.collect()["clade"])
+    else:
+        assert set(proportions["clade"]) <= {"AA", "BB", "other"}
+        assert "other" in set(proportions["clade"])
@@ -0,0 +1,255 @@
+import io
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+from unittest import mock
+
+import polars as pl
+import pytest
+import zstandard
+from cladetime.cladetime import CladeTime
+from cladetime.sync_mirror import DEFAULT_MIRROR_KEYS, main
+from cladetime.util.config import Config
+from cladetime.util.download import ranged_download
+from cladetime.util.fasta import read_fasta
+from cladetime.util.reference import _get_s3_object_url, _list_s3_object_versions
+from cladetime.util.storage import (
+    LocalMirrorBackend,
+    S3Backend,
+    _get_local_object,
+    get_storage_backend,
+    sync_mirror,
+)
+from click.testing import CliRunner
+from freezegun import freeze_time
+
+
+@pytest.fixture
+def mirror(tmp_path, s3_setup, monkeypatch):
+    s3_client, bucket_name, _ = s3_setup
+    # the mock bucket isn't public, so objects are read with the fixture's signed client
+    monkeypatch.setattr("cladetime.util.reference._get_s3_client", lambda: s3_client)
+    return LocalMirrorBackend(tmp_path / "mirror", bucket_name)
+
+
+def test_sync_mirror(s3_setup, mirror):
+    s3_client, bucket_name, s3_object_keys = s3_setup
+    object_keys = list(s3_object_keys.values())
+
+    added = sync_mirror(mirror, object_keys)
+
+    for file, object_key in s3_object_keys.items():
+        versions = mirror.get_versions(object_key)
+        assert added[object_key] == [version_id for _, version_id in versions]
+        assert [last_modified.date().isoformat() for last_modified, _ in versions] == [
+            "2023-01-01",
+            "2023-02-05",
+            "2023-02-05",
+            "2023-03-22",
+        ]
+        with mirror.open(object_key, versions[0][1]) as f:
+            assert f.read() == f"{file} version 1".encode()
+        # mirrored files keep the key's suffixes
+        assert mirror.get_path(object_key, versions[0][1]).name.endswith("".join(Path(object_key).suffixes))
+
+    # a sync only copies versions that aren't already in the mirror
+    object_key = s3_object_keys["sequence_metadata"]
+    with freeze_time("2023-05-01 12:00:00"):
+        s3_client.put_object(Bucket=bucket_name, Key=object_key, Body="sequence_metadata version 5")
+    with mock.patch("cladetime.util.reference._list_s3_object_versions", wraps=_list_s3_object_versions) as mock_list:
+        added = sync_mirror(mirror, object_keys)
+
+    assert added[object_key] == [mirror.get_versions(object_key)[-1][1]]
+    assert all(added[key] == [] for key in object_keys if key != object_key)
+    # and only lists the versions published since the mirror's newest version
+    newer_than = mock_list.call_args.args[1]
+    assert newer_than[object_key] == datetime(2023, 3, 22, 22, 55, 12, tzinfo=timezone.utc)
+
+
+def test_sync_mirror_since(s3_setup, mirror):
+    _, _, s3_object_keys = s3_setup
+    object_key = s3_object_keys["sequence"]
+
+    sync_mirror(mirror, [object_key], since=datetime(2023, 2, 1, tzinfo=timezone.utc))
+
+    assert [last_modified.month for last_modified, _ in mirror.get_versions(object_key)] == [2, 2, 3]
+
+
+def test_sync_mirror_interrupted(s3_setup, mirror):
+    _, bucket_name, s3_object_keys = s3_setup
+    object_key = s3_object_keys["sequence"]
+    source = S3Backend(bucket_name)
+    opened = []
+
+    def open_version(object_key, version_id):
+        if len(opened) == 2:
+            raise ConnectionError("connection reset")
+        opened.append(version_id)
+        return S3Backend.open(source, object_key, version_id)
+
+    with mock.patch.object(source, "open", side_effect=open_version):
+        with pytest.raises(ConnectionError):
+            sync_mirror(mirror, [object_key], source=source)
+
+    # the versions that were copied are in the mirror (and the next sync copies the rest)
+    assert [version_id for _, version_id in mirror.get_versions(object_key)] == opened
+    assert len(sync_mirror(mirror, [object_key])[object_key]) == 2
+    assert len(mirror.get_versions(object_key)) == 4
+
+
+def test_storage_backend_read_range(s3_setup, mirror):
+    _, bucket_name, s3_object_keys = s3_setup
+    object_key = s3_object_keys["sequence"]
+    sync_mirror(mirror, [object_key])
+    version_id = mirror.get_versions(object_key)[1][1]
+
+    for backend in [S3Backend(bucket_name), mirror]:
+        assert backend.read_range(object_key, version_id, 9, 7) == b"version"
+
+
+def test_ranged_download_from_mirror(s3_setup, mirror, monkeypatch, tmp_path):
+    s3_client, bucket_name, s3_object_keys = s3_setup
+    object_key = s3_object_keys["sequence"]
+    sync_mirror(mirror, [object_key])
+    version_id = mirror.get_versions(object_key)[1][1]
+    monkeypatch.setenv("CLADETIME_MIRROR_DIR", str(mirror.root))
+    url = S3Backend(bucket_name).get_url(object_key, version_id)
+
+    # the object is read from the mirror in parts, without any HTTP requests
+    session = mock.MagicMock(side_effect=AssertionError("network request"))
+    filename = ranged_download(session, url, tmp_path / "sequences.fasta", part_size=4)
+
+    expected = s3_client.get_object(Bucket=bucket_name, Key=object_key, VersionId=version_id)["Body"].read()
+    assert filename.read_bytes() == expected
+    session.head.assert_not_called()
+    session.get.assert_not_called()
+
+
+def test_get_storage_backend(tmp_path, monkeypatch):
+    assert isinstance(get_storage_backend("nextstrain-data"), S3Backend)
+
+    monkeypatch.setenv("CLADETIME_MIRROR_DIR", str(tmp_path))
+    backend = get_storage_backend("nextstrain-data")
+    assert isinstance(backend, LocalMirrorBackend)
+    assert backend.root == tmp_path
+
+
+def test_mirror_version_lookup(s3_setup, mirror, monkeypatch):
+    _, bucket_name, s3_object_keys = s3_setup
+    object_key = s3_object_keys["sequence_metadata"]
+    sync_mirror(mirror, [object_key], since=datetime(2023, 2, 1, tzinfo=timezone.utc))
+    monkeypatch.setenv("CLADETIME_MIRROR_DIR", str(mirror.root))
+
+    with mock.patch("cladetime.util.reference._list_s3_object_versions") as mock_list:
+        version_id, url = _get_s3_object_url(bucket_name, object_key, datetime(2023, 3, 1, tzinfo=timezone.utc))
+        # the mirror only has the versions it synced
+        with pytest.raises(ValueError, match="No version"):
+            _get_s3_object_url(bucket_name, object_key, datetime(2023, 1, 15, tzinfo=timezone.utc))
+    mock_list.assert_not_called()
+
+    assert version_id == mirror.get_versions(object_key)[1][1]
+    assert _get_local_object(url) == mirror.get_path(object_key, version_id)
+    assert _get_local_object(url.replace(version_id, "unknown")) is None
+    # objects read from S3 don't have a local copy
+    monkeypatch.delenv("CLADETIME_MIRROR_DIR")
+    assert _get_local_object(url) is None
+
+
+def test_cladetime_offline(tmp_path, monkeypatch):
+    object_keys = {
+        "sequence": "files/ncov/open/sequences.fasta.zst",
+        "sequence_metadata": "files/ncov/open/metadata.tsv.zst",
+        "ncov_metadata": "files/ncov/open/metadata_version.json",
+    }
+    metadata = (Path(__file__).parents[2] / "data" / "test_metadata.tsv").read_bytes()
+    contents = {
+        "sequence": zstandard.compress(b">abc.1 SARS-CoV-2\nACGT\nAC\n>def.1 SARS-CoV-2\nGGT\n"),
+        "sequence_metadata": zstandard.compress(metadata),
+        "ncov_metadata": json.dumps({"nextclade_dataset_version": "2024-07-17--12-57-03Z"}).encode(),
+    }
+    mirror = LocalMirrorBackend(tmp_path / "mirror", "nextstrain-data")
+    for name, object_key in object_keys.items():
+        mirror.add_version(object_key, datetime(2024, 9, 1, tzinfo=timezone.utc), "v1", io.BytesIO(contents[name]))
+    monkeypatch.setenv("CLADETIME_MIRROR_DIR", str(mirror.root))
+    test_config = Config(datetime.now(), datetime.now())
+    test_config.nextstrain_min_ncov_metadata_date = datetime(2024, 8, 1, tzinfo=timezone.utc)
+    monkeypatch.setattr(CladeTime, "_get_config", lambda self: test_config)
+
+    # nothing is requested from S3 or over HTTP
+    no_network = mock.MagicMock(side_effect=AssertionError("network request"))
+    with (
+        mock.patch("cladetime.util.reference._get_s3_client", no_network),
+        mock.patch("cladetime.util.cache._get_session", no_network),
+        mock.patch("cladetime.util.sequence._get_session", no_network),
+        mock.patch("cladetime.util.fasta._get_session", no_network),
+    ):
+        ct = CladeTime(sequence_as_of="2024-10-01")
+        assert (
+            ct.url_sequence
+            == "https://nextstrain-data.s3.amazonaws.com/files/ncov/open/sequences.fasta.zst?versionId=v1"
+        )
+        assert ct.ncov_metadata == {"nextclade_dataset_version": "2024-07-17--12-57-03Z"}
+        assert ct.sequence_metadata.select(pl.len()).collect().item() == 29
+        assert list(read_fasta(ct.url_sequence)) == [("abc.1", "ACGTAC"), ("def.1", "GGT")]
+
+
+def test_cladetime_default_mirror_keys(tmp_path, monkeypatch):
+    # a mirror built by a bare sync_mirror doesn't hold the sequence file
+    mirror = LocalMirrorBackend(tmp_path / "mirror", "nextstrain-data")
+    contents = {
+        Config.nextstrain_genome_metadata_key: zstandard.compress(
+            (Path(__file__).parents[2] / "data" / "test_metadata.tsv").read_bytes()
+        ),
+        Config.nextstrain_ncov_metadata_key: json.dumps(
+            {"nextclade_dataset_version": "2024-07-17--12-57-03Z"}
+        ).encode(),
+    }
+    for object_key in DEFAULT_MIRROR_KEYS:
+        mirror.add_version(
+            object_key, datetime(2024, 9, 1, tzinfo=timezone.utc), "v1", io.BytesIO(contents[object_key])
+        )
+    monkeypatch.setenv("CLADETIME_MIRROR_DIR", str(mirror.root))
+    monkeypatch.setenv("CLADETIME_CACHE_DIR", str(tmp_path / "cache"))
+    test_config = Config(datetime.now(), datetime.now())
+    test_config.nextstrain_min_ncov_metadata_date = datetime(2024, 8, 1, tzinfo=timezone.utc)
+    monkeypatch.setattr(CladeTime, "_get_config", lambda self: test_config)
+
+    s3_versions = {Config.nextstrain_genome_sequence_key: [(datetime(2024, 9, 2, tzinfo=timezone.utc), "s3-v1")]}
+    with mock.patch("cladetime.util.reference._list_s3_object_versions", return_value=s3_versions) as mock_list:
+        ct = CladeTime(sequence_as_of="2024-10-01")
+        assert ct.url_sequence_metadata.endswith("/files/ncov/open/metadata.tsv.zst?versionId=v1")
+        assert ct.ncov_metadata == {"nextclade_dataset_version": "2024-07-17--12-57-03Z"}
+        assert ct.sequence_metadata.select(pl.len()).collect().item() == 29
+        # only the object that isn't in the mirror is listed from S3
+        assert ct.url_sequence.endswith("/files/ncov/open/sequences.fasta.zst?versionId=s3-v1")
+    mock_list.assert_called_once_with("nextstrain-data", {Config.nextstrain_genome_sequence_key: None})
+
+
+def test_sync_mirror_command(s3_setup, mirror):
+    _, bucket_name, s3_object_keys = s3_setup
+    object_key = s3_object_keys["ncov_metadata"]
+
+    result = CliRunner().invoke(
+        main,
+        ["--mirror-dir", str(mirror.root), "--bucket", bucket_name, "--key", object_key, "--since", "2023-02-01"],
+    )
+
+    assert result.exit_code == 0, result.output
+    assert len(mirror.get_versions(object_key)) == 3
+
+
+def test_sync_mirror_command_default_keys(tmp_path):
+    with mock.patch("cladetime.sync_mirror.sync_mirror", return_value={}) as mock_sync:
+        result = CliRunner().invoke(main, ["--mirror-dir", str(tmp_path)])
+
+    assert result.exit_code == 0, result.output
+    # the multi-GB sequence file isn't mirrored unless it's requested
+    assert Config.nextstrain_genome_sequence_key not in mock_sync.call_args.args[1]
+    assert Config.nextstrain_genome_metadata_key in mock_sync.call_args.args[1]
+
+
+def test_sync_mirror_command_no_mirror():
+    result = CliRunner().invoke(main, [])
+
+    assert result.exit_code != 0
+    assert "CLADETIME_MIRROR_DIR" in result.output
@@ -0,0 +1,90 @@
+import json
+import subprocess
+import sys
+
+import polars as pl
+import pytest
+from cladetime.util.timing import MetricsCollector, record_bytes_downloaded, span, time_function
+
+
+@time_function
+def _head(df: pl.DataFrame, n: int) -> pl.DataFrame:
+    record_bytes_downloaded(100)
+    return df.head(n)
+
+
+@time_function
+def _stage(df: pl.DataFrame) -> pl.DataFrame:
+    subprocess.run([sys.executable, "-c", "sum(range(10**6))"], check=True)
+    _head(df, 2)
+    _head(df, 3)
+    return df
+
+
+@time_function
+def _failing_stage():
+    raise ValueError("bad metadata")
+
+
+def test_time_function_without_collector():
+    df = pl.DataFrame({"a": range(10)})
+
+    assert _stage(df).equals(df)
+
+
+def test_metrics_collector_spans():
+    df = pl.DataFrame({"a": range(10)})
+
+    with MetricsCollector(labels={"run_time": "20241001T000000"}, trace_python_memory=True) as metrics:
+        with span("main"):
+            _stage(df)
+
+    [main] = metrics.spans
+    [stage] = main.children
+    assert [child.path for child in stage.children] == ["main/_stage/_head", "main/_stage/_head"]
+    assert [child.rows_out for child in stage.children] == [2, 3]
+    assert (stage.rows_in, stage.rows_out) == (10, 10)
+    assert main.rows_in is None
+
+    # downloads and peaks roll up into the enclosing spans
+    assert stage.bytes_downloaded == main.bytes_downloaded == 200
+    assert stage.peak_rss_bytes >= max(child.peak_rss_bytes for child in stage.children)
+    assert stage.python_peak_bytes >= max(child.python_peak_bytes for child in stage.children)
+    # the subprocess's CPU time is charged to the stage that ran it, not to the stages after it
+    assert stage.child_cpu_seconds > 0
+    assert all(child.child_cpu_seconds == 0 for child in stage.children)
+    assert stage.seconds >= sum(child.seconds for child in stage.children)
+
+    assert len(metrics.get_spans("_head")) == 2
+    assert metrics.get_spans("main/_stage") == [stage]
+
+
+def test_metrics_collector_records_errors(tmp_path):
+    with MetricsCollector() as metrics:
+        with pytest.raises(ValueError):
+            _failing_stage()
+
+    [failed] = metrics.spans
+    assert failed.error == "ValueError: bad metadata"
+    assert failed.python_peak_bytes is None
+
+    report = json.loads(metrics.write_json(tmp_path / "metrics.json").read_text())
+    assert report["spans"][0]["name"] == "_failing_stage"
+    assert report["spans"][0]["error"] == "ValueError: bad metadata"
+
+
+def test_metrics_collector_prometheus(tmp_path):
+    df = pl.DataFrame({"a": range(10)})
+
+    with MetricsCollector(labels={"run_time": "20241001T000000"}) as metrics:
+        _stage(df)
+
+    lines = metrics.write_prometheus(tmp_path / "metrics.prom").read_text().splitlines()
+
+    assert "# TYPE cladetime_stage_seconds gauge" in lines
+    # repeated stages are combined
+    assert 'cladetime_stage_calls{run_time="20241001T000000",stage="_stage/_head"} 2' in lines
+    assert 'cladetime_stage_rows_out{run_time="20241001T000000",stage="_stage/_head"} 5' in lines
+    assert 'cladetime_stage_bytes_downloaded{run_time="20241001T000000",stage="_stage"} 200' in lines
+    # metrics that weren't collected are left out
+    assert not any(line.startswith("cladetime_stage_python_peak_bytes{") for line in lines)